@@ -1,42 +1,280 @@
 import mne
 import argparse
 import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
+from result_cache import is_current, write_manifest, manifest_path
+from pipeline_utils import NON_EEG_CHANNEL_TYPES, SESSIONS, eeglab_session_path, raw_session_path, limit_blas_threads
 
-def main():
-    # Set up argument parser
-    parser = argparse.ArgumentParser(description="Mark bad channels in EEG data interactively")
-    parser.add_argument('expert', type=str, help='Expert identifier')
-    parser.add_argument('id', type=str, help='ID of the subject')
-    parser.add_argument('session', type=str, help='Session identifier')
-    parser.add_argument('--root_dir', type=str, default="/Volumes/eeg/", help='Root directory of the data')
+# Electrode positions of the cap, also loaded into EEGLAB when the recordings are exported
+CHANNEL_LOCS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'channel_locs.elc')
 
-    # Parse arguments
-    args = parser.parse_args()
-    root_dir = args.root_dir
-    expert = args.expert
-    subject_id = args.id
-    session = args.session
+# Duration of the windows statistics are computed over, and of the chunks of windows read from disk at once
+WINDOW_DURATION = 1.0
+CHUNK_DURATION = 60.0
+
+# Number of nearest electrodes each channel is correlated with
+N_NEIGHBORS = 6
+
+# Thresholds of the per-window criteria: robust z-score of the amplitude and of the high frequency noise, median
+# correlation with the neighbors, and standard deviation (in volts) below which a window is flat
+DEVIATION_THRESHOLD = 5.0
+HF_NOISE_THRESHOLD = 5.0
+CORRELATION_THRESHOLD = 0.4
+FLAT_THRESHOLD = 1e-8
+
+# Frequency above which the signal counts as high frequency noise
+HF_NOISE_FREQ = 50.0
+
+# Fraction of windows that must fail a criterion for a channel to be marked bad
+BAD_WINDOW_FRACTION = 0.2
+
+# Scale factors turning the interquartile range and the median absolute deviation into standard deviations
+IQR_TO_STD = 0.7413
+MAD_TO_STD = 1.4826
+
+CRITERIA = ["deviation", "correlation", "hf_noise", "flat"]
+
+# Bump when the detector changes which channels it marks, so that automatically marked recordings are marked again
+OUTPUT_VERSION = 1
+
+GROUPS = ["expert", "novice"]
+
+
+def _init_worker(blas_threads):
+    # Every worker reads one recording at a time, so its BLAS threads are capped to share the CPUs between workers
+    limit_blas_threads(blas_threads)
+    mne.set_log_level("WARNING")
+
+
+def read_channel_locations(path=CHANNEL_LOCS_PATH):
+    """
+    Reads the electrode positions of an ASA .elc file such as data/channel_locs.elc.
+
+    Returns:
+        positions : dict mapping each electrode name to its (x, y, z) position.
+    """
+    with open(path) as f:
+        lines = [line.strip() for line in f]
+    n_positions = int(lines[0].split("=")[1])
+    positions_start = lines.index("Positions") + 1
+    coordinates = np.array([line.split() for line in lines[positions_start:positions_start + n_positions]], dtype=float)
+    labels_start = lines.index("Labels") + 1
+    labels = " ".join(lines[labels_start:]).split()[:n_positions]
+    return dict(zip(labels, coordinates))
+
+
+def find_neighbors(ch_names, positions, n_neighbors=N_NEIGHBORS):
+    """
+    Finds the nearest electrodes of every channel among ch_names.
+
+    Returns:
+        neighbors : (n_channels, n_neighbors) array of channel indices, -1 for channels without a known position.
+    """
+    located = [idx for idx, ch_name in enumerate(ch_names) if ch_name in positions]
+    neighbors = np.full((len(ch_names), n_neighbors), -1)
+    if len(located) <= n_neighbors:
+        return neighbors
+    coordinates = np.array([positions[ch_names[idx]] for idx in located])
+    distances = np.linalg.norm(coordinates[:, None] - coordinates[None], axis=-1)
+    np.fill_diagonal(distances, np.inf)
+    nearest = np.argsort(distances, axis=1)[:, :n_neighbors]
+    neighbors[located] = np.array(located)[nearest]
+    return neighbors
+
+
+def _robust_z(values, axis=0):
+    # Robust z-score across channels, from the median and the median absolute deviation
+    median = np.median(values, axis=axis, keepdims=True)
+    mad = MAD_TO_STD * np.median(np.abs(values - median), axis=axis, keepdims=True)
+    return (values - median) / np.where(mad > 0, mad, np.inf)
+
+
+def _window_flags(windows, neighbors, sfreq, deviation_threshold, hf_noise_threshold, correlation_threshold, flat_threshold):
+    # Flags of every criterion for a (n_channels, n_windows, n_samples) block of windows, each (n_channels, n_windows)
+    centered = windows - windows.mean(axis=-1, keepdims=True)
+    flags = {}
+
+    # Robust amplitude of every window, compared across channels
+    q75, q25 = np.percentile(centered, [75, 25], axis=-1)
+    amplitude = IQR_TO_STD * (q75 - q25)
+    flags["deviation"] = np.abs(_robust_z(amplitude)) > deviation_threshold
+
+    # Median correlation with the neighbors, one neighbor at a time so that memory stays within a few blocks
+    norms = np.linalg.norm(centered, axis=-1)
+    norms = np.where(norms > 0, norms, np.inf)
+    correlations = np.stack([np.einsum('cws,cws->cw', centered, centered[neighbors[:, k]]) / (norms * norms[neighbors[:, k]])
+                             for k in range(neighbors.shape[1])])
+    correlation = np.median(correlations, axis=0)
+    flags["correlation"] = (correlation < correlation_threshold) & (neighbors[:, :1] >= 0)
+
+    # Ratio of the power above HF_NOISE_FREQ to the power below it, compared across channels
+    if sfreq > 2 * HF_NOISE_FREQ:
+        power = np.abs(np.fft.rfft(centered, axis=-1)) ** 2
+        freqs = np.fft.rfftfreq(centered.shape[-1], 1.0 / sfreq)
+        low = power[..., freqs <= HF_NOISE_FREQ].sum(axis=-1)
+        noise = np.sqrt(power[..., freqs > HF_NOISE_FREQ].sum(axis=-1) / np.where(low > 0, low, np.inf))
+        flags["hf_noise"] = _robust_z(noise) > hf_noise_threshold
+    else:
+        flags["hf_noise"] = np.zeros(amplitude.shape, dtype=bool)
+
+    flags["flat"] = centered.std(axis=-1) < flat_threshold
+    return flags
+
+
+def detect_bad_channels(raw, positions=None, window_duration=WINDOW_DURATION, chunk_duration=CHUNK_DURATION, n_neighbors=N_NEIGHBORS,
+                        deviation_threshold=DEVIATION_THRESHOLD, hf_noise_threshold=HF_NOISE_THRESHOLD, correlation_threshold=CORRELATION_THRESHOLD,
+                        flat_threshold=FLAT_THRESHOLD, bad_window_fraction=BAD_WINDOW_FRACTION):
+    """
+    Detects bad EEG channels from robust statistics of short windows, reading the recording in chunks.
+
+    Every window of window_duration seconds is judged on four criteria: a robust z-score of its amplitude across
+    channels above deviation_threshold, a median correlation with the n_neighbors nearest electrodes below
+    correlation_threshold, a robust z-score of its high to low frequency power ratio above hf_noise_threshold, and a
+    standard deviation below flat_threshold. A channel is bad when more than bad_window_fraction of its windows fail
+    the same criterion. Chunks of chunk_duration seconds are read at a time, so memory does not grow with the length
+    of the recording, and the raw data need not be preloaded.
+
+    Args:
+        positions: dict mapping electrode names to positions. Defaults to the positions in data/channel_locs.elc.
 
+    Returns:
+        bads : dict mapping each bad channel to the list of criteria it failed, in channel order.
+    """
+    if positions is None:
+        positions = read_channel_locations()
+    picks = [idx for idx, ch_name in enumerate(raw.ch_names) if ch_name not in NON_EEG_CHANNEL_TYPES]
+    ch_names = [raw.ch_names[idx] for idx in picks]
+    neighbors = find_neighbors(ch_names, positions, n_neighbors)
+
+    sfreq = raw.info['sfreq']
+    window_size = int(round(window_duration * sfreq))
+    windows_per_chunk = max(1, int(chunk_duration // window_duration))
+    n_windows = raw.n_times // window_size
+    bad_counts = {criterion: np.zeros(len(ch_names), dtype=np.int64) for criterion in CRITERIA}
+
+    for first_window in range(0, n_windows, windows_per_chunk):
+        chunk_windows = min(windows_per_chunk, n_windows - first_window)
+        start = first_window * window_size
+        data = raw.get_data(picks=picks, start=start, stop=start + chunk_windows * window_size)
+        windows = data.reshape(len(ch_names), chunk_windows, window_size)
+        flags = _window_flags(windows, neighbors, sfreq, deviation_threshold, hf_noise_threshold, correlation_threshold, flat_threshold)
+        for criterion in CRITERIA:
+            bad_counts[criterion] += flags[criterion].sum(axis=1)
+
+    bads = {}
+    for idx, ch_name in enumerate(ch_names):
+        failed = [criterion for criterion in CRITERIA if bad_counts[criterion][idx] > bad_window_fraction * n_windows]
+        if len(failed) > 0:
+            bads[ch_name] = failed
+    return bads
+
+
+def mark_bads_auto(root_dir, expert, subject_id, session, force=False, **detector_kwargs):
+    """
+    Detects the bad channels of an EEGLAB recording with detect_bad_channels and saves the recording with the
+    candidates marked as bad to the FIF file read by 1_preproc.py, without opening the interactive plot.
+
+    The FIF is written atomically with a manifest of the .set and .fdt files and the detector settings, so current
+    recordings are skipped. Recordings saved by the interactive mode have no manifest and are never overwritten unless
+    force is set.
+
+    Returns:
+        (out_path, bads) : path of the saved recording, and dict mapping each candidate to the criteria it failed, or
+        None if the recording was skipped.
+    """
+    in_path = eeglab_session_path(root_dir, expert, subject_id, session)
+    out_path = raw_session_path(root_dir, expert, subject_id, session)
+    input_paths = [in_path, os.path.splitext(in_path)[0] + '.fdt']
+    # The electrode positions decide the neighbors of every channel, so editing them marks the recording again
+    input_paths = [path for path in input_paths if os.path.exists(path)] + [CHANNEL_LOCS_PATH]
+
+    params = dict({"mode": "auto", "window_duration": WINDOW_DURATION, "n_neighbors": N_NEIGHBORS, "deviation_threshold": DEVIATION_THRESHOLD,
+                   "hf_noise_threshold": HF_NOISE_THRESHOLD, "correlation_threshold": CORRELATION_THRESHOLD, "flat_threshold": FLAT_THRESHOLD,
+                   "bad_window_fraction": BAD_WINDOW_FRACTION}, **detector_kwargs)
+    params.pop("chunk_duration", None)
+    if not force and os.path.exists(out_path) and not os.path.exists(manifest_path(out_path)):
+        print("Keeping manually marked bad channels: ", out_path)
+        return out_path, None
+    if not force and is_current(out_path, input_paths, params, OUTPUT_VERSION):
+        print("Bad channels are up to date: ", out_path)
+        return out_path, None
+
+    # The data stays on disk: the detector reads it in chunks and saving copies it over in buffers
+    raw = mne.io.read_raw_eeglab(in_path, preload=False)
+    bads = detect_bad_channels(raw, **detector_kwargs)
+    raw.info['bads'] = list(bads)
+
+    # MNE expects raw file names to end in _raw.fif, so the temporary name keeps that ending
+    tmp_path = f"{out_path[:-len('_raw.fif')]}.{os.getpid()}.tmp_raw.fif"
+    raw.save(tmp_path, overwrite=True)
+    os.replace(tmp_path, out_path)
+    write_manifest(out_path, input_paths, params, OUTPUT_VERSION)
+    print(f"Marked {expert} {subject_id} {session} bad channels {bads}, saved to: ", out_path)
+    return out_path, bads
+
+
+def find_eeglab_sessions(root_dir, experts=GROUPS, subject_ids=None, sessions=SESSIONS):
+    """
+    Finds every (expert, subject_id, session) with an EEGLAB recording.
+    """
+    found = []
+    for expert in experts:
+        group_dir = os.path.join(root_dir, 'raw', expert)
+        if not os.path.isdir(group_dir):
+            continue
+        for subject_id in sorted(os.listdir(group_dir)) if subject_ids is None else subject_ids:
+            for session in sessions:
+                if os.path.exists(eeglab_session_path(root_dir, expert, subject_id, session)):
+                    found.append((expert, subject_id, session))
+    return found
+
+
+def mark_all(root_dir, sessions, n_workers=None, blas_threads=1, force=False, **detector_kwargs):
+    """
+    Runs mark_bads_auto on many recordings on a process pool.
+
+    Args:
+        sessions: (expert, subject_id, session) tuples, e.g. from find_eeglab_sessions.
+        n_workers: Number of worker processes, each reading one recording at a time. Defaults to the number of CPUs.
+        blas_threads: Number of BLAS threads of each worker.
+        detector_kwargs: Keyword arguments of detect_bad_channels, e.g. correlation_threshold.
+
+    Returns:
+        (completed, failed) : lists of (expert, subject_id, session) tuples.
+    """
+    completed, failed = [], []
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(blas_threads,)) as pool:
+        futures = {pool.submit(mark_bads_auto, root_dir, expert, subject_id, session, force=force, **detector_kwargs): (expert, subject_id, session)
+                   for expert, subject_id, session in sessions}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                print("Marking bad channels failed for ", futures[future], ":")
+                traceback.print_exc()
+                failed.append(futures[future])
+                continue
+            completed.append(futures[future])
+    return completed, failed
+
+
+def mark_bads_interactive(root_dir, expert, subject_id, session):
+    """
+    Opens the recording with the automatically detected bad channels marked, for the user to finalize, and saves it.
+    """
     # Define data input and output path
-    in_path = os.path.join(root_dir, 'raw', expert, subject_id, f'{session}.set')
-    out_path = os.path.join(root_dir, 'raw', expert, subject_id, f'{session}_raw.fif')
+    in_path = eeglab_session_path(root_dir, expert, subject_id, session)
+    out_path = raw_session_path(root_dir, expert, subject_id, session)
 
     # Load the EEG data
     raw = mne.io.read_raw_eeglab(in_path, preload=True)
 
-    # Calculate the standard deviation of each channel
-    data = raw.get_data()
-    std_devs = np.std(data, axis=1)
-
-    # Calculate the median and a threshold for detecting bad channels
-    median_std = np.median(std_devs)
-    max_std = 50 
-    min_std = 0.00001
-
-    # Find channels with standard deviations significantly above the median
-    candidate_bads = [raw.ch_names[i] for i, std in enumerate(std_devs) if std > max_std * median_std or std < min_std]
-    print("Automatic candidate_bads: " + str(candidate_bads))
+    # Find candidate bad channels from windowed statistics of the recording
+    bads = detect_bad_channels(raw)
+    candidate_bads = list(bads)
+    print("Automatic candidate_bads: " + str(bads))
 
     # Set the candidates as the initial guess for bad channels
     raw.info['bads'] = candidate_bads
@@ -50,6 +288,47 @@ def main():
     # Save the raw object to the same filepath
     raw.save(out_path, overwrite=True)
 
+    # A manual selection replaces any automatic one, whose manifest would otherwise let mark_bads_auto overwrite it
+    if os.path.exists(manifest_path(out_path)):
+        os.remove(manifest_path(out_path))
+
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description="Mark bad channels in EEG data interactively, or automatically for many recordings with --auto")
+    parser.add_argument('expert', type=str, nargs="?", help='Expert identifier')
+    parser.add_argument('id', type=str, nargs="?", help='ID of the subject')
+    parser.add_argument('session', type=str, nargs="?", help='Session identifier')
+    parser.add_argument('--root_dir', type=str, default="/Volumes/eeg/", help='Root directory of the data')
+    parser.add_argument("--auto", help="Mark the detected bad channels of every recording without opening the plot", action="store_true")
+    parser.add_argument("--experts", help="Groups to mark (auto mode)", nargs="+", default=GROUPS, choices=GROUPS)
+    parser.add_argument("--ids", help="IDs of the participants (auto mode), defaults to every participant with a recording", nargs="+", default=None)
+    parser.add_argument("--sessions", help="Sessions to mark (auto mode)", nargs="+", default=list(SESSIONS), type=int)
+    parser.add_argument("--correlation_threshold", help="Median correlation with the neighbors below which a window is bad (auto mode)", default=CORRELATION_THRESHOLD, type=float)
+    parser.add_argument("--bad_window_fraction", help="Fraction of bad windows above which a channel is bad (auto mode)", default=BAD_WINDOW_FRACTION, type=float)
+    parser.add_argument("--n_workers", help="Number of worker processes (auto mode)", default=os.cpu_count(), type=int)
+    parser.add_argument("--blas_threads", help="Number of BLAS threads per worker, defaults to the CPUs divided between the workers (auto mode)", default=None, type=int)
+    parser.add_argument("--force", help="Remark recordings that are up to date or were marked interactively (auto mode)", action="store_true")
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    if not args.auto:
+        if args.session is None:
+            parser.error("expert, id and session are required without --auto")
+        mark_bads_interactive(args.root_dir, args.expert, args.id, args.session)
+        return
+
+    blas_threads = args.blas_threads or max(1, (os.cpu_count() or 1) // args.n_workers)
+    sessions = find_eeglab_sessions(args.root_dir, args.experts, args.ids, args.sessions)
+    print(f"Found {len(sessions)} EEGLAB recordings")
+
+    completed, failed = mark_all(args.root_dir, sessions, n_workers=args.n_workers, blas_threads=blas_threads, force=args.force,
+                                 correlation_threshold=args.correlation_threshold, bad_window_fraction=args.bad_window_fraction)
+    print(f"Marked or kept {len(completed)} recordings, {len(failed)} failed")
+    for session in failed:
+        print("Failed: ", session)
+
 if __name__ == '__main__':
     # Call main handling args
-    main()
\ No newline at end of file
+    main()
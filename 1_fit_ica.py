@@ -0,0 +1,147 @@
+import mne
+import argparse
+import glob
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from result_cache import is_current, write_manifest, manifest_path
+from pipeline_utils import SESSIONS, preprocessed_session_path, ica_path, limit_blas_threads
+
+# Seed of the ICA fit, fixed so that refitting a session gives the same components
+ICA_RANDOM_STATE = 42
+
+# Bump when the fit changes the components it finds, so that existing ICAs are refitted
+OUTPUT_VERSION = 1
+
+GROUPS = ["expert", "novice"]
+
+
+def _init_worker(blas_threads):
+    # Every worker fits one session at a time, so its BLAS threads are capped to share the CPUs between workers
+    limit_blas_threads(blas_threads)
+    mne.set_log_level("WARNING")
+
+
+def fit_ica(root_dir, expert, subject_id, session, num_ica_comps, force=False):
+    """
+    Fits ICA to a preprocessed recording and saves it to the ica directory.
+
+    The ICA is written under a temporary name and moved into place once complete, together with a manifest of the
+    preprocessed file and the ICA parameters. An interrupted fit therefore never leaves a partial file behind, and a
+    session whose ICA is current is skipped, so rerunning the stage resumes where it stopped.
+
+    Returns:
+        out_path : path of the fitted ICA.
+    """
+    in_path = preprocessed_session_path(root_dir, expert, subject_id, session)
+    out_path = ica_path(root_dir, expert, subject_id, session, num_ica_comps)
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+
+    params = {"num_ica_comps": num_ica_comps, "random_state": ICA_RANDOM_STATE}
+    if not force and is_current(out_path, [in_path], params, OUTPUT_VERSION):
+        print("ICA is up to date: ", out_path)
+        return out_path
+    if not force and not os.path.exists(manifest_path(out_path)) and os.path.exists(out_path) and os.path.getmtime(out_path) >= os.path.getmtime(in_path):
+        # Adopt ICAs fitted before manifests were written instead of refitting them
+        write_manifest(out_path, [in_path], params, OUTPUT_VERSION)
+        print("ICA is up to date: ", out_path)
+        return out_path
+
+    raw = mne.io.read_raw_fif(in_path, preload=True)
+
+    # Initialize ICA object
+    ica = mne.preprocessing.ICA(n_components=num_ica_comps, random_state=ICA_RANDOM_STATE)
+
+    # Fit the ICA to the data
+    ica.fit(raw)
+
+    # Save the ICA object. MNE expects ICA file names to end in _ica.fif, so the temporary name keeps that ending.
+    tmp_path = f"{out_path[:-len('_ica.fif')]}.{os.getpid()}.tmp_ica.fif"
+    ica.save(tmp_path, overwrite=True)
+    os.replace(tmp_path, out_path)
+    write_manifest(out_path, [in_path], params, OUTPUT_VERSION)
+    print("Saved ICA to: ", out_path)
+    return out_path
+
+
+def find_preprocessed_sessions(root_dir, experts=GROUPS, subject_ids=None, sessions=SESSIONS):
+    """
+    Finds every (expert, subject_id, session) with a preprocessed recording.
+    """
+    found = []
+    for expert in experts:
+        group_dir = os.path.join(root_dir, 'preprocessed', expert)
+        if not os.path.isdir(group_dir):
+            continue
+        for subject_id in sorted(os.listdir(group_dir)) if subject_ids is None else subject_ids:
+            for session in sessions:
+                if os.path.exists(preprocessed_session_path(root_dir, expert, subject_id, session)):
+                    found.append((expert, subject_id, session))
+    return found
+
+
+def _remove_partial_fits(root_dir, expert, subject_id, session, num_ica_comps):
+    # Delete temporary files left behind by workers that were killed while saving
+    out_path = ica_path(root_dir, expert, subject_id, session, num_ica_comps)
+    for tmp_path in glob.glob(f"{glob.escape(out_path[:-len('_ica.fif')])}.*.tmp_ica.fif"):
+        os.remove(tmp_path)
+
+
+def fit_all(root_dir, sessions, num_ica_comps, n_workers=None, blas_threads=1, force=False):
+    """
+    Fits ICA to many preprocessed sessions on a process pool.
+
+    Args:
+        sessions: (expert, subject_id, session) tuples, e.g. from find_preprocessed_sessions.
+        n_workers: Number of worker processes, each fitting one session at a time. Defaults to the number of CPUs.
+        blas_threads: Number of BLAS threads of each worker.
+        force: Refit sessions whose ICA is up to date.
+
+    Returns:
+        (completed, failed) : lists of (expert, subject_id, session) tuples.
+    """
+    for expert, subject_id, session in sessions:
+        _remove_partial_fits(root_dir, expert, subject_id, session, num_ica_comps)
+
+    completed, failed = [], []
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(blas_threads,)) as pool:
+        futures = {pool.submit(fit_ica, root_dir, expert, subject_id, session, num_ica_comps, force=force): (expert, subject_id, session)
+                   for expert, subject_id, session in sessions}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                print("Fitting ICA failed for ", futures[future], ":")
+                traceback.print_exc()
+                failed.append(futures[future])
+                continue
+            completed.append(futures[future])
+    return completed, failed
+
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description="Fit ICA to preprocessed EEG recordings on a process pool, skipping sessions whose ICA is up to date")
+    parser.add_argument('--root_dir', type=str, default="/Volumes/eeg", help='Root directory of the data')
+    parser.add_argument("--num_ica_comps", help="Number of ICA components", default=0.9999, type=float)
+    parser.add_argument("--experts", help="Groups to fit", nargs="+", default=GROUPS, choices=GROUPS)
+    parser.add_argument("--ids", help="IDs of the participants to fit, defaults to every preprocessed participant", nargs="+", default=None)
+    parser.add_argument("--sessions", help="Sessions to fit", nargs="+", default=list(SESSIONS), type=int)
+    parser.add_argument("--n_workers", help="Number of worker processes", default=os.cpu_count(), type=int)
+    parser.add_argument("--blas_threads", help="Number of BLAS threads per worker, defaults to the CPUs divided between the workers", default=None, type=int)
+    parser.add_argument("--force", help="Refit sessions whose ICA is up to date", action="store_true")
+
+    # Parse arguments
+    args = parser.parse_args()
+    blas_threads = args.blas_threads or max(1, (os.cpu_count() or 1) // args.n_workers)
+
+    sessions = find_preprocessed_sessions(args.root_dir, args.experts, args.ids, args.sessions)
+    print(f"Found {len(sessions)} preprocessed sessions")
+
+    completed, failed = fit_all(args.root_dir, sessions, args.num_ica_comps, n_workers=args.n_workers, blas_threads=blas_threads, force=args.force)
+    print(f"Fitted or reused {len(completed)} ICAs, {len(failed)} failed")
+    for session in failed:
+        print("Failed: ", session)
+
+if __name__ == '__main__':
+    main()
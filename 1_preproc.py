@@ -1,34 +1,23 @@
-import mne 
+import mne
 import numpy as np
 import argparse
 import os
+from pipeline_utils import NON_EEG_CHANNEL_TYPES, raw_session_path, preprocessed_session_path
 
 np.random.seed(42)
 
-def main():
-    # Set up argument parser
-    parser = argparse.ArgumentParser(description="Preprocess EEG data with MNE")
-    parser.add_argument('expert', type=str, help='Expert identifier')
-    parser.add_argument('id', type=str, help='ID of the participant')
-    parser.add_argument('session', type=str, help='Session number')
-    parser.add_argument('--root_dir', type=str, default="/Volumes/eeg", help='Root directory of the data')
-    parser.add_argument("--num_ica_comps", help="Number of ICA components", default=0.9999, type=float)
-
-    # Parse arguments
-    args = parser.parse_args()
-    root_dir = args.root_dir
-    expert = args.expert
-    subject_id = args.id
-    session = args.session
-    num_ica_comps = args.num_ica_comps
+def preprocess(root_dir, expert, subject_id, session):
+    """
+    Resamples, interpolates, rereferences and filters a single recording.
 
+    Returns:
+        raw : the preprocessed MNE Raw object, which is also saved to the preprocessed directory.
+    """
     # Define input and output paths
-    in_path = os.path.join(root_dir, 'raw', expert, subject_id, f'{session}_raw.fif')
-    out_path = os.path.join(root_dir, 'preprocessed', expert, subject_id, f'{session}_raw.fif')
+    in_path = raw_session_path(root_dir, expert, subject_id, session)
+    out_path = preprocessed_session_path(root_dir, expert, subject_id, session)
     bads_out_path = os.path.join(root_dir, 'preprocessed', expert, subject_id, f'{session}_bads.txt')
-    ica_path = os.path.join(root_dir, 'ica', expert, subject_id, f'{session}_{num_ica_comps}_ica.fif')
     os.makedirs(os.path.dirname(out_path), exist_ok=True)
-    os.makedirs(os.path.dirname(ica_path), exist_ok=True)
 
     # Load the raw data
     raw = mne.io.read_raw(f'{in_path}', preload=True)
@@ -37,16 +26,7 @@ def main():
     raw.resample(512)
 
     # Set the channel types for non-EEG channels
-    channel_types = {
-        'HEOGR': 'eog',
-        'HEOGL': 'eog',
-        'VEOGU': 'eog',
-        'VEOGL': 'eog',
-        'ECG': 'ecg',
-        'M1': 'misc',
-        'M2': 'misc',
-    }
-    raw.set_channel_types(channel_types)
+    raw.set_channel_types(NON_EEG_CHANNEL_TYPES)
 
     # Print what bad channels are being interpolated
     print(f'Interpolating bad channels: {raw.info["bads"]}')
@@ -68,14 +48,25 @@ def main():
     # Save the preprocessed data to a new file in MNE standard format
     raw.save(out_path, overwrite=True)
 
-    # Initialize ICA object
-    ica = mne.preprocessing.ICA(n_components=num_ica_comps, random_state=42)
+    return raw
 
-    # Fit the ICA to the data
-    ica.fit(raw)
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description="Preprocess EEG data with MNE")
+    parser.add_argument('expert', type=str, help='Expert identifier')
+    parser.add_argument('id', type=str, help='ID of the participant')
+    parser.add_argument('session', type=str, help='Session number')
+    parser.add_argument('--root_dir', type=str, default="/Volumes/eeg", help='Root directory of the data')
+
+    # Parse arguments
+    args = parser.parse_args()
+    root_dir = args.root_dir
+    expert = args.expert
+    subject_id = args.id
+    session = args.session
 
-    # Save the ICA object
-    ica.save(ica_path, overwrite=True)
+    # ICA is fitted separately by 1_fit_ica.py, so that a failed fit never loses the preprocessing
+    preprocess(root_dir, expert, subject_id, session)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
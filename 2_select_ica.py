@@ -2,28 +2,324 @@ import mne
 import numpy as np
 import argparse
 import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import matplotlib.pyplot as plt
 from matplotlib.widgets import Slider, Button
+from result_cache import is_current, write_manifest, manifest_path
+from working_copy import write_working_copy
+from pipeline_utils import SESSIONS, preprocessed_session_path, ica_path, processed_session_path, working_copy_path, limit_blas_threads
 
 np.random.seed(42)
 
-def main():
-    # Set up argument parser
-    parser = argparse.ArgumentParser(description="Select ICA components for removal interactively")
-    parser.add_argument('expert', type=str, help='Expert identifier')
-    parser.add_argument('id', type=str, help='ID of the participant')
-    parser.add_argument('session', type=str, help='Session number')
-    parser.add_argument('--root_dir', type=str, default="/Volumes/eeg", help='Root directory of the data')
-    parser.add_argument("--num_ica_comps", help="Number of ICA components", default=0.9999, type=float)
+# Z-score of the correlation between a component and the EOG or ECG channels above which it is removed automatically
+EOG_THRESHOLD = 3.0
+ECG_THRESHOLD = 3.0
 
-    # Parse arguments
-    args = parser.parse_args()
-    root_dir = args.root_dir
-    expert = args.expert
-    subject_id = args.id
-    session = args.session
-    num_ica_comps = args.num_ica_comps
+# Components scoring within this margin below a threshold make the selection ambiguous, as do selections of more than
+# MAX_AUTO_EXCLUDE components
+REVIEW_MARGIN = 0.5
+MAX_AUTO_EXCLUDE = 4
+
+# ICLabel classes removed automatically, and the probability below which a component of these classes is ambiguous
+ICLABEL_ARTIFACTS = ["eye blink", "heart beat"]
+ICLABEL_REVIEW_PROBABILITY = 0.5
+
+# Sessions whose automatic selection needs a manual review, one "<expert> <id> <session>" line each followed by a tab and the reasons
+REVIEW_QUEUE_FILE = "ica_review_queue.txt"
+
+# Bump when the automatic selection changes which components it removes, so that automatically cleaned sessions are
+# cleaned again
+OUTPUT_VERSION = 1
+
+GROUPS = ["expert", "novice"]
+
+
+def _init_worker(blas_threads):
+    # Every worker cleans one session at a time, so its BLAS threads are capped to share the CPUs between workers
+    limit_blas_threads(blas_threads)
+    mne.set_log_level("WARNING")
+
+
+def _ica_drops_path(root_dir, expert, subject_id, session, num_ica_comps):
+    return os.path.join(root_dir, 'processed', expert, subject_id, f'{session}_{num_ica_comps}_ica_drops.txt')
+
+
+def review_queue_path(root_dir):
+    return os.path.join(root_dir, 'processed', REVIEW_QUEUE_FILE)
+
+
+def _find_bads(find, raw, threshold, review_margin):
+    # Components above the threshold, and components scoring just below it, which are left for a reviewer to judge
+    bads, _ = find(raw, threshold=threshold)
+    near_bads, _ = find(raw, threshold=threshold - review_margin)
+    return [int(idx) for idx in bads], [int(idx) for idx in near_bads if idx not in bads]
+
+
+def auto_select_components(ica, raw, eog_threshold=EOG_THRESHOLD, ecg_threshold=ECG_THRESHOLD, review_margin=REVIEW_MARGIN,
+                           max_exclude=MAX_AUTO_EXCLUDE, iclabel_threshold=None):
+    """
+    Selects the ICA components to remove from a session without user interaction.
+
+    Components whose sources correlate with the EOG channels, or with the ECG channel if one was recorded, with a
+    z-score above the threshold are removed. With iclabel_threshold set, components that ICLabel classifies as eye
+    blink or heart beat with at least that probability are removed too (requires mne-icalabel).
+
+    The selection is flagged for review when a component scores within review_margin of a threshold (or between
+    ICLABEL_REVIEW_PROBABILITY and iclabel_threshold), when no eye component is found, or when more than max_exclude
+    components would be removed.
+
+    Returns:
+        (exclude, reasons) : sorted indices of the components to remove, and the reasons the selection needs a manual
+        review, empty if it is unambiguous.
+    """
+    exclude, reasons = set(), []
+
+    eog_bads, eog_near = _find_bads(ica.find_bads_eog, raw, eog_threshold, review_margin)
+    exclude.update(eog_bads)
+    if len(eog_bads) == 0:
+        reasons.append("no EOG component")
+    if len(eog_near) > 0:
+        reasons.append(f"EOG components {eog_near} near threshold")
+
+    if "ecg" in raw.get_channel_types(unique=True):
+        find_bads_ecg = lambda inst, threshold: ica.find_bads_ecg(inst, method="correlation", threshold=threshold)
+        ecg_bads, ecg_near = _find_bads(find_bads_ecg, raw, ecg_threshold, review_margin)
+        exclude.update(ecg_bads)
+        if len(ecg_near) > 0:
+            reasons.append(f"ECG components {ecg_near} near threshold")
+
+    if iclabel_threshold is not None:
+        try:
+            from mne_icalabel import label_components
+        except ImportError:
+            raise ImportError("ICLabel scores require the mne-icalabel package")
+        labels = label_components(raw, ica, method="iclabel")
+        for idx, (label, probability) in enumerate(zip(labels["labels"], labels["y_pred_proba"])):
+            if label not in ICLABEL_ARTIFACTS:
+                continue
+            if probability >= iclabel_threshold:
+                exclude.add(idx)
+            elif probability >= ICLABEL_REVIEW_PROBABILITY and idx not in exclude:
+                reasons.append(f"ICLabel {label} component {idx} at p={probability:.2f}")
+
+    if len(exclude) > max_exclude:
+        reasons.append(f"{len(exclude)} components selected")
+    return sorted(exclude), reasons
+
+
+def _remove_automatic_output(root_dir, expert, subject_id, session, num_ica_comps):
+    # Remove an automatically cleaned session, recognized by its manifest, with its _ica_drops.txt and working copy
+    out_path = processed_session_path(root_dir, expert, subject_id, session, num_ica_comps)
+    if not os.path.exists(manifest_path(out_path)):
+        return False
+    copy_path = working_copy_path(root_dir, expert, subject_id, session, num_ica_comps)
+    for path in [out_path, manifest_path(out_path), _ica_drops_path(root_dir, expert, subject_id, session, num_ica_comps), copy_path, manifest_path(copy_path)]:
+        if os.path.exists(path):
+            os.remove(path)
+    return True
+
+
+def select_ica_auto(root_dir, expert, subject_id, session, num_ica_comps, eog_threshold=EOG_THRESHOLD, ecg_threshold=ECG_THRESHOLD,
+                    review_margin=REVIEW_MARGIN, max_exclude=MAX_AUTO_EXCLUDE, iclabel_threshold=None, force=False):
+    """
+    Removes the automatically selected ICA components of a session (see auto_select_components) and saves the cleaned
+    session, its _ica_drops.txt and its working copy, unless the selection needs a manual review. A session queued for
+    review has its earlier automatic output removed, so that only reviewed data is used downstream.
+
+    The cleaned session is written atomically with a manifest of its inputs and thresholds, so current sessions are
+    skipped. Sessions saved by the interactive mode have no manifest and are never overwritten unless force is set.
+
+    Returns:
+        (out_path, reasons) : path of the cleaned session, or None if it was queued for review, and the reasons for the
+        review.
+    """
+    in_path = preprocessed_session_path(root_dir, expert, subject_id, session)
+    ica_in_path = ica_path(root_dir, expert, subject_id, session, num_ica_comps)
+    out_path = processed_session_path(root_dir, expert, subject_id, session, num_ica_comps)
+
+    params = {"mode": "auto", "eog_threshold": eog_threshold, "ecg_threshold": ecg_threshold, "review_margin": review_margin,
+              "max_exclude": max_exclude, "iclabel_threshold": iclabel_threshold}
+    if not force and os.path.exists(out_path) and not os.path.exists(manifest_path(out_path)):
+        print("Keeping manually selected components: ", out_path)
+        return out_path, []
+    if not force and is_current(out_path, [in_path, ica_in_path], params, OUTPUT_VERSION):
+        print("Processed data is up to date: ", out_path)
+        return out_path, []
+
+    raw = mne.io.read_raw_fif(in_path, preload=True)
+    ica = mne.preprocessing.read_ica(ica_in_path)
+    exclude, reasons = auto_select_components(ica, raw, eog_threshold=eog_threshold, ecg_threshold=ecg_threshold, review_margin=review_margin,
+                                              max_exclude=max_exclude, iclabel_threshold=iclabel_threshold)
+    if len(reasons) > 0:
+        print(f"Queueing {expert} {subject_id} {session} for review: {'; '.join(reasons)}")
+        if _remove_automatic_output(root_dir, expert, subject_id, session, num_ica_comps):
+            print("Removed the outdated automatic selection: ", out_path)
+        return None, reasons
+
+    # Clean the loaded recording in place, as it is not needed afterwards
+    ica.exclude = exclude
+    ica.apply(raw)
+
+    # MNE expects raw file names to end in _raw.fif, so the temporary name keeps that ending
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    tmp_path = f"{out_path[:-len('_raw.fif')]}.{os.getpid()}.tmp_raw.fif"
+    raw.save(tmp_path, overwrite=True)
+    os.replace(tmp_path, out_path)
+    with open(_ica_drops_path(root_dir, expert, subject_id, session, num_ica_comps), 'w') as f:
+        f.write("ICA Components Dropped: " + str(exclude))
+    write_manifest(out_path, [in_path, ica_in_path], params, OUTPUT_VERSION)
+    print(f"Dropped components {exclude}, saved processed data to: ", out_path)
+
+    write_working_copy(root_dir, expert, subject_id, session, num_ica_comps)
+    return out_path, []
 
+
+def find_fitted_sessions(root_dir, num_ica_comps, experts=GROUPS, subject_ids=None, sessions=SESSIONS):
+    """
+    Finds every (expert, subject_id, session) with a preprocessed recording and a fitted ICA.
+    """
+    found = []
+    for expert in experts:
+        group_dir = os.path.join(root_dir, 'ica', expert)
+        if not os.path.isdir(group_dir):
+            continue
+        for subject_id in sorted(os.listdir(group_dir)) if subject_ids is None else subject_ids:
+            for session in sessions:
+                if os.path.exists(ica_path(root_dir, expert, subject_id, session, num_ica_comps)) and \
+                        os.path.exists(preprocessed_session_path(root_dir, expert, subject_id, session)):
+                    found.append((expert, subject_id, session))
+    return found
+
+
+def read_review_queue(root_dir):
+    """
+    Reads the review queue as a dict mapping (expert, subject_id, session) to the reasons for the review.
+    """
+    queue = {}
+    if not os.path.exists(review_queue_path(root_dir)):
+        return queue
+    with open(review_queue_path(root_dir)) as f:
+        for line in f:
+            if line.strip():
+                session_key, _, reasons = line.rstrip("\n").partition("\t")
+                expert, subject_id, session = session_key.split()
+                queue[(expert, subject_id, int(session))] = reasons
+    return queue
+
+
+def update_review_queue(root_dir, num_ica_comps, selected, queued):
+    """
+    Rewrites the review queue with the sessions queued by an automatic run, dropping the sessions it cleaned and the
+    sessions that have since been reviewed interactively.
+
+    Args:
+        selected: (expert, subject_id, session) tuples that were cleaned automatically.
+        queued: dict mapping (expert, subject_id, session) to the list of reasons for their review.
+    """
+    queue = read_review_queue(root_dir)
+    for key in selected:
+        queue.pop(key, None)
+    for expert, subject_id, session in list(queue):
+        out_path = processed_session_path(root_dir, expert, subject_id, session, num_ica_comps)
+        if os.path.exists(out_path) and not os.path.exists(manifest_path(out_path)):
+            del queue[(expert, subject_id, session)]
+    queue.update({key: "; ".join(reasons) for key, reasons in queued.items()})
+
+    os.makedirs(os.path.dirname(review_queue_path(root_dir)), exist_ok=True)
+    with open(review_queue_path(root_dir), 'w') as f:
+        for (expert, subject_id, session), reasons in sorted(queue.items()):
+            f.write(f"{expert} {subject_id} {session}\t{reasons}\n")
+    return queue
+
+
+def select_all(root_dir, sessions, num_ica_comps, n_workers=None, blas_threads=1, force=False, **thresholds):
+    """
+    Runs select_ica_auto on many sessions on a process pool and updates the review queue.
+
+    Args:
+        sessions: (expert, subject_id, session) tuples, e.g. from find_fitted_sessions.
+        n_workers: Number of worker processes, each cleaning one session at a time. Defaults to the number of CPUs.
+        blas_threads: Number of BLAS threads of each worker.
+        thresholds: Keyword arguments of select_ica_auto, e.g. eog_threshold.
+
+    Returns:
+        (selected, queued, failed) : lists of (expert, subject_id, session) tuples that were cleaned or are up to date,
+        that were queued for review, and that failed.
+    """
+    selected, queued, failed = [], {}, []
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(blas_threads,)) as pool:
+        futures = {pool.submit(select_ica_auto, root_dir, expert, subject_id, session, num_ica_comps, force=force, **thresholds): (expert, subject_id, session)
+                   for expert, subject_id, session in sessions}
+        for future in as_completed(futures):
+            try:
+                out_path, reasons = future.result()
+            except Exception:
+                print("Selecting ICA components failed for ", futures[future], ":")
+                traceback.print_exc()
+                failed.append(futures[future])
+                continue
+            if out_path is None:
+                queued[futures[future]] = reasons
+            else:
+                selected.append(futures[future])
+
+    update_review_queue(root_dir, num_ica_comps, selected, queued)
+    return selected, sorted(queued), failed
+
+
+class ReviewSignals:
+    """
+    Channels of a recording together with the ICA sources, computed once, from which the channels cleaned of any set
+    of components are reconstructed for a window of samples without applying the ICA to the whole recording.
+
+    Removing components leaves the data minus the contribution of each removed component, its source time course
+    times its pattern scaled back by the pre-whitener. This matches ica.apply as long as all PCA components are kept,
+    which is the default. Channels that the ICA was not fitted on, e.g. the EOG channels, are left unchanged.
+    """
+    def __init__(self, raw, ica, ch_names):
+        self.ch_names = list(ch_names)
+        self.times = raw.times
+        self.data = raw.get_data(picks=self.ch_names)
+
+        # Sources are kept as float32, which is ample for display and halves their size on long recordings
+        self.sources = ica.get_sources(raw).get_data().astype(np.float32)
+
+        # Pattern of every component on the plotted channels, in the units of the data
+        patterns = ica.get_components() * ica.pre_whitener_
+        self.patterns = np.zeros((len(self.ch_names), ica.n_components_))
+        for idx, ch_name in enumerate(self.ch_names):
+            if ch_name in ica.ch_names:
+                self.patterns[idx] = patterns[ica.ch_names.index(ch_name)]
+
+    def window(self, start, stop, exclude):
+        """
+        Returns the (original, cleaned) channels from sample start to stop with the components in exclude removed.
+        """
+        data = self.data[:, start:stop]
+        exclude = list(exclude)
+        if len(exclude) == 0:
+            return data, data
+        return data, data - self.patterns[:, exclude] @ self.sources[exclude, start:stop]
+
+
+def _browser_exclude(sources_obj, ica):
+    # Components currently marked in the sources browser, which only writes them to ica.exclude once it is closed
+    try:
+        return sorted(int(name[len("ICA"):]) for name in sources_obj.mne.info["bads"])
+    except (AttributeError, KeyError, TypeError):
+        # Browsers without a channel info, e.g. other backends or a closed figure, fall back to the ICA itself
+        return list(ica.exclude)
+
+
+def select_interactive(root_dir, expert, subject_id, session, num_ica_comps):
+    """
+    Opens the interactive selection of the ICA components to remove from one session, starting from the components
+    that correlate with the EOG channels, and saves the cleaned session.
+
+    The original and cleaned channels of the visible window follow the components marked in the sources browser, and
+    only that window is reconstructed when scrolling or marking components (see ReviewSignals).
+    """
     # Define input and output paths
     in_path = os.path.join(root_dir, 'preprocessed', expert, subject_id, f'{session}_raw.fif')
     ica_in_path = os.path.join(root_dir, 'ica', expert, subject_id, f'{session}_{num_ica_comps}_ica.fif')
@@ -48,38 +344,43 @@ def main():
     start_time = 0
     window_size = 10
 
-    # Apply the ICA to the raw data
-    raw_cleaned = raw.copy()
-    ica.apply(raw_cleaned)
-    data, times = raw[:]
-    data_cleaned, _ = raw_cleaned[:]
-
     # Define the channels you want to plot
     channels_to_plot = ['Fpz', 'Fz', "AF3", "AF4", 'Cz', "POz", "HEOGR", "HEOGL", "VEOGU", "VEOGL"]  
     print(raw.ch_names)
 
-    # Initial plot setup
+    # Compute the sources once, instead of applying the ICA to a copy of the recording on every reload
+    signals = ReviewSignals(raw, ica, channels_to_plot)
+    times = signals.times
+    exclude = list(ica.exclude)
+
+    # Initial plot setup, with one original and one cleaned line per channel that are updated in place
     fig, ax = plt.subplots(len(channels_to_plot), 1, figsize=(10, 7))
     plt.subplots_adjust(bottom=0.25)
+    original_lines, cleaned_lines = [], []
+    for idx, channel_name in enumerate(channels_to_plot):
+        original_lines.append(ax[idx].plot([], [], color='black', label='Original')[0])
+        cleaned_lines.append(ax[idx].plot([], [], color='red', linestyle='--', label='Cleaned')[0])
+        ax[idx].set_ylabel(channel_name)
+        ax[idx].set_xticks([])
+        ax[idx].set_yticks([])
+    ax[-1].set_xlabel('Time (s)')
+    ax[0].legend()
+    plt.suptitle(f'{expert} {subject_id} {session}')
 
     def update_plot(val):
         start_time = slider.val
         start, stop = raw.time_as_index([start_time, start_time + window_size])
+        data, data_cleaned = signals.window(start, stop, exclude)
 
-        for idx, channel_name in enumerate(channels_to_plot):
-            ax[idx].clear()
-            channel = raw.ch_names.index(channel_name)
-            ax[idx].plot(times[start:stop], data[channel, start:stop], color='black', label='Original')
-            ax[idx].plot(times[start:stop], data_cleaned[channel, start:stop], color='red', linestyle='--', label='Cleaned')
-
-            ax[idx].set_ylabel(channel_name)
-            ax[idx].set_xticks([])
-            ax[idx].set_yticks([])
-        
-        ax[-1].set_xlabel('Time (s)')
-        ax[0].legend()
-        plt.suptitle(f'{expert} {subject_id} {session}')
-        plt.draw()
+        for idx in range(len(channels_to_plot)):
+            original_lines[idx].set_data(times[start:stop], data[idx])
+            cleaned_lines[idx].set_data(times[start:stop], data_cleaned[idx])
+            ax[idx].set_xlim(times[start], times[stop - 1])
+            low = min(data[idx].min(), data_cleaned[idx].min())
+            high = max(data[idx].max(), data_cleaned[idx].max())
+            margin = 0.05 * (high - low) or 1e-6
+            ax[idx].set_ylim(low - margin, high + margin)
+        fig.canvas.draw_idle()
 
     # Create a slider for time navigation
     ax_slider = plt.axes([0.2, 0.1, 0.65, 0.03], facecolor='lightgoldenrodyellow')
@@ -89,16 +390,17 @@ def main():
     # Initial plot
     update_plot(start_time)
 
-    # Add a button that triggers a reload of data
-    def on_reload(event):
-        nonlocal raw, ica, raw_cleaned, data, times, data_cleaned, sources_obj
-        sources_obj.close()
-        raw_cleaned = raw.copy()
-        ica.apply(raw_cleaned)
-        data, times = raw[:]
-        data_cleaned, _ = raw_cleaned[:]
-        sources_obj = ica.plot_sources(raw, show_scrollbars=False)
-        update_plot(slider.val)
+    # Follow the components marked in the sources browser
+    def on_reload(event=None):
+        nonlocal exclude
+        marked = _browser_exclude(sources_obj, ica)
+        if marked != exclude:
+            exclude = marked
+            update_plot(slider.val)
+
+    timer = fig.canvas.new_timer(interval=200)
+    timer.add_callback(on_reload)
+    timer.start()
 
     ax_reload = plt.axes([0.4, 0.025, 0.1, 0.04])
     button_reload = Button(ax_reload, 'Reload')
@@ -106,6 +408,7 @@ def main():
 
     # Add a quit button
     def quit(event):
+        timer.stop()
         plt.close()
         sources_obj.close()
 
@@ -121,15 +424,69 @@ def main():
     print(f'Proposing dropping the following: {ica.exclude}')
     plt.show()
 
-    ica.apply(raw_cleaned)
+    # Apply the final selection once, in place, as the original recording is no longer needed
+    del signals
+    ica.apply(raw)
 
     # Save the data
-    raw_cleaned.save(out_path, overwrite=True)
+    raw.save(out_path, overwrite=True)
+
+    # A manual selection replaces any automatic one, whose manifest would otherwise let select_ica_auto overwrite it
+    if os.path.exists(manifest_path(out_path)):
+        os.remove(manifest_path(out_path))
 
     # Write dropped ica components
     print(f'Dropping the following channels: {ica.exclude}')
     with open(ica_drops_out_path, 'w') as f:
         f.write("ICA Components Dropped: " + str(ica.exclude))
 
+    # Write the decimated working copy read by the connectivity scripts with --working_copies
+    write_working_copy(root_dir, expert, subject_id, session, num_ica_comps)
+
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description="Select ICA components for removal interactively, or automatically for many sessions with --auto")
+    parser.add_argument('expert', type=str, nargs="?", help='Expert identifier')
+    parser.add_argument('id', type=str, nargs="?", help='ID of the participant')
+    parser.add_argument('session', type=str, nargs="?", help='Session number')
+    parser.add_argument('--root_dir', type=str, default="/Volumes/eeg", help='Root directory of the data')
+    parser.add_argument("--num_ica_comps", help="Number of ICA components", default=0.9999, type=float)
+    parser.add_argument("--auto", help="Select components of every fitted session without interaction and queue ambiguous sessions for review", action="store_true")
+    parser.add_argument("--experts", help="Groups to select components for (auto mode)", nargs="+", default=GROUPS, choices=GROUPS)
+    parser.add_argument("--ids", help="IDs of the participants (auto mode), defaults to every participant with a fitted ICA", nargs="+", default=None)
+    parser.add_argument("--sessions", help="Sessions to select components for (auto mode)", nargs="+", default=list(SESSIONS), type=int)
+    parser.add_argument("--eog_threshold", help="Z-score threshold of the EOG correlation (auto mode)", default=EOG_THRESHOLD, type=float)
+    parser.add_argument("--ecg_threshold", help="Z-score threshold of the ECG correlation (auto mode)", default=ECG_THRESHOLD, type=float)
+    parser.add_argument("--review_margin", help="Queue sessions with components this close below a threshold for review (auto mode)", default=REVIEW_MARGIN, type=float)
+    parser.add_argument("--max_exclude", help="Queue sessions with more components selected for review (auto mode)", default=MAX_AUTO_EXCLUDE, type=int)
+    parser.add_argument("--iclabel_threshold", help="Also remove components ICLabel classifies as eye blink or heart beat with this probability, requires mne-icalabel (auto mode)",
+                        default=None, type=float)
+    parser.add_argument("--n_workers", help="Number of worker processes (auto mode)", default=os.cpu_count(), type=int)
+    parser.add_argument("--blas_threads", help="Number of BLAS threads per worker, defaults to the CPUs divided between the workers (auto mode)", default=None, type=int)
+    parser.add_argument("--force", help="Reselect sessions that are up to date or were selected interactively (auto mode)", action="store_true")
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    if not args.auto:
+        if args.session is None:
+            parser.error("expert, id and session are required without --auto")
+        select_interactive(args.root_dir, args.expert, args.id, args.session, args.num_ica_comps)
+        return
+
+    blas_threads = args.blas_threads or max(1, (os.cpu_count() or 1) // args.n_workers)
+    sessions = find_fitted_sessions(args.root_dir, args.num_ica_comps, args.experts, args.ids, args.sessions)
+    print(f"Found {len(sessions)} sessions with a fitted ICA")
+
+    selected, queued, failed = select_all(args.root_dir, sessions, args.num_ica_comps, n_workers=args.n_workers, blas_threads=blas_threads, force=args.force,
+                                          eog_threshold=args.eog_threshold, ecg_threshold=args.ecg_threshold, review_margin=args.review_margin,
+                                          max_exclude=args.max_exclude, iclabel_threshold=args.iclabel_threshold)
+    print(f"Cleaned or kept {len(selected)} sessions, queued {len(queued)} for review, {len(failed)} failed")
+    for expert, subject_id, session in queued:
+        print(f"Review with: python 2_select_ica.py {expert} {subject_id} {session}")
+    for session in failed:
+        print("Failed: ", session)
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -2,13 +2,19 @@ import mne
 import os
 import numpy as np
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from result_cache import is_current, write_manifest
+from instrumentation import stage, tracing
+from filter_cache import BandFilterCache, DEFAULT_MAX_BYTES
+from working_copy import load_working_session, working_copy_dir_suffix, working_copy_sfreq
+from pipeline_utils import FREQUENCY_BANDS, ELECTRODE_SETS, SESSIONS, CONDITIONS, condition_prefix, processed_session_path, connectivity_output_path, metric_dir_suffix, existing_processed_session_paths, existing_working_copy_paths, working_copy_path, load_processed_session, find_condition_windows, window_epochs, iter_band_filtered, trace_path, resolve_electrodes, parse_electrodes, save_connectivity_electrodes
 
 np.random.seed(42)
 import numpy as np
 
 import numpy as np
 from scipy.signal import hilbert
-from itertools import combinations
 
 def phase_synchrony_via_normalized_entropy(epochs):
     """
@@ -21,68 +27,428 @@ def phase_synchrony_via_normalized_entropy(epochs):
         synchrony_matrices : ndarray, shape (n_epochs, n_channels, n_channels)
         Array of synchronization indices for each epoch.
     """
+    # Extract data from epochs with shape (n_epochs, n_channels, n_times)
+    data = epochs.get_data(copy=False) 
+
+    return normalized_entropy_from_data(data)
+
+# Number of (pair, sample) phase differences processed per block. Blocks of this size keep the phase difference and
+# bin index temporaries resident in cache, which measured faster than batching every epoch into one huge array.
+BLOCK_PAIR_SAMPLES = 2 ** 18
+
+# Bump when the values a metric produces change, e.g. a fix of the epoching or of a metric, so that saved results are
+# recomputed
+OUTPUT_VERSION = 1
+
+def entropy_block_size(n_channels, n_times):
+    # Number of epochs per vectorized pass so that a block holds about BLOCK_PAIR_SAMPLES phase differences
+    n_pairs = n_channels * (n_channels - 1) // 2
+    return max(1, BLOCK_PAIR_SAMPLES // max(1, n_pairs * n_times))
+
+class AnalyticBlock:
+    """
+    Analytic signal of a block of epochs, computed once and shared by every metric evaluated on the block.
+
+    Args:
+        data: ndarray, shape (n_epochs, n_channels, n_times) containing the EEG data.
+    """
+    def __init__(self, data):
+        self.n_epochs, self.n_channels, self.n_times = data.shape
+
+        # Generate all unique pairs of channels (same order as itertools.combinations)
+        self.pair_k, self.pair_m = np.triu_indices(self.n_channels, k=1)
+
+        # Compute the analytic signal for every epoch and channel in a single call and extract the instantaneous phase
+        with stage("hilbert"):
+            self.analytic_signal = hilbert(data, axis=-1)
+            self.phase = np.angle(self.analytic_signal)  # Shape: (n_epochs, n_channels, n_times)
+        self._phase_difference = None
+
+    @property
+    def phase_difference(self):
+        # Phase difference for all pairs of electrodes in all epochs, shape (n_epochs, n_pairs, n_times)
+        if self._phase_difference is None:
+            with stage("phase_difference"):
+                phdiff = self.phase[:, self.pair_k, :] - self.phase[:, self.pair_m, :]
+
+                # Wrap phase differences to the range [-pi, pi] (MATLAB does this automatically)
+                self._phase_difference = np.angle(np.exp(1j * phdiff))
+        return self._phase_difference
+
+    def cross_spectrum(self):
+        # Instantaneous cross spectrum of every pair, shape (n_epochs, n_pairs, n_times)
+        return self.analytic_signal[:, self.pair_k, :] * np.conj(self.analytic_signal[:, self.pair_m, :])
+
+def _normalized_entropy(block):
     # Define the number of bins in the phase difference distribution
     BINS = 50  
 
-    # Extract data from epochs with shape (n_epochs, n_channels, n_times)
-    data = epochs.get_data(copy=False) 
+    n_epochs, n_pairs = block.n_epochs, len(block.pair_k)
+    phdiff = block.phase_difference
+
+    # Bin the phase differences into B bins over the range [−pi, pi]. The bin is computed arithmetically and then
+    # corrected against the edges, which matches np.digitize exactly but avoids a binary search per sample.
+    # A difference of exactly pi falls into the last bin.
+    bin_edges = np.linspace(-np.pi, np.pi, BINS + 1)
+    bin_indices = ((phdiff + np.pi) * (BINS / (2 * np.pi))).astype(np.intp)
+    np.clip(bin_indices, 0, BINS - 1, out=bin_indices)
+    bin_indices -= phdiff < bin_edges[bin_indices]
+    bin_indices += phdiff >= bin_edges[bin_indices + 1]
+    np.clip(bin_indices, 0, BINS - 1, out=bin_indices)
+
+    # Offset every (epoch, bin, pair) triple into its own slot so that one bincount builds all histograms at once
+    bin_indices *= n_pairs
+    bin_indices += (np.arange(n_epochs) * BINS * n_pairs)[:, None, None] + np.arange(n_pairs)[None, :, None]
+    counts = np.bincount(bin_indices.ravel(), minlength=n_epochs * BINS * n_pairs)
+    counts = counts.reshape(n_epochs, BINS, n_pairs).astype(float)
+
+    # Normalize histograms to get probability distributions
+    d = counts / (np.sum(counts, axis=1, keepdims=True) + np.finfo(float).eps)
+
+    # Compute the entropy
+    logd = np.log(d + np.finfo(float).eps)
+    return np.sum(d * logd, axis=1) / np.log(BINS)  # Shape: (n_epochs, n_pairs)
+
+def _phase_locking_value(block):
+    # Length of the mean phase difference vector
+    return np.abs(np.mean(np.exp(1j * block.phase_difference), axis=-1))
+
+def _phase_lag_index(block):
+    # Asymmetry of the phase difference distribution around zero
+    return np.abs(np.mean(np.sign(np.sin(block.phase_difference)), axis=-1))
+
+def _weighted_phase_lag_index(block):
+    # Phase lag index with every sample weighted by the magnitude of the imaginary cross spectrum
+    imag = block.cross_spectrum().imag
+    return np.abs(np.mean(imag, axis=-1)) / (np.mean(np.abs(imag), axis=-1) + np.finfo(float).eps)
+
+def _circular_correlation(block):
+    # Circular correlation coefficient of the two phase time series around their circular means
+    mean_phase = np.angle(np.mean(np.exp(1j * block.phase), axis=-1, keepdims=True))
+    sin_centered = np.sin(block.phase - mean_phase)
+    sin_k, sin_m = sin_centered[:, block.pair_k, :], sin_centered[:, block.pair_m, :]
+    numerator = np.sum(sin_k * sin_m, axis=-1)
+    denominator = np.sqrt(np.sum(sin_k ** 2, axis=-1) * np.sum(sin_m ** 2, axis=-1))
+    return numerator / (denominator + np.finfo(float).eps)
+
+def _coherency(block):
+    # Magnitude of the normalized time domain coherency, i.e. the phase locking value with every sample weighted by the
+    # product of the amplitudes (the unweighted mean phase coherence is the phase locking value)
+    amplitude_sq = np.abs(block.analytic_signal) ** 2
+    numerator = np.abs(np.sum(block.cross_spectrum(), axis=-1))
+    denominator = np.sqrt(np.sum(amplitude_sq[:, block.pair_k, :], axis=-1) * np.sum(amplitude_sq[:, block.pair_m, :], axis=-1))
+    return numerator / (denominator + np.finfo(float).eps)
+
+# Phase synchrony metrics computed from a shared AnalyticBlock. Each maps a block to values of shape (n_epochs, n_pairs).
+METRICS = {
+    "entropy": _normalized_entropy,
+    "plv": _phase_locking_value,
+    "pli": _phase_lag_index,
+    "wpli": _weighted_phase_lag_index,
+    "circular_correlation": _circular_correlation,
+    "coherency": _coherency,
+}
+
+def phase_synchrony_from_data(data, metrics=("entropy",), epochs_per_block=None):
+    """
+    Computes several phase synchrony metrics from one Hilbert transform per block of epochs.
+
+    Args:
+        data: ndarray, shape (n_epochs, n_channels, n_times) containing the EEG data.
+        metrics: Names of metrics in METRICS to compute.
+        epochs_per_block: Number of epochs handled by each vectorized pass. Defaults to a cache-sized block.
+
+    Returns:
+        synchrony_matrices : dict mapping each metric to an ndarray of shape (n_epochs, n_channels, n_channels) with
+        zeros on the diagonal.
+    """
+    unknown = [metric for metric in metrics if metric not in METRICS]
+    if unknown:
+        raise ValueError(f"Unknown metrics {unknown}, expected any of {list(METRICS)}")
+
     n_epochs, n_channels, n_times = data.shape
 
-    # Initialize the synchrony matrix for all epochs
-    synchrony_matrices = np.zeros((n_epochs, n_channels, n_channels))
+    if epochs_per_block is None:
+        epochs_per_block = entropy_block_size(n_channels, n_times)
+
+    # Initialize the synchrony matrices for all epochs
+    synchrony_matrices = {metric: np.zeros((n_epochs, n_channels, n_channels)) for metric in metrics}
+
+    for block_start in range(0, n_epochs, epochs_per_block):
+        block = AnalyticBlock(data[block_start:block_start + epochs_per_block])
+        for metric in metrics:
+            with stage("metric", metric=metric):
+                values = METRICS[metric](block)
+
+            # Fill the symmetric synchrony matrices with the computed values using triangular indexing
+            s = synchrony_matrices[metric][block_start:block_start + block.n_epochs]
+            s[:, block.pair_k, block.pair_m] = values
+            s[:, block.pair_m, block.pair_k] = values
+
+    return synchrony_matrices
+
+def normalized_entropy_from_data(data, epochs_per_block=None):
+    """
+    Batched engine behind phase_synchrony_via_normalized_entropy, operating on blocks of epochs at once.
+
+    Args:
+        data: ndarray, shape (n_epochs, n_channels, n_times) containing the EEG data.
+        epochs_per_block: Number of epochs handled by each vectorized pass. Defaults to a cache-sized block.
+    
+    Returns:
+        synchrony_matrices : ndarray, shape (n_epochs, n_channels, n_channels)
+        Array of synchronization indices for each epoch.
+    """
+    return phase_synchrony_from_data(data, ("entropy",), epochs_per_block)["entropy"]
+
+def _shared_synchrony_chunk(shm_name, shape, dtype, start, stop, metrics):
+    # Worker side of phase_synchrony_parallel: attach to the shared input buffer and process one chunk of epochs
+    shm = SharedMemory(name=shm_name)
+    try:
+        data = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        return phase_synchrony_from_data(data[start:stop], metrics)
+    finally:
+        shm.close()
+
+def phase_synchrony_parallel(datasets, metrics=("entropy",), n_jobs=1):
+    """
+    Runs phase_synchrony_from_data on several arrays (e.g. one per frequency band) using a pool of processes.
 
-    # Generate all unique pairs of channels
-    pairs = np.array(list(combinations(range(n_channels), 2)))  # Shape: (n_pairs, 2)
-    n_pairs = pairs.shape[0]
+    Each array is copied once into a shared memory buffer and split into chunks of epochs, so workers read their input
+    in place instead of receiving it pickled. Chunks are aligned to the engine's block size, so every block is computed
+    exactly as in the serial path and the result is bit-identical.
 
-    # Loop over epochs
-    for epoch_idx in range(n_epochs):
-        epoch_data = data[epoch_idx, :, :]  # Shape: (n_channels, n_times)
+    Args:
+        datasets: List of ndarrays, each of shape (n_epochs, n_channels, n_times).
+        metrics: Names of metrics in METRICS to compute.
+        n_jobs: Number of worker processes. 1 runs serially in this process, -1 uses every CPU.
 
-        # Initialize the synchronization indices matrix for this epoch
-        s = np.zeros((n_channels, n_channels))
+    Returns:
+        synchrony_matrices : list with one dict per input array, mapping each metric to an ndarray of shape
+        (n_epochs, n_channels, n_channels).
+    """
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    if n_jobs == 1:
+        return [phase_synchrony_from_data(data, metrics) for data in datasets]
+
+    # Split the epochs of every array into about n_jobs chunks in total, each a whole number of blocks
+    total_epochs = sum(len(data) for data in datasets)
+    shared = []
+    try:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            futures = []
+            for data in datasets:
+                n_epochs, n_channels, n_times = data.shape
+                block_size = entropy_block_size(n_channels, n_times)
+                chunk_size = -(-max(1, -(-total_epochs // n_jobs)) // block_size) * block_size
+
+                shm = SharedMemory(create=True, size=max(1, data.nbytes))
+                shared.append(shm)
+                np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)[:] = data
+                futures.append([pool.submit(_shared_synchrony_chunk, shm.name, data.shape, data.dtype, start, start + chunk_size, metrics)
+                                for start in range(0, n_epochs, chunk_size)])
+
+            results = []
+            for chunk_futures, data in zip(futures, datasets):
+                chunks = [future.result() for future in chunk_futures]
+                results.append({metric: np.concatenate([chunk[metric] for chunk in chunks]) if chunks else np.zeros((0, data.shape[1], data.shape[1]))
+                                for metric in metrics})
+            return results
+    finally:
+        for shm in shared:
+            shm.close()
+            shm.unlink()
+
+def compute_connectivity(root_dir, expert, subject_id, num_ica_comps=0.9999, dir_suffix="", baseline=False, with_gestures=False, epoch_duration=5.0, epoch_overlap=2.5, force=False, n_jobs=1, metrics=("entropy",), trace_dir=None, profile=False,
+                         filter_cache_dir=None, filter_cache_max_bytes=DEFAULT_MAX_BYTES, electrodes="interest", working_copies=False):
+    """
+    Computes phase synchrony connectivity for one participant and condition and saves one numpy array per metric.
 
-        # Transpose to flip shape
-        epoch_data_T = epoch_data.T  # Shape: (n_times, n_channels)
+    A result is skipped if its manifest shows it was computed from the same processed files and parameters, unless
+    force is set.
 
-        # Compute the analytic signal using the Hilbert transform
-        analytic_signal = hilbert(epoch_data_T, axis=0)
+    Returns:
+        out_paths : dict mapping each metric to the path of its saved array, or None if no epochs were found.
+    """
+    out_paths = compute_conditions(root_dir, expert, subject_id, [(baseline, with_gestures)], num_ica_comps=num_ica_comps, dir_suffix=dir_suffix,
+                                   epoch_duration=epoch_duration, epoch_overlap=epoch_overlap, force=force, n_jobs=n_jobs, metrics=metrics,
+                                   trace_dir=trace_dir, profile=profile, filter_cache_dir=filter_cache_dir,
+                                   filter_cache_max_bytes=filter_cache_max_bytes, electrodes=electrodes, working_copies=working_copies)
+    return {metric: metric_paths[(baseline, with_gestures)] for metric, metric_paths in out_paths.items()}
+
+def compute_conditions(root_dir, expert, subject_id, conditions=CONDITIONS, num_ica_comps=0.9999, dir_suffix="", epoch_duration=5.0, epoch_overlap=2.5, force=False, n_jobs=1, metrics=("entropy",), trace_dir=None, profile=False,
+                       filter_cache_dir=None, filter_cache_max_bytes=DEFAULT_MAX_BYTES, electrodes="interest", working_copies=False):
+    """
+    Computes phase synchrony connectivity for several conditions and metrics of one participant in a single pass.
 
-        # Extract the instantaneous phase
-        ph = np.angle(analytic_signal)  # Shape: (n_times, n_channels)
+    Each session is loaded and filtered once, its annotation windows are partitioned into all requested conditions, and
+    the connectivity engine runs once per band over the combined epochs before being split into one array per condition.
+    All metrics share one Hilbert transform per block of epochs, and each metric is saved under its own directory (see
+    metric_dir_suffix).
 
-        # Compute the phase difference for all pairs of electrodes
-        ph1 = ph[:, pairs[:, 0]]  # Shape: (n_times, n_pairs)
-        ph2 = ph[:, pairs[:, 1]]  # Shape: (n_times, n_pairs)
-        phdiff = ph1 - ph2  # Shape: (n_times, n_pairs)
+    Args:
+        conditions: (baseline, with_gestures) tuples to compute. Defaults to BL_NoG, BL_WiG, NoG and WiG.
+        n_jobs: Number of processes the engine is split across, by band and chunk of epochs. -1 uses every CPU.
+        metrics: Names of metrics in METRICS to compute. Defaults to normalized entropy only.
+        trace_dir: Directory to write a JSON and CSV trace of the time and memory of each stage to. With n_jobs > 1 the
+            hilbert and metric stages run in worker processes and are not traced.
+        profile: Also dump cProfile stats of the run next to the trace.
+        filter_cache_dir: Directory of a BandFilterCache. Band-filtered float32 signals of the electrodes of interest are
+            then read from the cache, or filtered and added to it, instead of filtering every session on every run.
+            The float32 signals give results within float32 rounding of, but not identical to, uncached runs.
+        filter_cache_max_bytes: Size bound of the filter cache, beyond which least recently used signals are evicted.
+        electrodes: Named electrode set in ELECTRODE_SETS, "eeg", or list of electrodes, picked right after loading each
+            session. The picked names are saved as electrode_names.npy in each connectivity directory.
+        working_copies: Read the decimated float32 working copies written by working_copy.py, with their parsed
+            condition windows, instead of the processed sessions. The electrodes must be part of the working copies.
+            Results are saved under dir_suffix followed by the rate of the copies, see working_copy_dir_suffix.
 
-        # Wrap phase differences to the range [-pi, pi] (MATLAB does this automatically)
-        phdiff = np.angle(np.exp(1j * phdiff))
+    Returns:
+        out_paths : dict mapping each metric to a dict mapping each condition to the path of its saved array, or None if
+        no epochs were found.
+    """
+    with tracing(trace_path(trace_dir, expert, subject_id, conditions), profile):
+        unknown = [metric for metric in metrics if metric not in METRICS]
+        if unknown:
+            raise ValueError(f"Unknown metrics {unknown}, expected any of {list(METRICS)}")
+
+        # Results computed from working copies go to their own directory, suffixed with the rate of the copies
+        if working_copies:
+            input_paths = existing_working_copy_paths(root_dir, expert, subject_id, num_ica_comps)
+            dir_suffix = working_copy_dir_suffix(dir_suffix, working_copy_sfreq(input_paths))
+        else:
+            input_paths = existing_processed_session_paths(root_dir, expert, subject_id, num_ica_comps)
+
+        # Define output paths
+        out_paths = {metric: {condition: connectivity_output_path(root_dir, metric_dir_suffix(dir_suffix, metric), expert, subject_id, *condition)
+                              for condition in conditions} for metric in metrics}
+        for metric_paths in out_paths.values():
+            for out_path in metric_paths.values():
+                os.makedirs(os.path.dirname(out_path), exist_ok=True)
+
+        # Only compute the conditions and metrics with an existing result that is not current
+        params = {}
+        stale = []
+        for metric in metrics:
+            for condition in conditions:
+                baseline, with_gestures = condition
+                params[(metric, condition)] = {
+                    "method": metric,
+                    "num_ica_comps": num_ica_comps,
+                    "baseline": baseline,
+                    "with_gestures": with_gestures,
+                    "epoch_duration": epoch_duration,
+                    "epoch_overlap": epoch_overlap,
+                    "frequency_bands": FREQUENCY_BANDS,
+                }
+                # Older results were always computed on the electrodes of interest and have no electrodes parameter
+                if resolve_electrodes(electrodes) != ELECTRODE_SETS["interest"]:
+                    params[(metric, condition)]["electrodes"] = resolve_electrodes(electrodes)
+                if filter_cache_dir is not None:
+                    params[(metric, condition)]["band_dtype"] = "float32"
+                if working_copies:
+                    params[(metric, condition)]["working_copies"] = True
+                if not force and is_current(out_paths[metric][condition], input_paths, params[(metric, condition)], OUTPUT_VERSION):
+                    print("Connectivity data is up to date: ", out_paths[metric][condition])
+                else:
+                    stale.append((metric, condition))
+
+        if len(stale) == 0:
+            return out_paths
+        stale_metrics = [metric for metric in metrics if any(stale_metric == metric for stale_metric, _ in stale)]
+        stale_conditions = [condition for condition in conditions if any(stale_condition == condition for _, stale_condition in stale)]
+
+        frequency_bands = FREQUENCY_BANDS
+
+        # Compile one list of epochs per condition and frequency band across all sessions
+        band_epochs = {condition: [[] for _ in frequency_bands] for condition in stale_conditions}
+        filter_cache = BandFilterCache(filter_cache_dir, filter_cache_max_bytes) if filter_cache_dir is not None else None
+
+        for session in SESSIONS:
+            # Load the raw data once for all conditions and frequency bands. With a filter cache, the data is only read if
+            # a band is missing from the cache.
+            # Working copies are memory-mapped and carry their condition windows, so nothing is parsed here.
+            if working_copies:
+                raw, session_windows = load_working_session(root_dir, expert, subject_id, session, num_ica_comps, electrodes=electrodes)
+            else:
+                raw = load_processed_session(root_dir, expert, subject_id, session, num_ica_comps, preload=filter_cache is None, electrodes=electrodes)
+            if raw is None:
+                continue
+            ch_names = raw.ch_names
 
-        # Bin the phase differences into B bins over the range [−pi, pi] to form a histogram
-        bin_edges = np.linspace(-np.pi, np.pi, BINS + 1)
-        bin_indices = np.digitize(phdiff, bins=bin_edges) - 1 
-        counts = np.zeros((BINS, n_pairs))
-        for i in range(n_pairs):
-            indices = bin_indices[:, i]
-            counts[:, i] = np.bincount(indices, minlength=BINS)
+            # Partition the events of interest into conditions once for all frequency bands
+            if working_copies:
+                windows = {condition: session_windows[condition] for condition in stale_conditions}
+            else:
+                windows = find_condition_windows(raw, stale_conditions)
 
-        # Normalize histograms to get probability distributions
-        d = counts / (np.sum(counts, axis=0, keepdims=True) + np.finfo(float).eps)
+            # Proceed to the next session if no annotations of interest were found
+            if all(len(condition_windows) == 0 for condition_windows in windows.values()):
+                continue
 
-        # Compute the entropy
-        logd = np.log(d + np.finfo(float).eps)
-        h = np.sum(d * logd, axis=0) / np.log(BINS)
+            # Filter the loaded buffer to each frequency band in turn
+            if filter_cache is None:
+                band_raws = iter_band_filtered(raw, frequency_bands, n_jobs=n_jobs)
+            else:
+                if working_copies:
+                    source_path = working_copy_path(root_dir, expert, subject_id, session, num_ica_comps)
+                else:
+                    source_path = processed_session_path(root_dir, expert, subject_id, session, num_ica_comps)
+                band_raws = filter_cache.iter_band_filtered(raw, source_path, frequency_bands, raw.ch_names, n_jobs=n_jobs)
+            for band_idx, band_raw in band_raws:
+                # Cut the epochs of each annotation window out of the filtered buffer and copy them out once per
+                # condition, so that the filtered session can be released
+                for condition in stale_conditions:
+                    if len(windows[condition]) == 0:
+                        continue
+                    with stage("epoch", condition=condition_prefix(*condition).rstrip("_")):
+                        new_epochs = [window_epochs(band_raw, start, end, epoch_duration, epoch_overlap) for start, end in windows[condition]]
+                        band_epochs[condition][band_idx].append(np.concatenate(new_epochs))
+
+        band_inputs = []
+        for band_idx, band in enumerate(frequency_bands):
+            # Stack the epochs of every condition that has any, remembering where each condition ends
+            band_conditions = [condition for condition in stale_conditions if len(band_epochs[condition][band_idx]) > 0]
+            if len(band_conditions) == 0:
+                print("No epochs found for frequency band ", band)
+                continue
+            condition_lengths = [sum(len(data) for data in band_epochs[condition][band_idx]) for condition in band_conditions]
+            split_indices = np.cumsum(condition_lengths)[:-1]
+            data = np.concatenate([data for condition in band_conditions for data in band_epochs[condition][band_idx]])
+            for condition in band_conditions:
+                band_epochs[condition][band_idx] = []
+
+            # The electrodes were already picked when the sessions were loaded
+            band_inputs.append((band_conditions, split_indices, data))
+
+        # Run the engine once per band over all conditions, spread over n_jobs processes, and split the result back into conditions
+        all_connectivity = {(metric, condition): [] for metric in stale_metrics for condition in stale_conditions}
+        band_connectivity = phase_synchrony_parallel([data for _, _, data in band_inputs], metrics=stale_metrics, n_jobs=n_jobs)
+        for (band_conditions, split_indices, _), connectivity in zip(band_inputs, band_connectivity):
+            for metric in stale_metrics:
+                for condition, condition_connectivity in zip(band_conditions, np.split(connectivity[metric], split_indices)):
+                    all_connectivity[(metric, condition)].append(condition_connectivity)
+
+        if len(band_inputs) > 0:
+            for metric in stale_metrics:
+                save_connectivity_electrodes(root_dir, metric_dir_suffix(dir_suffix, metric), ch_names)
+
+        for metric, condition in stale:
+            out_path = out_paths[metric][condition]
+            if len(all_connectivity[(metric, condition)]) == 0:
+                print("No epochs found for subject ", subject_id, " in ", condition_prefix(*condition) + "connectivity")
+                out_paths[metric][condition] = None
+                continue
 
-        # Fill the synchrony matrix with the computed entropy values
-        for idx, (k, m) in enumerate(pairs):
-            s[k, m] = h[idx]
-            s[m, k] = h[idx]
+            all_connectivity_arr = np.stack(all_connectivity[(metric, condition)], axis=3)
 
-        # Store the synchronization matrix for this epoch
-        synchrony_matrices[epoch_idx, :, :] = s
+            with stage("save", metric=metric, condition=condition_prefix(*condition).rstrip("_")):
+                np.save(out_path, all_connectivity_arr)
+                write_manifest(out_path, input_paths, params[(metric, condition)], OUTPUT_VERSION)
+            print("Saved connectivity data to: ", out_path)
 
-    return synchrony_matrices
+        return out_paths
 
 def main():
     # Set up argument parser
@@ -97,115 +463,37 @@ def main():
     parser.add_argument("--WiG", help="Whether to use data with or without gestures", default="False", type=str)
     parser.add_argument("--epoch_duration", help="Duration of each epoch in seconds", default=5.0, type=float)
     parser.add_argument("--epoch_overlap", help="Overlap between epochs in seconds", default=2.5, type=float)
+    parser.add_argument("--force", help="Recompute even if the saved result is up to date", action="store_true")
+    parser.add_argument("--all_conditions", help="Compute BL_NoG, BL_WiG, NoG and WiG in a single pass, ignoring --baseline and --WiG", action="store_true")
+    parser.add_argument("--n_jobs", help="Number of processes to split the bands and epochs across, -1 for all CPUs", default=1, type=int)
+    parser.add_argument("--trace_dir", help="Write a JSON and CSV trace of the time and memory of each stage to this directory", default=None, type=str)
+    parser.add_argument("--profile", help="Also dump cProfile stats next to the trace (requires --trace_dir)", action="store_true")
+    parser.add_argument("--filter_cache", help="Directory to cache band-filtered signals in, reused across runs", default=None, type=str)
+    parser.add_argument("--filter_cache_size_gb", help="Size bound of the filter cache in GB", default=DEFAULT_MAX_BYTES / 2 ** 30, type=float)
+    parser.add_argument("--electrodes", help=f"Electrodes to compute connectivity between: one of {list(ELECTRODE_SETS)}, 'eeg' for all EEG channels, or a list of electrode names",
+                        nargs="+", default=["interest"])
+    parser.add_argument("--working_copies", help="Read the decimated working copies written by working_copy.py instead of the processed sessions", action="store_true")
+    parser.add_argument("--metrics", help="Phase synchrony metrics to compute, each saved to its own directory. coherency is the amplitude weighted phase locking value", nargs="+", default=["entropy"], choices=list(METRICS))
     
     # Parse arguments
     args = parser.parse_args()
-    root_dir = args.root_dir
-    expert = args.expert
-    subject_id = args.id
-    num_ica_comps = args.num_ica_comps
-    dir_suffix = args.dir_suffix
-    epoch_duration = args.epoch_duration
-    epoch_overlap = args.epoch_overlap
-
     baseline = True if args.baseline.lower() == "true" else False
     with_gestures = True if args.WiG.lower() == "true" else False
 
-    # Define output path
-    out_filename_prefix = ""
-    if baseline:
-        out_filename_prefix += "BL_"
-    if with_gestures:
-        out_filename_prefix += "WiG_"
-    else:
-        out_filename_prefix += "NoG_"
-    
-    out_path = os.path.join(root_dir, 'connectivity_scores' + dir_suffix, expert, subject_id, out_filename_prefix + "connectivity.npy")
-
-    os.makedirs(os.path.dirname(out_path), exist_ok=True)
-
-    frequency_bands = [(0.5,4.0), (4.0,8.0), (8.0,10.0), (10.0,13.0), (13.0,20.0), (20.0,30.0)]
-    all_connectivity = []
-
-    for band in frequency_bands:
-        # Compile a single list of epochs across all sessions
-        epochs = []
-
-        for session in range(1, 5):
-            # Load the raw data
-            in_path = os.path.join(root_dir, 'processed', expert, subject_id, f'{session}_{num_ica_comps}_raw.fif')            
-            try:
-                raw = mne.io.read_raw_fif(in_path, preload=True)
-            except FileNotFoundError:
-                print("Skipping session ", session, " due to missing file")
-                continue
-            
-            # Filter to the current frequency band
-            lower_bound = band[0]
-            upper_bound = band[1]
-            raw = raw.filter(l_freq=lower_bound, h_freq=upper_bound)
-
-            # Isolate the events of interest
-            start_times = {}
-            for annot in raw.annotations:
-                start_times[annot["description"]] = annot["onset"]
-
-            # Create a beg_keys sub list that includes only the start_times keys with the string "beg" somewhere inside
-            beg_keys = [key for key in start_times.keys() if "beg" in key]
-            # Isolate only the events corresponding to the correct gesture/no gesture condition
-            filter_string = "WiG" if with_gestures else "NoG"
-            beg_keys = [key for key in beg_keys if filter_string in key]
-            
-            # Isolate only the events corresponding to the correct baseline/no baseline condition
-            if baseline:
-                # Remove keys missing "BL"
-                beg_keys = [key for key in beg_keys if "BL" in key]
-            else:
-                # Remove keys containing "BL"
-                beg_keys = [key for key in beg_keys if "BL" not in key]
-
-            # Identify the corresponding end_keys for each beg_key by replacing "beg" with "end" and grabbing that key from start_times
-            end_keys = [key.replace("beg", "end") for key in beg_keys]
-            # Drop any end_keys that are not in start_times
-            end_keys = [key for key in end_keys if key in start_times]
-            # Create tuple pairs
-            annotations_of_interest = list(zip(beg_keys, end_keys))
-            print("annotations of interest: ", annotations_of_interest) 
-
-            # Proceed to the next session if no annotations of interest were found
-            if len(annotations_of_interest) == 0:
-                continue
-
-            # Create epochs for each pair of annotations and add them to the global list of all epochs
-            for pair in annotations_of_interest:
-                # Ignore the first two seconds and the last second of event
-                start = start_times[pair[0]] + 2
-                end = start_times[pair[1]] - 1
-                raw_cropped = raw.copy().crop(tmin=start, tmax=end)
-
-                # Make epochs
-                new_epochs = mne.make_fixed_length_epochs(raw_cropped, duration=epoch_duration, overlap=epoch_overlap, preload=True)
-
-                # Append the new epochs to the global list
-                epochs.append(new_epochs)
-
-        if len(epochs) == 0:
-            print("No epochs found for frequency band ", band)
-            continue
-        epochs = mne.epochs.concatenate_epochs(epochs)
-
-        # Isolate the electrodes of interest: F3 (5),Fz (6),F4 (7),FCz (42),Cz (16),CP3 (48),CP4 (49),P1 (51),Pz (26),P2 (52),PPO1 (92) and PPO2 (93)
-        electrodes_of_interest = ["F3", "Fz", "F4", "FCz", "Cz", "CP3", "CP4", "P1", "Pz", "P2", "PPO1", "PPO2"]
-        indices_of_interest = [raw.ch_names.index(ch) for ch in electrodes_of_interest] # 0 indexed so 1 less than above
-        epochs.pick(indices_of_interest)
-
-        connectivity = phase_synchrony_via_normalized_entropy(epochs)
-        all_connectivity.append(connectivity)
-    
-    all_connectivity_arr = np.stack(all_connectivity, axis=3)
-
-    np.save(out_path, all_connectivity_arr)
-    print("Saved connectivity data to: ", out_path)
+    if args.all_conditions:
+        compute_conditions(args.root_dir, args.expert, args.id, num_ica_comps=args.num_ica_comps, dir_suffix=args.dir_suffix,
+                           epoch_duration=args.epoch_duration, epoch_overlap=args.epoch_overlap, force=args.force, n_jobs=args.n_jobs,
+                           metrics=args.metrics, trace_dir=args.trace_dir, profile=args.profile,
+                           filter_cache_dir=args.filter_cache, filter_cache_max_bytes=int(args.filter_cache_size_gb * 2 ** 30),
+                           electrodes=parse_electrodes(args.electrodes), working_copies=args.working_copies)
+        return
+
+    compute_connectivity(args.root_dir, args.expert, args.id, num_ica_comps=args.num_ica_comps, dir_suffix=args.dir_suffix,
+                         baseline=baseline, with_gestures=with_gestures, epoch_duration=args.epoch_duration, epoch_overlap=args.epoch_overlap, force=args.force,
+                         n_jobs=args.n_jobs, metrics=args.metrics,
+                         trace_dir=args.trace_dir, profile=args.profile, filter_cache_dir=args.filter_cache,
+                         filter_cache_max_bytes=int(args.filter_cache_size_gb * 2 ** 30), electrodes=parse_electrodes(args.electrodes),
+                         working_copies=args.working_copies)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
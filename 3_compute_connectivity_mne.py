@@ -3,10 +3,252 @@ import os
 import numpy as np
 from mne_connectivity import spectral_connectivity_time
 import argparse
+from result_cache import is_current, write_manifest, manifest_path
+from instrumentation import stage, tracing
+from working_copy import load_working_copy, load_working_session, working_copy_dir_suffix, working_copy_sfreq
+from pipeline_utils import ELECTRODE_SETS, SESSIONS, CONDITIONS, condition_prefix, connectivity_output_path, mean_output_path, existing_processed_session_paths, existing_working_copy_paths, load_processed_session, find_condition_windows, window_epochs, NpyStreamWriter, trace_path, resolve_electrodes, parse_electrodes, pick_electrodes, save_connectivity_electrodes
 
 np.random.seed(42)
 import numpy as np
 
+# Bump when the saved connectivity changes, e.g. a fix of the epoching, so that saved results are recomputed
+OUTPUT_VERSION = 1
+
+def compute_connectivity(root_dir, expert, subject_id, num_ica_comps=0.9999, dir_suffix="", baseline=False, with_gestures=False, min_freq=0.5, max_freq=30.0, plv_method="pli", n_cycles_numerator=4, force=False, chunk_size=None, running_mean=False, n_jobs=1, trace_dir=None, profile=False, electrodes="interest", working_copies=False):
+    """
+    Computes MNE spectral connectivity for one participant and condition and saves it as a numpy array.
+
+    The result is skipped if its manifest shows it was computed from the same processed files and parameters, unless
+    force is set.
+
+    Returns:
+        out_path : path of the saved array, or None if no epochs were found.
+    """
+    out_paths = compute_conditions(root_dir, expert, subject_id, [(baseline, with_gestures)], num_ica_comps=num_ica_comps, dir_suffix=dir_suffix,
+                                   min_freq=min_freq, max_freq=max_freq, plv_method=plv_method, n_cycles_numerator=n_cycles_numerator, force=force, chunk_size=chunk_size,
+                                   running_mean=running_mean, n_jobs=n_jobs, trace_dir=trace_dir, profile=profile,
+                                   electrodes=electrodes, working_copies=working_copies)
+    return out_paths[(baseline, with_gestures)]
+
+def _iter_window_epochs(root_dir, expert, subject_id, num_ica_comps, conditions, electrodes, working_copies):
+    # Load each session once, restricted to the electrodes, and yield the epochs of every annotation window
+    for session in SESSIONS:
+        print("Processing session ", session)
+
+        # Load the raw data, and skip this session if it is missing for the subject
+        if working_copies:
+            raw, session_windows = load_working_session(root_dir, expert, subject_id, session, num_ica_comps, electrodes=electrodes)
+        else:
+            raw = load_processed_session(root_dir, expert, subject_id, session, num_ica_comps, electrodes=electrodes)
+        if raw is None:
+            continue
+
+        # Partition the events of interest into conditions, which working copies carry already parsed
+        if working_copies:
+            windows = {condition: session_windows[condition] for condition in conditions}
+        else:
+            windows = find_condition_windows(raw, conditions)
+        if all(len(condition_windows) == 0 for condition_windows in windows.values()):
+            # Proceed to the next session if no annotations of interest were found
+            print("No annotations of interest found for session ", session)
+            continue
+
+        # Cut each annotation window into 5 second epochs with 2.5 second overlap, as views of the loaded buffer
+        for condition in conditions:
+            for start, end in windows[condition]:
+                with stage("epoch", condition=condition_prefix(*condition).rstrip("_")):
+                    new_epochs = window_epochs(raw, start, end, duration=5.0, overlap=2.5)
+                yield condition, new_epochs, raw.info['sfreq']
+
+            print("Added ", len(windows[condition]), " windows of epochs to ", condition_prefix(*condition) + "connectivity")
+
+def compute_conditions(root_dir, expert, subject_id, conditions=CONDITIONS, num_ica_comps=0.9999, dir_suffix="", min_freq=0.5, max_freq=30.0, plv_method="pli", n_cycles_numerator=4, force=False, chunk_size=None, running_mean=False, n_jobs=1, trace_dir=None, profile=False, electrodes="interest", working_copies=False):
+    """
+    Computes MNE spectral connectivity for several conditions of one participant in a single pass.
+
+    Each session is loaded once and its annotation windows are partitioned into all requested conditions. Spectral
+    connectivity is computed once over the combined epochs and split into one array per condition.
+
+    With chunk_size set, epochs are instead processed in chunks of at most chunk_size epochs per condition and each
+    chunk is appended to the output file on disk, so memory does not grow with the length of the recording.
+
+    Args:
+        conditions: (baseline, with_gestures) tuples to compute. Defaults to BL_NoG, BL_WiG, NoG and WiG.
+        chunk_size: Number of epochs per chunk in streaming mode. None computes all epochs at once.
+        running_mean: Also save the mean over epochs of each condition next to its output, see mean_output_path.
+        n_jobs: Number of jobs spectral_connectivity_time splits the epochs across. -1 uses every CPU.
+        trace_dir: Directory to write a JSON and CSV trace of the time and memory of each stage to.
+        profile: Also dump cProfile stats of the run next to the trace.
+        electrodes: Named electrode set in ELECTRODE_SETS, "eeg", or list of electrodes, picked right after loading each
+            session. The picked names are saved as electrode_names.npy in the connectivity directory.
+        working_copies: Read the decimated float32 working copies written by working_copy.py, with their parsed
+            condition windows, instead of the processed sessions. The electrodes must be part of the working copies.
+            Results are saved under dir_suffix followed by the rate of the copies, see working_copy_dir_suffix.
+
+    Returns:
+        out_paths : dict mapping each condition to the path of its saved array, or None if no epochs were found.
+    """
+    with tracing(trace_path(trace_dir, expert, subject_id, conditions), profile):
+        # Results computed from working copies go to their own directory, suffixed with the rate of the copies
+        if working_copies:
+            input_paths = existing_working_copy_paths(root_dir, expert, subject_id, num_ica_comps)
+            dir_suffix = working_copy_dir_suffix(dir_suffix, working_copy_sfreq(input_paths))
+        else:
+            input_paths = existing_processed_session_paths(root_dir, expert, subject_id, num_ica_comps)
+
+        # Define output paths
+        out_paths = {condition: connectivity_output_path(root_dir, dir_suffix, expert, subject_id, *condition) for condition in conditions}
+        for out_path in out_paths.values():
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+
+        # Only compute the conditions whose existing result is not current
+        params = {}
+        stale_conditions = []
+        for condition in conditions:
+            baseline, with_gestures = condition
+            params[condition] = {
+                "method": "mne",
+                "num_ica_comps": num_ica_comps,
+                "baseline": baseline,
+                "with_gestures": with_gestures,
+                "min_freq": min_freq,
+                "max_freq": max_freq,
+                "plv_method": plv_method,
+                "n_cycles_numerator": n_cycles_numerator,
+            }
+            # Older results were always computed on the electrodes of interest and have no electrodes parameter
+            if resolve_electrodes(electrodes) != ELECTRODE_SETS["interest"]:
+                params[condition]["electrodes"] = resolve_electrodes(electrodes)
+            if working_copies:
+                params[condition]["working_copies"] = True
+            # The mean carries its own manifest, so a mean left by an earlier run is never mistaken for a current one
+            mean_stale = running_mean and not is_current(mean_output_path(out_paths[condition]), input_paths, params[condition], OUTPUT_VERSION)
+            if not force and not mean_stale and is_current(out_paths[condition], input_paths, params[condition], OUTPUT_VERSION):
+                print("Connectivity data is up to date: ", out_paths[condition])
+            else:
+                stale_conditions.append(condition)
+
+        if len(stale_conditions) == 0:
+            return out_paths
+
+        # Define the frequency intervals to study
+        num_intervals = int((max_freq-min_freq) * 2) + 1
+        freqs = np.linspace(min_freq, max_freq, num_intervals)
+        n_cycles = freqs / n_cycles_numerator
+        connectivity_kwargs = dict(freqs=freqs, method=plv_method, mode='multitaper', n_cycles=n_cycles, average=False, n_jobs=n_jobs)
+
+        session_epochs = _iter_window_epochs(root_dir, expert, subject_id, num_ica_comps, stale_conditions, electrodes, working_copies)
+        if chunk_size is None:
+            found_conditions = _compute_in_memory(session_epochs, stale_conditions, out_paths, running_mean, connectivity_kwargs)
+        else:
+            found_conditions = _compute_streaming(session_epochs, stale_conditions, out_paths, chunk_size, running_mean, connectivity_kwargs)
+
+        if len(found_conditions) > 0:
+            # Record the picked electrodes, in order, from the header of any session
+            if working_copies:
+                ch_names = pick_electrodes(load_working_copy(input_paths[0])[0], electrodes).ch_names
+            else:
+                ch_names = pick_electrodes(mne.io.read_raw_fif(input_paths[0], preload=False, verbose=False), electrodes).ch_names
+            save_connectivity_electrodes(root_dir, dir_suffix, ch_names)
+
+        for condition in stale_conditions:
+            if condition not in found_conditions:
+                # Skip conditions for which no epochs were found
+                print("No epochs found for subject ", subject_id, " in ", condition_prefix(*condition) + "connectivity")
+                out_paths[condition] = None
+                continue
+            with stage("save", condition=condition_prefix(*condition).rstrip("_")):
+                write_manifest(out_paths[condition], input_paths, params[condition], OUTPUT_VERSION)
+                mean_path = mean_output_path(out_paths[condition])
+                if running_mean:
+                    write_manifest(mean_path, input_paths, params[condition], OUTPUT_VERSION)
+                else:
+                    # Remove the mean of an earlier run, which no longer matches the recomputed epochs
+                    for path in [mean_path, manifest_path(mean_path)]:
+                        if os.path.exists(path):
+                            os.remove(path)
+            print("Saved connectivity data to: ", out_paths[condition])
+
+        return out_paths
+
+def _compute_in_memory(session_epochs, conditions, out_paths, running_mean, connectivity_kwargs):
+    # Compile one list of epochs per condition across all sessions
+    condition_epochs = {condition: [] for condition in conditions}
+    for condition, new_epochs, sfreq in session_epochs:
+        condition_epochs[condition].append(new_epochs)
+
+    # Concatenate the epochs of every condition that has any, remembering where each condition ends
+    found_conditions = [condition for condition in conditions if len(condition_epochs[condition]) > 0]
+    if len(found_conditions) == 0:
+        return found_conditions
+
+    split_indices = np.cumsum([sum(len(data) for data in condition_epochs[condition]) for condition in found_conditions])[:-1]
+    data = np.concatenate([data for condition in found_conditions for data in condition_epochs[condition]])
+
+    # Compute the spectral connectivity once over all conditions
+    with stage("spectral_connectivity"):
+        spec_con_obj = spectral_connectivity_time(data, sfreq=sfreq, **connectivity_kwargs)
+        arr = spec_con_obj.get_data(output="dense")
+
+    # Split the per-epoch connectivity back into conditions and store each as a numpy array in its output path
+    for condition, condition_arr in zip(found_conditions, np.split(arr, split_indices)):
+        with stage("save", condition=condition_prefix(*condition).rstrip("_")):
+            np.save(out_paths[condition], condition_arr)
+            if running_mean:
+                np.save(mean_output_path(out_paths[condition]), np.mean(condition_arr, axis=0))
+
+    return found_conditions
+
+def _compute_streaming(session_epochs, conditions, out_paths, chunk_size, running_mean, connectivity_kwargs):
+    # Per condition: output file, epochs waiting for a full chunk, and the running sum and count for the mean
+    writers = {condition: NpyStreamWriter(out_paths[condition]) for condition in conditions}
+    buffers = {condition: [] for condition in conditions}
+    sums = {condition: 0.0 for condition in conditions}
+    counts = {condition: 0 for condition in conditions}
+
+    def process(condition, data, sfreq):
+        # Spectral connectivity is computed per epoch, so chunking does not change the result
+        with stage("spectral_connectivity"):
+            spec_con_obj = spectral_connectivity_time(data, sfreq=sfreq, **connectivity_kwargs)
+            arr = spec_con_obj.get_data(output="dense")
+        with stage("save", condition=condition_prefix(*condition).rstrip("_")):
+            writers[condition].append(arr)
+        if running_mean:
+            sums[condition] = sums[condition] + np.sum(arr, axis=0)
+        counts[condition] += len(arr)
+
+    try:
+        sfreq = None
+        for condition, new_epochs, sfreq in session_epochs:
+            buffers[condition].append(new_epochs)
+            # Process every full chunk and keep the remaining epochs buffered
+            if sum(len(data) for data in buffers[condition]) >= chunk_size:
+                data = np.concatenate(buffers[condition])
+                n_full = len(data) - len(data) % chunk_size
+                for start in range(0, n_full, chunk_size):
+                    process(condition, data[start:start + chunk_size], sfreq)
+                buffers[condition] = [data[n_full:]] if n_full < len(data) else []
+
+        for condition in conditions:
+            if len(buffers[condition]) > 0:
+                process(condition, np.concatenate(buffers[condition]), sfreq)
+    except BaseException:
+        for writer in writers.values():
+            writer.abort()
+        raise
+
+    found_conditions = []
+    for condition in conditions:
+        if counts[condition] == 0:
+            writers[condition].abort()
+            continue
+        writers[condition].close()
+        if running_mean:
+            np.save(mean_output_path(out_paths[condition]), sums[condition] / counts[condition])
+        found_conditions.append(condition)
+
+    return found_conditions
+
 def main():
     # Set up argument parser
     parser = argparse.ArgumentParser(description="Compute spectral connectivity metrics on processed EEG data")
@@ -22,125 +264,36 @@ def main():
     parser.add_argument("--n_cycles_numerator", help="Numerator for the number of cycles", default=4, type=int)
     parser.add_argument("--baseline", help="Whether to use baseline data", default="False", type=str)
     parser.add_argument("--WiG", help="Whether to use data with or without gestures", default="False", type=str)
+    parser.add_argument("--force", help="Recompute even if the saved result is up to date", action="store_true")
+    parser.add_argument("--all_conditions", help="Compute BL_NoG, BL_WiG, NoG and WiG in a single pass, ignoring --baseline and --WiG", action="store_true")
+    parser.add_argument("--chunk_size", help="Stream epochs to disk in chunks of this many epochs instead of computing all at once", default=None, type=int)
+    parser.add_argument("--running_mean", help="Also save the mean over epochs of each condition", action="store_true")
+    parser.add_argument("--n_jobs", help="Number of jobs to split the epochs across, -1 for all CPUs", default=1, type=int)
+    parser.add_argument("--electrodes", help=f"Electrodes to compute connectivity between: one of {list(ELECTRODE_SETS)}, 'eeg' for all EEG channels, or a list of electrode names",
+                        nargs="+", default=["interest"])
+    parser.add_argument("--working_copies", help="Read the decimated working copies written by working_copy.py instead of the processed sessions", action="store_true")
+    parser.add_argument("--trace_dir", help="Write a JSON and CSV trace of the time and memory of each stage to this directory", default=None, type=str)
+    parser.add_argument("--profile", help="Also dump cProfile stats next to the trace (requires --trace_dir)", action="store_true")
     
     # Parse arguments
     args = parser.parse_args()
-    root_dir = args.root_dir
-    expert = args.expert
-    subject_id = args.id
-    min_freq = float(args.min_freq)
-    max_freq = float(args.max_freq)
-    num_ica_comps = args.num_ica_comps
-    dir_suffix = args.dir_suffix
-    plv_method = args.PLV_method
-    n_cycles_numerator = args.n_cycles_numerator
     baseline = True if args.baseline.lower() == "true" else False
     with_gestures = True if args.WiG.lower() == "true" else False
 
-    # Define output path
-    out_filename_prefix = ""
-    if baseline:
-        out_filename_prefix += "BL_"
-    if with_gestures:
-        out_filename_prefix += "WiG_"
-    else:
-        out_filename_prefix += "NoG_"
-    out_path = os.path.join(root_dir, 'connectivity_scores' + dir_suffix, expert, subject_id, out_filename_prefix + "connectivity.npy")
-    os.makedirs(os.path.dirname(out_path), exist_ok=True)
-
-    # Compile a single list of epochs across all sessions
-    epochs = []
-    for session in range(1, 5):
-        previous_epoch_count = len(epochs)
-        print("Processing session ", session)
-
-        # Load the raw data, and skip this session if it is missing for the subject
-        in_path = os.path.join(root_dir, 'processed', expert, subject_id, f'{session}_{num_ica_comps}_raw.fif')
-        try:
-            raw = mne.io.read_raw_fif(in_path, preload=True)
-        except FileNotFoundError:
-            print("Skipping session ", session, " due to missing file")
-            continue
-        
-        # Isolate the events of interest
-        start_times = {}
-        for annot in raw.annotations:
-            start_times[annot["description"]] = annot["onset"]
-
-        # Create a beg_keys sub list that includes only the start_times keys with the string "beg" somewhere inside
-        beg_keys = [key for key in start_times.keys() if "beg" in key]
-
-        # Isolate only the events corresponding to the correct gesture/no gesture condition
-        filter_string = "WiG" if with_gestures else "NoG"
-        beg_keys = [key for key in beg_keys if filter_string in key]
-
-        if baseline:
-            # Remove keys missing "BL"
-            beg_keys = [key for key in beg_keys if "BL" in key]
-        else:
-            # Remove keys containing "BL"
-            beg_keys = [key for key in beg_keys if "BL" not in key]
-
-
-        # Identify the corresponding end_keys for each beg_key by replacing "beg" with "end" and grabbing that key from start_times
-        end_keys = [key.replace("beg", "end") for key in beg_keys]
-
-        # Drop any end_keys that are not in start_times
-        end_keys = [key for key in end_keys if key in start_times]
-
-        # Create tuple pairs
-        annotations_of_interest = list(zip(beg_keys, end_keys))
-
-        # Print the identified annotations of interest
-        print("annotations of interest: ", annotations_of_interest)
-        if len(annotations_of_interest) == 0:
-            # Proceed to the next session if no annotations of interest were found
-            print("No annotations of interest found for session ", session)
-            continue
-        else: 
-            print("Found annotations of interest for session ", session)
-            print(annotations_of_interest)
-        
-        # Create epochs for each pair of annotations and add them to the global list of all epochs
-        for pair in annotations_of_interest:
-            # Ignore the first two seconds and the last second of event
-            start = start_times[pair[0]] + 2
-            end = start_times[pair[1]] - 1
-            raw_cropped = raw.copy().crop(tmin=start, tmax=end)
-
-            # Define epochs as 5 second windows with 2.5 second overlap
-            new_epochs = mne.make_fixed_length_epochs(raw_cropped, duration=5.0, overlap=2.5, preload=True)
-
-            # Append the new epochs to the global list
-            epochs.append(new_epochs)
-
-        print("Added ", len(epochs) - previous_epoch_count, " epochs to the list")
-
-        epochs = mne.epochs.concatenate_epochs(epochs)
-
-    # If no epochs were found, exit the program
-    if len(epochs) == 0:
-        print("No epochs found for subject ", subject_id)
+    if args.all_conditions:
+        compute_conditions(args.root_dir, args.expert, args.id, num_ica_comps=args.num_ica_comps, dir_suffix=args.dir_suffix,
+                           min_freq=float(args.min_freq), max_freq=float(args.max_freq), plv_method=args.PLV_method,
+                           n_cycles_numerator=args.n_cycles_numerator, force=args.force, chunk_size=args.chunk_size,
+                           running_mean=args.running_mean, n_jobs=args.n_jobs, trace_dir=args.trace_dir, profile=args.profile,
+                           electrodes=parse_electrodes(args.electrodes), working_copies=args.working_copies)
         return
-    
-
-    # Isolate the electrodes of interest: F3 (5),Fz (6),F4 (7),FCz (42),Cz (16),CP3 (48),CP4 (49),P1 (51),Pz (26),P2 (52),PPO1 (92) and PPO2 (93)
-    channels_of_interest = ["F3", "Fz", "F4", "FCz", "Cz", "CP3", "CP4", "P1", "Pz", "P2", "PPO1", "PPO2"]
-    indices_of_interest = [raw_cropped.ch_names.index(ch) for ch in channels_of_interest] # 0 indexed so 1 less than above
-    epochs.pick(indices_of_interest)
-
-    # Define the frequency intervals to study
-    num_intervals = int((max_freq-min_freq) * 2) + 1
-    freqs = np.linspace(min_freq, max_freq, num_intervals)
-    n_cycles = freqs / n_cycles_numerator
-
-    # Compute the spectral connectivity
-    spec_con_obj = spectral_connectivity_time(epochs, freqs=freqs, method=plv_method, mode='multitaper', n_cycles=n_cycles, average=False)
-    arr = spec_con_obj.get_data(output="dense")
 
-    # Store the connectivity array as a numpy array in the output path
-    np.save(out_path, arr)
-    print("Saved connectivity data to: ", out_path)
+    compute_connectivity(args.root_dir, args.expert, args.id, num_ica_comps=args.num_ica_comps, dir_suffix=args.dir_suffix,
+                         baseline=baseline, with_gestures=with_gestures, min_freq=float(args.min_freq), max_freq=float(args.max_freq),
+                         plv_method=args.PLV_method, n_cycles_numerator=args.n_cycles_numerator, force=args.force,
+                         chunk_size=args.chunk_size, running_mean=args.running_mean, n_jobs=args.n_jobs, trace_dir=args.trace_dir,
+                         profile=args.profile, electrodes=parse_electrodes(args.electrodes),
+                         working_copies=args.working_copies)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,216 @@
+import argparse
+import importlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+# Shapes of the real data: 12 electrodes of interest, 512 Hz recordings cut into 5 second epochs, 6 entropy bands
+N_CHANNELS = 12
+SFREQ = 512
+EPOCH_DURATION = 5.0
+N_BANDS = 6
+
+# Scaling sizes of every benchmark, in the unit its throughput is reported in
+SIZES = {
+    "entropy": [16, 64, 256],
+    "dataset": [10, 20, 40],
+    "dataset_lazy": [10, 20, 40],
+    "mixed_anova": [20, 40, 80],
+}
+QUICK_SIZES = {name: sizes[:1] for name, sizes in SIZES.items()}
+
+# Number of epochs in each synthetic connectivity file
+EPOCHS_PER_CONDITION = 40
+
+
+def synthetic_eeg(n_epochs, seed=0):
+    # Band limited noise with a shared component, so that phase differences are not uniformly distributed
+    rng = np.random.default_rng(seed)
+    n_times = int(EPOCH_DURATION * SFREQ)
+    shared = rng.standard_normal((n_epochs, 1, n_times))
+    data = shared + rng.standard_normal((n_epochs, N_CHANNELS, n_times))
+    return np.cumsum(data, axis=-1) / np.sqrt(n_times)
+
+
+def synthetic_connectivity_dir(root, n_subjects, seed=0):
+    """
+    Writes a data directory with electrode names and an entropy connectivity directory with n_subjects split between
+    the expert and novice groups, in the layout read by Dataset.
+
+    Returns:
+        connectivity_dir_path : path of the connectivity directory relative to root.
+    """
+    from connectivity_store import CONDITION_FILES
+
+    rng = np.random.default_rng(seed)
+    np.save(os.path.join(root, "electrode_names.npy"), np.array([f"E{i}" for i in range(N_CHANNELS)]))
+    connectivity_dir_path = f"connectivity_scores_{n_subjects}"
+    for i in range(n_subjects):
+        group = "expert" if i % 2 == 0 else "novice"
+        subject_dir = os.path.join(root, connectivity_dir_path, group, str(i))
+        os.makedirs(subject_dir, exist_ok=True)
+        for filename in CONDITION_FILES.values():
+            np.save(os.path.join(subject_dir, filename), -rng.random((EPOCHS_PER_CONDITION, N_CHANNELS, N_CHANNELS, N_BANDS)))
+    return connectivity_dir_path
+
+
+def bench_entropy(size, tmp_dir):
+    entropy = importlib.import_module("3_compute_connectivity_entropy")
+    data = synthetic_eeg(size)
+    return lambda: entropy.normalized_entropy_from_data(data), "epochs"
+
+
+def _bench_dataset(size, tmp_dir, lazy):
+    from dataset import Dataset
+
+    connectivity_dir_path = synthetic_connectivity_dir(tmp_dir, size)
+
+    def run():
+        dataset = Dataset(connectivity_dir_path, data_dir=tmp_dir, lazy=lazy)
+        # Lazy datasets only load on access, so touch every condition to time the same amount of work
+        for group in ["expert", "novice"]:
+            for demo in ["BL", "demo"]:
+                for gestures in ["NoG", "WiG"]:
+                    dataset.get_frequency_average(group, demo, gestures, "theta")
+    return run, "subjects"
+
+
+def bench_dataset(size, tmp_dir):
+    return _bench_dataset(size, tmp_dir, lazy=False)
+
+
+def bench_dataset_lazy(size, tmp_dir):
+    return _bench_dataset(size, tmp_dir, lazy=True)
+
+
+def bench_mixed_anova(size, tmp_dir):
+    from stats_tests import run_mixed_anova
+
+    rng = np.random.default_rng(0)
+    n_A = size // 2
+    arrays = [rng.random((n, N_CHANNELS, N_CHANNELS)) for n in [n_A, n_A, size - n_A, size - n_A]]
+    return lambda: run_mixed_anova(*arrays), "subjects"
+
+
+BENCHMARKS = {
+    "entropy": bench_entropy,
+    "dataset": bench_dataset,
+    "dataset_lazy": bench_dataset_lazy,
+    "mixed_anova": bench_mixed_anova,
+}
+
+
+def time_benchmark(name, size, repeats):
+    """
+    Times one benchmark at one size.
+
+    The fastest of `repeats` untraced runs gives the wall time, and one additional run under tracemalloc gives the
+    peak memory allocated by Python and numpy during the call.
+
+    Returns:
+        result : dict with seconds, throughput (size per second), unit and peak_mb.
+    """
+    tmp_dir = tempfile.mkdtemp(prefix="eeg_benchmark_")
+    try:
+        run, unit = BENCHMARKS[name](size, tmp_dir)
+        # Warm up imports and caches so that the first repeat is not penalized
+        run()
+
+        seconds = min(_timed(run) for _ in range(repeats))
+
+        tracemalloc.start()
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return {"seconds": seconds, "throughput": size / seconds, "unit": f"{unit}/s", "peak_mb": peak / 2 ** 20}
+
+
+def _timed(run):
+    start = time.perf_counter()
+    run()
+    return time.perf_counter() - start
+
+
+def run_benchmarks(names, sizes, repeats):
+    results = {}
+    for name in names:
+        for size in sizes[name]:
+            key = f"{name}/{size}"
+            results[key] = time_benchmark(name, size, repeats)
+            result = results[key]
+            print(f"{key:<24} {result['seconds'] * 1e3:10.2f} ms {result['throughput']:12.1f} {result['unit']:<12} {result['peak_mb']:8.1f} MB")
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compares results with a saved baseline.
+
+    Returns:
+        regressions : list of (key, metric, baseline value, new value) where the new run is more than `tolerance`
+        (a fraction) slower or uses more than `tolerance` more peak memory.
+    """
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        old = baseline[key]
+        if result["seconds"] > old["seconds"] * (1 + tolerance):
+            regressions.append((key, "seconds", old["seconds"], result["seconds"]))
+        if result["peak_mb"] > old["peak_mb"] * (1 + tolerance):
+            regressions.append((key, "peak_mb", old["peak_mb"], result["peak_mb"]))
+    return regressions
+
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description="Benchmark the connectivity, dataset loading and statistics hot paths on synthetic data")
+    parser.add_argument("--benchmarks", help="Benchmarks to run", nargs="+", default=list(BENCHMARKS), choices=list(BENCHMARKS))
+    parser.add_argument("--repeats", help="Number of timed runs per size, the fastest is reported", default=3, type=int)
+    parser.add_argument("--quick", help="Only run the smallest size of each benchmark", action="store_true")
+    parser.add_argument("--save", help="Write the results to this JSON file", default=None, type=str)
+    parser.add_argument("--compare", help="Compare the results with this JSON baseline and exit with status 1 on regressions", default=None, type=str)
+    parser.add_argument("--tolerance", help="Allowed relative slowdown or memory growth before a result counts as a regression", default=0.2, type=float)
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.benchmarks, QUICK_SIZES if args.quick else SIZES, args.repeats)
+
+    if args.save:
+        report = {
+            "meta": {
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "platform": platform.platform(),
+                "processor": platform.processor(),
+                "cpu_count": os.cpu_count(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            },
+            "results": results,
+        }
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+        print("Saved benchmark results to: ", args.save)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        for key, metric, old, new in regressions:
+            print(f"Regression in {key}: {metric} {old:.4g} -> {new:.4g}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against ", args.compare)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+import numpy as np
+import os
+import zipfile
+
+# Connectivity file of each (demo, gestures) condition within a subject directory
+CONDITION_FILES = {
+    ("BL", "NoG"): "BL_NoG_connectivity.npy",
+    ("BL", "WiG"): "BL_WiG_connectivity.npy",
+    ("demo", "NoG"): "NoG_connectivity.npy",
+    ("demo", "WiG"): "WiG_connectivity.npy",
+}
+
+GROUPS = ["expert", "novice"]
+
+# Electrode names of the rows and columns of the connectivity matrices, stored at the root of a connectivity directory
+ELECTRODE_NAMES_FILE = "electrode_names.npy"
+
+# Fixed size of a zip local file header, before the variable length file name and extra field
+_ZIP_LOCAL_HEADER_SIZE = 30
+
+
+def _write_npy_member(zf, name, arr):
+    with zf.open(name + '.npy', 'w', force_zip64=True) as f:
+        np.lib.format.write_array(f, np.asarray(arr), allow_pickle=False)
+
+
+def pack_store(connectivity_dir, out_path, dtype=np.float32):
+    """
+    Packs every *_connectivity.npy file of a connectivity directory into one uncompressed .npz container.
+
+    The container holds a single contiguous `data` array with the epochs of every (group, id, demo, gestures) entry
+    stacked along the first axis, an `offsets` array such that the epochs of entry i are data[offsets[i]:offsets[i+1]],
+    and one index array per key (`groups`, `ids`, `demos`, `gestures`). Entries are written in sorted subject order.
+    The electrode names of the directory, if recorded, are stored as `electrode_names`.
+
+    Args:
+        connectivity_dir: Directory with {expert,novice}/{id}/*_connectivity.npy files.
+        out_path: Path of the .npz file to write.
+        dtype: Data type of the packed epochs.
+
+    Returns:
+        n_entries : number of packed (group, id, demo, gestures) entries.
+    """
+    # Collect the entries and their shapes without loading any data
+    entries = []
+    for group in GROUPS:
+        group_dir = os.path.join(connectivity_dir, group)
+        if not os.path.isdir(group_dir):
+            continue
+        for id in sorted(os.listdir(group_dir)):
+            for (demo, gestures), filename in CONDITION_FILES.items():
+                path = os.path.join(group_dir, id, filename)
+                if os.path.exists(path):
+                    entries.append((group, id, demo, gestures, path))
+
+    shapes = [np.load(path, mmap_mode='r').shape for *_, path in entries]
+    epoch_shapes = {shape[1:] for shape in shapes}
+    if len(epoch_shapes) > 1:
+        raise ValueError(f"Connectivity files have different epoch shapes: {sorted(epoch_shapes)}")
+    epoch_shape = epoch_shapes.pop() if epoch_shapes else (0,)
+    offsets = np.concatenate([[0], np.cumsum([shape[0] for shape in shapes])]).astype(np.int64)
+
+    # Write to a temporary file first so that an interrupted run never leaves a truncated container behind
+    tmp_path = out_path + ".tmp"
+    with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+        # Stream the epochs one file at a time behind a single npy header
+        header = {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False, 'shape': (int(offsets[-1]),) + tuple(epoch_shape)}
+        with zf.open('data.npy', 'w', force_zip64=True) as f:
+            np.lib.format.write_array_header_2_0(f, header)
+            for *_, path in entries:
+                f.write(np.ascontiguousarray(np.load(path), dtype=dtype).tobytes())
+
+        _write_npy_member(zf, 'offsets', offsets)
+        _write_npy_member(zf, 'groups', np.array([entry[0] for entry in entries], dtype=str))
+        _write_npy_member(zf, 'ids', np.array([entry[1] for entry in entries], dtype=str))
+        _write_npy_member(zf, 'demos', np.array([entry[2] for entry in entries], dtype=str))
+        _write_npy_member(zf, 'gestures', np.array([entry[3] for entry in entries], dtype=str))
+        electrode_names_path = os.path.join(connectivity_dir, ELECTRODE_NAMES_FILE)
+        if os.path.exists(electrode_names_path):
+            _write_npy_member(zf, 'electrode_names', np.load(electrode_names_path))
+    os.replace(tmp_path, out_path)
+
+    return len(entries)
+
+
+def mmap_npz_member(path, name):
+    """
+    Memory-maps an uncompressed member of an .npz file in place, without extracting it.
+    """
+    with zipfile.ZipFile(path) as zf:
+        info = zf.getinfo(name + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        # Compressed members cannot be mapped, so fall back to reading them
+        return np.load(path)[name]
+
+    with open(path, 'rb') as f:
+        # Skip the local file header, whose extra field may differ from the one in the central directory
+        f.seek(info.header_offset)
+        local_header = f.read(_ZIP_LOCAL_HEADER_SIZE)
+        name_length = int.from_bytes(local_header[26:28], 'little')
+        extra_length = int.from_bytes(local_header[28:30], 'little')
+        f.seek(info.header_offset + _ZIP_LOCAL_HEADER_SIZE + name_length + extra_length)
+
+        # Parse the npy header to find the array layout
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+
+    if np.prod(shape) == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape, order='F' if fortran_order else 'C')
+
+
+class ConnectivityStore:
+    """
+    Read access to a container written by pack_store.
+
+    The epoch data is memory-mapped, so opening the store only reads the small index arrays and slicing an entry only
+    reads that entry's epochs.
+    """
+    def __init__(self, path):
+        self.path = path
+        with np.load(path) as npz:
+            self.offsets = npz['offsets']
+            groups, ids, demos, gestures = npz['groups'], npz['ids'], npz['demos'], npz['gestures']
+            self.electrode_names = npz['electrode_names'] if 'electrode_names' in npz.files else None
+        self.data = mmap_npz_member(path, 'data')
+        self.index = {(str(group), str(id), str(demo), str(gesture)): i for i, (group, id, demo, gesture) in enumerate(zip(groups, ids, demos, gestures))}
+
+    def subject_ids(self, group):
+        # Subject ids of a group in stored order
+        return list(dict.fromkeys(id for entry_group, id, _, _ in self.index if entry_group == group))
+
+    def has(self, group, id, demo, gestures):
+        return (group, id, demo, gestures) in self.index
+
+    def get(self, group, id, demo, gestures):
+        """
+        Returns a memory-mapped view of the epochs of one entry, shape (n_epochs, ...).
+        """
+        try:
+            i = self.index[(group, id, demo, gestures)]
+        except KeyError:
+            raise FileNotFoundError(f"{group}/{id}/{CONDITION_FILES[(demo, gestures)]} is not in {self.path}")
+        return self.data[self.offsets[i]:self.offsets[i + 1]]
@@ -1,31 +1,186 @@
+import json
 import numpy as np
 import os 
 from collections import defaultdict
+from connectivity_store import CONDITION_FILES, ELECTRODE_NAMES_FILE, ConnectivityStore
+
+# Frequency bands in the order they are stored along the last axis of entropy connectivity files (see
+# pipeline_utils.FREQUENCY_BANDS), as name -> (min_freq, max_freq) with both bounds inclusive
+FREQUENCY_BANDS = {
+    "delta": (0.5, 4),
+    "theta": (4, 8),
+    "low alpha": (8, 10),
+    "high alpha": (10, 13),
+    "low beta": (13, 20),
+    "high beta": (20, 30),
+}
+
+# Upper bound on the bytes of a memory-mapped file that are read into memory at once in lazy mode
+EPOCH_CHUNK_BYTES = 64 * 2 ** 20
+
+# Normalization schemes computed from the baseline (BL_NoG and BL_WiG) epochs of each subject, see Dataset.set_normalization
+NORMALIZATIONS = ["minmax", "zscore", "robust"]
+
+# Lower and upper percentile of the baseline epochs used as the range of the robust normalization
+ROBUST_PERCENTILES = (5, 95)
+
+# Added to the range (or standard deviation) of every normalization to avoid dividing by zero
+NORMALIZATION_EPS = 1e-6
+
+# Bump when the layout of the persisted subject summaries changes so that older summaries are never read
+SUMMARY_CACHE_VERSION = 1
+
+BASELINE_STATISTICS = ["min", "max", "mean", "std", "p_low", "p_high"]
+
+
+class _LazyArrayDict(dict):
+    # Dict that computes and stores a missing value on first access
+    def __init__(self, loader):
+        super().__init__()
+        self._loader = loader
+
+    def __missing__(self, key):
+        value = self._loader(key)
+        self[key] = value
+        return value
+
+
+def _iter_epoch_chunks(arr):
+    # Yield consecutive blocks of epochs from a (possibly memory-mapped) array, each at most EPOCH_CHUNK_BYTES large
+    epoch_bytes = max(1, arr[0].nbytes) if len(arr) else 1
+    chunk = max(1, EPOCH_CHUNK_BYTES // epoch_bytes)
+    for start in range(0, len(arr), chunk):
+        yield np.asarray(arr[start:start + chunk], dtype=np.float64)
+
+
+def _baseline_statistics(arrays):
+    """
+    Computes the statistics of every connectivity entry over the epochs of several (memory-mapped) arrays in a single
+    pass. The arrays are read in blocks of rows of the first electrode axis, so only one block of all epochs is in
+    memory at a time and the arrays are never concatenated as a whole.
+
+    Returns:
+        (stats, sums) : dict of BASELINE_STATISTICS, each of the shape of one epoch, with "p_low" and "p_high" the
+        ROBUST_PERCENTILES, and the sum over the epochs of each array.
+    """
+    shape = arrays[0].shape[1:]
+    stats = {name: np.full(shape, np.nan) for name in BASELINE_STATISTICS}
+    sums = [np.zeros(shape) for _ in arrays]
+    n_epochs = sum(len(arr) for arr in arrays)
+    if n_epochs == 0:
+        return stats, sums
+
+    row_bytes = n_epochs * int(np.prod(shape[1:])) * np.dtype(np.float64).itemsize
+    rows = max(1, EPOCH_CHUNK_BYTES // max(1, row_bytes))
+    for start in range(0, shape[0], rows):
+        rows_slice = slice(start, start + rows)
+        blocks = [np.asarray(arr[:, rows_slice], dtype=np.float64) for arr in arrays]
+        for total, block in zip(sums, blocks):
+            total[rows_slice] = block.sum(axis=0)
+        block = np.concatenate(blocks)
+        stats["min"][rows_slice] = block.min(axis=0)
+        stats["max"][rows_slice] = block.max(axis=0)
+        stats["mean"][rows_slice] = block.mean(axis=0)
+        stats["std"][rows_slice] = block.std(axis=0)
+        stats["p_low"][rows_slice], stats["p_high"][rows_slice] = np.percentile(block, ROBUST_PERCENTILES, axis=0)
+    return stats, sums
+
+
+def _normalization_affine(stats, normalization):
+    # Offset and scale of a normalization scheme, such that normalized = (data - offset) / scale
+    if normalization is None:
+        return 0.0, 1.0
+    if normalization == "minmax":
+        return stats["min"], stats["max"] - stats["min"] + NORMALIZATION_EPS
+    if normalization == "zscore":
+        return stats["mean"], stats["std"] + NORMALIZATION_EPS
+    return stats["p_low"], stats["p_high"] - stats["p_low"] + NORMALIZATION_EPS
+
+
+def _resolve_normalization(normalize):
+    # Map the normalize argument of Dataset to a scheme in NORMALIZATIONS, or None
+    if normalize is True:
+        return "minmax"
+    if normalize is False or normalize is None:
+        return None
+    if normalize not in NORMALIZATIONS:
+        raise ValueError(f"Unknown normalization {normalize}, expected True, False or one of {NORMALIZATIONS}")
+    return normalize
+
 
 class Dataset:
-    def __init__(self, connectivity_dir_path, data_dir="data", frequency_file="frequencies.npy", electrode_file="electrode_names.npy", novice_excludes=[], expert_excludes=[], entropy_analysis=True, normalize=True):
+    def __init__(self, connectivity_dir_path, data_dir="data", frequency_file="frequencies.npy", electrode_file="electrode_names.npy", novice_excludes=[], expert_excludes=[], entropy_analysis=True, normalize=True, lazy=False, bands=None, cache_dir=None):
+        """
+        Args:
+            connectivity_dir_path: Directory of connectivity files within data_dir, or a .npz container written by
+                pack_dataset.py, which is read through a memory map.
+            electrode_file: Electrode names within data_dir, used when the connectivity directory or container does not
+                record the electrodes it was computed on.
+            normalize: Normalization of every subject by its baseline epochs: "minmax" (or True), "zscore", "robust"
+                (min-max over the ROBUST_PERCENTILES) or False. Can be switched later with set_normalization. Eager
+                epochs in id_dicts are float32 and normalized in place.
+            lazy: If True, connectivity files are memory-mapped and each subject is reduced to its epoch means the
+                first time numpy_arrays is accessed for its group. Only the averaged arrays are kept in memory, so
+                id_dicts and lists stay empty; use get_subject_epochs for the epochs of a single subject.
+            bands: Optional dict of band name -> (min_freq, max_freq) used by get_frequency_average, defaulting to
+                FREQUENCY_BANDS. With entropy_analysis the bands must be a subset of FREQUENCY_BANDS (by bounds), since
+                entropy files only hold those bands.
+            cache_dir: Optional directory to persist the epoch means and baseline statistics of every subject in, keyed
+                on the size and modification time of its files, so that they are only computed once across sessions.
+        """
         self.directory = os.path.join(data_dir, connectivity_dir_path)
-        self.frequencies = ["delta", "theta", "low alpha", "high alpha", "low beta", "high beta"] if entropy_analysis else np.load(os.path.join(data_dir, frequency_file)) 
-        self.electrode_names = np.load(os.path.join(data_dir, electrode_file))
+        self.bands = dict(FREQUENCY_BANDS if bands is None else bands)
+        self.frequencies = list(self.bands) if entropy_analysis else np.load(os.path.join(data_dir, frequency_file))
         self.novice_excludes = novice_excludes
         self.expert_excludes = expert_excludes
         self.entropy_analysis = entropy_analysis
-        self.normalize = normalize
+        self.normalization = _resolve_normalization(normalize)
+        self.normalize = self.normalization is not None
+        self.lazy = lazy
+        self.cache_dir = cache_dir
+        self.store = ConnectivityStore(self.directory) if self.directory.endswith(".npz") else None
+        self.electrode_names = self._load_electrode_names(os.path.join(data_dir, electrode_file))
+        self._build_band_table()
+        self._band_averages = {}
 
         self.id_dicts = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: defaultdict(list))))
         self.lists = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
         self.numpy_arrays = defaultdict(lambda: defaultdict(lambda: defaultdict(None)))
 
+        # Size and modification time of the files of every loaded subject, used by refresh to detect changes
+        self._signatures = {}
+        self._subject_summaries = {}
+
+        if lazy:
+            self.subject_ids = self._scan_subject_ids()
+            for group in self.subject_ids:
+                for id in self.subject_ids[group]:
+                    self._signatures[(group, id)] = self._subject_signature(group, id)
+            self._reset_lazy_numpy_arrays()
+            return
+
         self.load_all_id_dicts()
         self.load_all_lists()
         self.load_all_numpy_arrays()
 
+    def _load_electrode_names(self, default_path):
+        # Prefer the electrodes recorded with the connectivity data, which older connectivity directories do not have
+        if self.store is not None and self.store.electrode_names is not None:
+            return self.store.electrode_names
+        electrode_names_path = os.path.join(self.directory, ELECTRODE_NAMES_FILE)
+        if self.store is None and os.path.exists(electrode_names_path):
+            return np.load(electrode_names_path)
+        return np.load(default_path)
 
-    def load_all_id_dicts(self):
-        # Create a dict of all raw subjects using _load_invidiual_subject()
+    def _iter_subject_dirs(self):
+        # Yield (group_dir, id) for every subject directory that is not excluded, sorted like the packed store so that
+        # both orders of the subjects in numpy_arrays agree
         for group_dir in ['expert', 'novice']:
-            group_dir_path = os.path.join(self.directory, group_dir)
-            ids = os.listdir(group_dir_path)
+            if self.store is not None:
+                ids = self.store.subject_ids(group_dir)
+            else:
+                group_dir_path = os.path.join(self.directory, group_dir)
+                ids = sorted(os.listdir(group_dir_path))
 
             for id in ids:
                 if group_dir == 'expert' and id in self.expert_excludes:
@@ -33,17 +188,252 @@ class Dataset:
                 if group_dir == 'novice' and id in self.novice_excludes:
                     continue
                 # If id is not a directory, skip
-                if not os.path.isdir(os.path.join(group_dir_path, id)):
-                    continue
-                BL_NoG_data, BL_WiG_data, NoG_data, WiG_data = [], [], [], []
-                try:
-                    BL_NoG_data, BL_WiG_data, NoG_data, WiG_data = self._load_invidiual_subject(group_dir, id)
-                    self.id_dicts[group_dir]["BL"]["NoG"][id] = BL_NoG_data
-                    self.id_dicts[group_dir]["demo"]["NoG"][id] = NoG_data
-                    self.id_dicts[group_dir]["BL"]["WiG"][id] = BL_WiG_data
-                    self.id_dicts[group_dir]["demo"]["WiG"][id] = WiG_data
-                except FileNotFoundError:
+                if self.store is None and not os.path.isdir(os.path.join(group_dir_path, id)):
                     continue
+                yield group_dir, id
+
+    def _subject_path(self, group_dir, id, demo, gestures):
+        return os.path.join(self.directory, group_dir, id, CONDITION_FILES[(demo, gestures)])
+
+    def _has_condition(self, group_dir, id, demo, gestures):
+        if self.store is not None:
+            return self.store.has(group_dir, id, demo, gestures)
+        return os.path.exists(self._subject_path(group_dir, id, demo, gestures))
+
+    def _load_condition(self, group_dir, id, demo, gestures, mmap=False):
+        # Load the epochs of one condition from the packed store or from its own file, optionally memory-mapped
+        if self.store is not None:
+            data = self.store.get(group_dir, id, demo, gestures)
+            return data if mmap else np.array(data)
+        return np.load(self._subject_path(group_dir, id, demo, gestures), mmap_mode='r' if mmap else None)
+
+    def _scan_subject_ids(self):
+        # List the subjects that have all four connectivity files, without loading any of them
+        subject_ids = defaultdict(list)
+        for group_dir, id in self._iter_subject_dirs():
+            if all(self._has_condition(group_dir, id, demo, gestures) for demo, gestures in CONDITION_FILES):
+                subject_ids[group_dir].append(id)
+        return subject_ids
+
+    def _subject_signature(self, group_dir, id):
+        # Size and modification time of every file a subject is read from, or None if any of them is missing
+        if self.store is not None:
+            paths = [self.store.path]
+        else:
+            paths = [self._subject_path(group_dir, id, demo, gestures) for demo, gestures in CONDITION_FILES]
+        signature = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                return None
+            signature.append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+        return signature
+
+    def _summary_cache_path(self, group_dir, id):
+        return os.path.join(self.cache_dir, os.path.basename(self.directory), group_dir, id + ".npz")
+
+    def _read_cached_summary(self, group_dir, id, signature):
+        # Return the persisted summary of a subject if it was computed from the same files, else None
+        path = self._summary_cache_path(group_dir, id)
+        try:
+            with np.load(path) as npz:
+                if json.loads(str(npz["signature"])) != {"version": SUMMARY_CACHE_VERSION, "files": signature}:
+                    return None
+                return {
+                    "means": {(demo, gestures): npz[f"mean_{demo}_{gestures}"] for demo, gestures in CONDITION_FILES},
+                    "stats": {name: npz[f"stat_{name}"] for name in BASELINE_STATISTICS},
+                    "signature": signature,
+                }
+        except (FileNotFoundError, KeyError, ValueError):
+            return None
+
+    def _write_cached_summary(self, group_dir, id, summary):
+        # Write to a temporary file first so that concurrent readers never see a partially written summary
+        path = self._summary_cache_path(group_dir, id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path[:-len('.npz')]}.{os.getpid()}.tmp.npz"
+        arrays = {f"mean_{demo}_{gestures}": mean for (demo, gestures), mean in summary["means"].items()}
+        arrays.update({f"stat_{name}": stat for name, stat in summary["stats"].items()})
+        np.savez(tmp_path, signature=json.dumps({"version": SUMMARY_CACHE_VERSION, "files": summary["signature"]}), **arrays)
+        os.replace(tmp_path, path)
+
+    def _cached_subject_summary(self, group_dir, id, signature):
+        # Return the summary of a subject kept in memory or persisted in cache_dir if it matches its files, else None
+        summary = self._subject_summaries.get((group_dir, id))
+        if summary is not None and summary["signature"] == signature:
+            return summary
+        summary = self._read_cached_summary(group_dir, id, signature) if self.cache_dir is not None else None
+        if summary is not None:
+            self._subject_summaries[(group_dir, id)] = summary
+        return summary
+
+    def _subject_summary(self, group_dir, id, epochs=None):
+        """
+        Returns the epoch means of every condition and the baseline statistics of a subject, before normalization.
+
+        The summary is computed from epochs, a dict mapping each condition to the epochs already read into memory, or
+        otherwise in one streaming pass over the memory-mapped files of the subject. It is kept in memory and, with a
+        cache_dir, on disk until the files change.
+        """
+        signature = self._subject_signature(group_dir, id)
+        summary = self._cached_subject_summary(group_dir, id, signature)
+        if summary is not None:
+            return summary
+
+        if epochs is None:
+            epochs = {(demo, gestures): self._load_condition(group_dir, id, demo, gestures, mmap=True) for demo, gestures in CONDITION_FILES}
+        means = {}
+        baseline = [epochs[("BL", gestures)] for gestures in ["NoG", "WiG"]]
+        stats, baseline_sums = _baseline_statistics(baseline)
+        for gestures, data, total in zip(["NoG", "WiG"], baseline, baseline_sums):
+            means[("BL", gestures)] = total / len(data) if len(data) else np.full(data.shape[1:], np.nan)
+        for gestures in ["NoG", "WiG"]:
+            data = epochs[("demo", gestures)]
+            total = np.zeros(data.shape[1:])
+            for chunk in _iter_epoch_chunks(data):
+                total += chunk.sum(axis=0)
+            means[("demo", gestures)] = total / len(data) if len(data) else np.full(data.shape[1:], np.nan)
+        summary = {"means": {key: means[key] for key in CONDITION_FILES}, "stats": stats, "signature": signature}
+        if self.cache_dir is not None and signature is not None:
+            self._write_cached_summary(group_dir, id, summary)
+
+        self._subject_summaries[(group_dir, id)] = summary
+        return summary
+
+    def _normalized_mean(self, group_dir, id, demo, gestures):
+        # Normalization is affine per entry, so the mean of the normalized epochs is the normalized mean
+        summary = self._subject_summary(group_dir, id)
+        offset, scale = _normalization_affine(summary["stats"], self.normalization)
+        return (summary["means"][(demo, gestures)] - offset) / scale
+
+    def _load_lazy_numpy_array(self, group, demo, gestures):
+        return np.array([self._normalized_mean(group, id, demo, gestures) for id in self.subject_ids[group]])
+
+    def _reset_lazy_numpy_arrays(self):
+        # Recompute the averaged arrays of every group from the subject summaries on next access
+        for group in self.subject_ids:
+            for demo in ["BL", "demo"]:
+                self.numpy_arrays[group][demo] = _LazyArrayDict(lambda gestures, group=group, demo=demo: self._load_lazy_numpy_array(group, demo, gestures))
+
+    def get_subject_epochs(self, group, demo, gestures, id):
+        """
+        Loads the (normalized) epochs of a single subject and condition, with the same values as id_dicts in eager mode.
+        """
+        BL_NoG_data, BL_WiG_data, NoG_data, WiG_data = self._load_invidiual_subject(group, id)
+        return {("BL", "NoG"): BL_NoG_data, ("BL", "WiG"): BL_WiG_data, ("demo", "NoG"): NoG_data, ("demo", "WiG"): WiG_data}[(demo, gestures)]
+
+    def load_all_id_dicts(self):
+        # Create a dict of all raw subjects using _load_invidiual_subject()
+        for group_dir, id in self._iter_subject_dirs():
+            try:
+                self._add_subject(group_dir, id)
+            except FileNotFoundError:
+                continue
+
+    def _add_subject(self, group_dir, id):
+        # Load (or reload) a subject into id_dicts, or only register it in lazy mode
+        signature = self._subject_signature(group_dir, id)
+        if not self.lazy:
+            BL_NoG_data, BL_WiG_data, NoG_data, WiG_data = self._load_invidiual_subject(group_dir, id)
+            self.id_dicts[group_dir]["BL"]["NoG"][id] = BL_NoG_data
+            self.id_dicts[group_dir]["demo"]["NoG"][id] = NoG_data
+            self.id_dicts[group_dir]["BL"]["WiG"][id] = BL_WiG_data
+            self.id_dicts[group_dir]["demo"]["WiG"][id] = WiG_data
+        elif id not in self.subject_ids[group_dir]:
+            self.subject_ids[group_dir].append(id)
+        self._signatures[(group_dir, id)] = signature
+
+    def _drop_subject(self, group_dir, id):
+        if not self.lazy:
+            for demo, gestures in CONDITION_FILES:
+                self.id_dicts[group_dir][demo][gestures].pop(id, None)
+        elif id in self.subject_ids[group_dir]:
+            self.subject_ids[group_dir].remove(id)
+        self._signatures.pop((group_dir, id), None)
+        self._subject_summaries.pop((group_dir, id), None)
+
+    def refresh(self):
+        """
+        Loads the subjects whose connectivity files were added or changed since they were loaded and drops the subjects
+        whose files were removed, without reloading any other subject.
+
+        Changes are detected from the size and modification time of the files (or of the packed store). id_dicts,
+        lists and numpy_arrays are updated in place.
+
+        Returns:
+            changes : dict with the "added", "updated" and "removed" lists of (group, id) pairs.
+        """
+        if self.store is not None:
+            # Only the small index arrays are read, the epochs stay memory-mapped
+            self.store = ConnectivityStore(self.directory)
+
+        current = {}
+        for group_dir, id in self._iter_subject_dirs():
+            if all(self._has_condition(group_dir, id, demo, gestures) for demo, gestures in CONDITION_FILES):
+                current[(group_dir, id)] = self._subject_signature(group_dir, id)
+
+        changes = {
+            "added": [key for key in current if key not in self._signatures],
+            "updated": [key for key, signature in current.items() if key in self._signatures and self._signatures[key] != signature],
+            "removed": [key for key in self._signatures if key not in current],
+        }
+        for group_dir, id in changes["removed"]:
+            self._drop_subject(group_dir, id)
+        for group_dir, id in changes["added"] + changes["updated"]:
+            self._add_subject(group_dir, id)
+        self._sort_subjects()
+
+        if any(changes.values()):
+            self._band_averages.clear()
+            if self.lazy:
+                self._reset_lazy_numpy_arrays()
+            else:
+                self.load_all_lists()
+                self.load_all_numpy_arrays()
+        return changes
+
+    def _sort_subjects(self):
+        # Keep added subjects in the sorted order of _iter_subject_dirs
+        if self.lazy:
+            for ids in self.subject_ids.values():
+                ids.sort()
+            return
+        for group in self.id_dicts.values():
+            for demo in group.values():
+                for subjects in demo.values():
+                    items = sorted(subjects.items())
+                    subjects.clear()
+                    subjects.update(items)
+
+    def set_normalization(self, normalize):
+        """
+        Switches to another normalization scheme (see the normalize argument) without reloading any file.
+
+        The epochs in id_dicts are renormalized in place from the cached baseline statistics, and numpy_arrays is
+        recomputed from the cached epoch means of every subject.
+        """
+        normalization = _resolve_normalization(normalize)
+        if not self.lazy:
+            for group_dir, id in self._signatures:
+                stats = self._subject_summary(group_dir, id)["stats"]
+                old_offset, old_scale = _normalization_affine(stats, self.normalization)
+                new_offset, new_scale = _normalization_affine(stats, normalization)
+                # Undo the current normalization and apply the new one as a single multiply-add per entry
+                factor = np.asarray(old_scale / new_scale, dtype=np.float32)
+                shift = np.asarray((old_offset - new_offset) / new_scale, dtype=np.float32)
+                for demo, gestures in CONDITION_FILES:
+                    data = self.id_dicts[group_dir][demo][gestures][id]
+                    data *= factor
+                    data += shift
+
+        self.normalization = normalization
+        self.normalize = normalization is not None
+        self._band_averages.clear()
+        if self.lazy:
+            self._reset_lazy_numpy_arrays()
+        else:
+            self.load_all_numpy_arrays()
 
     def load_all_lists(self):
         for group in self.id_dicts.keys():
@@ -56,78 +446,84 @@ class Dataset:
                     self.lists[group][demo][gestures] = data_as_list
 
     def load_all_numpy_arrays(self):
-        for group in self.lists.keys():
-            for demo in self.lists[group].keys():
-                for gestures in self.lists[group][demo].keys():
-                    averaged_data= []
-                    for subject in self.lists[group][demo][gestures]:
-                        # Average the data for each subject over the first dimension
-                        subject_averaged = np.mean(subject, axis=0)
-                        averaged_data.append(subject_averaged)
-                    self.numpy_arrays[group][demo][gestures] = np.array(averaged_data)
+        for group in self.id_dicts.keys():
+            for demo in self.id_dicts[group].keys():
+                for gestures in self.id_dicts[group][demo].keys():
+                    # Average the data for each subject over the first dimension, from the epoch means cached in float64
+                    ids = list(self.id_dicts[group][demo][gestures].keys())
+                    self.numpy_arrays[group][demo][gestures] = np.array([self._normalized_mean(group, id, demo, gestures) for id in ids])
     
-    def get_frequency_average_bounds(self, group, demo, gestures, min_freq, max_freq):
-        data = self.numpy_arrays[group][demo][gestures]
+    def _build_band_table(self):
+        # Map every band to the index (entropy) or frequency slice (spectral) that selects it, once per Dataset
+        self.band_index = {name: i for i, name in enumerate(self.bands)}
+        if self.entropy_analysis:
+            stored_bands = {bounds: i for i, bounds in enumerate(FREQUENCY_BANDS.values())}
+            unknown = [name for name, bounds in self.bands.items() if tuple(bounds) not in stored_bands]
+            if unknown:
+                raise ValueError(f"Bands {unknown} are not stored in entropy connectivity files, which hold {FREQUENCY_BANDS}")
+            self.band_slices = {name: stored_bands[tuple(bounds)] for name, bounds in self.bands.items()}
+        else:
+            self.band_slices = {name: self._frequency_slice(min_freq, max_freq) for name, (min_freq, max_freq) in self.bands.items()}
+
+    def _frequency_slice(self, min_freq, max_freq):
+        # Frequencies are sorted, so the frequencies within the bounds form a contiguous slice
         frequency_indices = np.where((self.frequencies >= min_freq) & (self.frequencies <= max_freq))[0]
+        if len(frequency_indices) == 0:
+            raise ValueError(f"No frequencies between {min_freq} and {max_freq} Hz")
+        if np.all(np.diff(frequency_indices) == 1):
+            return slice(frequency_indices[0], frequency_indices[-1] + 1)
+        return frequency_indices
 
-        data = data[:, :, :, frequency_indices]
+    def get_band_averages(self, group, demo, gestures):
+        """
+        Returns the band averaged connectivity of a condition, shape (n_subjects, n_electrodes, n_electrodes, n_bands),
+        with bands in the order of self.bands. The array is computed once per condition and cached.
+        """
+        key = (group, demo, gestures)
+        if key not in self._band_averages:
+            data = self.numpy_arrays[group][demo][gestures]
+            if self.entropy_analysis:
+                indices = list(self.band_slices.values())
+                # Entropy files are already averaged per band, so the default bands are served without a copy
+                self._band_averages[key] = data if indices == list(range(data.shape[3])) else data[:, :, :, indices]
+            else:
+                self._band_averages[key] = np.stack([np.mean(data[:, :, :, band_slice], axis=3) for band_slice in self.band_slices.values()], axis=3)
+        return self._band_averages[key]
 
-        return np.mean(data, axis=3)
+    def get_frequency_average_bounds(self, group, demo, gestures, min_freq, max_freq):
+        data = self.numpy_arrays[group][demo][gestures]
+        return np.mean(data[:, :, :, self._frequency_slice(min_freq, max_freq)], axis=3)
     
     def get_subset(self, group, demo, gestures, freq):
         return self.get_frequency_average(group, demo, gestures, freq)
 
     def get_frequency_average(self, group, demo, gestures, freq):
-        # Check if we are doing entropy based analysis, in which case we can directly return the array at the corresponding index without averaging (data is already averaged for each frequency band)
-        if self.entropy_analysis:
-            if freq == "delta":
-                return self.numpy_arrays[group][demo][gestures][:, :, :, 0]
-            if freq == "theta":
-                return self.numpy_arrays[group][demo][gestures][:, :, :, 1]
-            if freq == "low alpha":
-                return self.numpy_arrays[group][demo][gestures][:, :, :, 2]
-            if freq == "high alpha":
-                return self.numpy_arrays[group][demo][gestures][:, :, :, 3]
-            if freq == "low beta":
-                return self.numpy_arrays[group][demo][gestures][:, :, :, 4]
-            if freq == "high beta":
-                return self.numpy_arrays[group][demo][gestures][:, :, :, 5]
-        else:
-            # Explicitly average the data for each frequency band
-            if freq == "delta":
-                return self.get_frequency_average_bounds(group, demo, gestures, 0.5, 4)
-            if freq == "theta":
-                return self.get_frequency_average_bounds(group, demo, gestures, 4, 8)
-            if freq == "low alpha":
-                return self.get_frequency_average_bounds(group, demo, gestures, 8, 10)
-            if freq == "high alpha":
-                return self.get_frequency_average_bounds(group, demo, gestures, 10, 13)
-            if freq == "low beta":
-                return self.get_frequency_average_bounds(group, demo, gestures, 13, 20)
-            if freq == "high beta":
-                return self.get_frequency_average_bounds(group, demo, gestures, 20, 30)
+        # Return a view of the band in the cached band averages
+        if freq not in self.band_index:
+            raise ValueError(f"Unknown frequency band {freq}, expected one of {list(self.bands)}")
+        return self.get_band_averages(group, demo, gestures)[:, :, :, self.band_index[freq]]
     
     def _load_invidiual_subject(self, group_dir, id):
-            path_BL_NoG = os.path.join(self.directory, group_dir, id, f'BL_NoG_connectivity.npy')
-            path_BL_WiG = os.path.join(self.directory, group_dir, id, f'BL_WiG_connectivity.npy')
-            path_NoG = os.path.join(self.directory, group_dir, id, f'NoG_connectivity.npy')
-            path_WiG = os.path.join(self.directory, group_dir, id, f'WiG_connectivity.npy')
-
-            BL_NoG_data = np.load(path_BL_NoG)
-            BL_WiG_data = np.load(path_BL_WiG)
-            NoG_data = np.load(path_NoG)
-            WiG_data = np.load(path_WiG)
-
-            # Perform normalization
-            if self.normalize:
-                all_BL = np.concatenate((BL_NoG_data, BL_WiG_data), axis=0)
-                min = np.min(all_BL, axis=0)
-                max = np.max(all_BL, axis=0)
-
-                BL_NoG_data = (BL_NoG_data - min) / (max - min + 1e-6)
-                BL_WiG_data = (BL_WiG_data - min) / (max - min + 1e-6)
-                NoG_data = (NoG_data - min) / (max - min + 1e-6)
-                WiG_data = (WiG_data - min) / (max - min + 1e-6)
+            if self._cached_subject_summary(group_dir, id, self._subject_signature(group_dir, id)) is None:
+                # Summarize the epochs as they are read, so that the files of the subject are only read once
+                epochs = {(demo, gestures): np.asarray(self._load_condition(group_dir, id, demo, gestures)) for demo, gestures in CONDITION_FILES}
+                summary = self._subject_summary(group_dir, id, epochs)
+                for key in CONDITION_FILES:
+                    epochs[key] = epochs[key].astype(np.float32)
+                BL_NoG_data, BL_WiG_data, NoG_data, WiG_data = [epochs[key] for key in CONDITION_FILES]
+            else:
+                # Read each condition straight into float32, without a float64 copy
+                summary = self._subject_summary(group_dir, id)
+                BL_NoG_data, BL_WiG_data, NoG_data, WiG_data = [np.array(self._load_condition(group_dir, id, demo, gestures, mmap=True), dtype=np.float32)
+                                                                for demo, gestures in CONDITION_FILES]
+
+            # Perform normalization in place with the baseline statistics of the subject
+            if self.normalization is not None:
+                offset, scale = _normalization_affine(summary["stats"], self.normalization)
+                offset, scale = np.asarray(offset, dtype=np.float32), np.asarray(scale, dtype=np.float32)
+                for data in (BL_NoG_data, BL_WiG_data, NoG_data, WiG_data):
+                    data -= offset
+                    data /= scale
 
             return BL_NoG_data, BL_WiG_data, NoG_data, WiG_data
     
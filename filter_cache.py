@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import mne
+import numpy as np
+from instrumentation import stage
+
+# Default upper bound on the total size of the cached signals
+DEFAULT_MAX_BYTES = 20 * 2 ** 30
+
+# Bump when the layout of cache entries changes so that older entries are never read
+CACHE_VERSION = 1
+
+
+class BandFilterCache:
+    """
+    On-disk cache of band-filtered, channel-picked float32 signals derived from processed sessions.
+
+    Every entry is one (session, band) signal of shape (n_channels, n_times), keyed on the source file (path, size and
+    modification time), the band, the picked channels and the MNE version that filtered it. Entries are memory-mapped
+    on read. When the cache grows beyond max_bytes, the least recently used entries are evicted.
+
+    Args:
+        cache_dir: Directory holding the cache entries.
+        max_bytes: Upper bound on the total size of the cached signals.
+    """
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, source_path, l_freq, h_freq, picks):
+        stat = os.stat(source_path)
+        payload = {
+            "version": CACHE_VERSION,
+            "source": os.path.abspath(source_path),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "l_freq": l_freq,
+            "h_freq": h_freq,
+            "picks": list(picks),
+            "mne": mne.__version__,
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key + ".npy")
+
+    def load(self, key):
+        """
+        Returns the memory-mapped signal of an entry and marks it as recently used, or None if it is not cached.
+        """
+        path = self._entry_path(key)
+        try:
+            data = np.load(path, mmap_mode='r')
+        except (FileNotFoundError, ValueError):
+            return None
+        # The modification time of an entry records when it was last used
+        os.utime(path)
+        return data
+
+    def store(self, key, data):
+        # Write to a temporary file first so that readers never see a partially written entry
+        path = self._entry_path(key)
+        tmp_path = path + ".tmp.npy"
+        np.save(tmp_path, np.asarray(data, dtype=np.float32))
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """
+        Deletes the least recently used entries until the cache fits into max_bytes.
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".npy") or name.endswith(".tmp.npy"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def iter_band_filtered(self, raw, source_path, frequency_bands, picks, n_jobs=1):
+        """
+        Cached counterpart of pipeline_utils.iter_band_filtered, restricted to the picked channels.
+
+        Missing bands are filtered from the picked channels of raw, which are loaded from disk only if needed, so raw
+        may be opened with preload=False. The yielded signals are the float32 cached values, identical for cache hits
+        and misses.
+
+        Yields:
+            (band_idx, band_raw) : index into frequency_bands and an MNE Raw object with the picked channels in order,
+            filtered to that band and carrying the annotations of raw.
+        """
+        picked = raw.copy().pick(picks)
+        for band_idx, (lower_bound, upper_bound) in enumerate(frequency_bands):
+            key = self.key(source_path, lower_bound, upper_bound, picks)
+            data = self.load(key)
+            if data is None:
+                with stage("filter", band=band_idx):
+                    if not picked.preload:
+                        picked.load_data()
+                    data = picked.copy().filter(l_freq=lower_bound, h_freq=upper_bound, n_jobs=n_jobs).get_data().astype(np.float32)
+                self.store(key, data)
+
+            with stage("read_filtered", band=band_idx):
+                band_raw = mne.io.RawArray(data, picked.info, first_samp=picked.first_samp, verbose=False)
+                band_raw.set_annotations(raw.annotations)
+            yield band_idx, band_raw
@@ -0,0 +1,118 @@
+import cProfile
+import csv
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:
+    # Peak RSS is not available on Windows
+    resource = None
+
+# Trace that stage() records into, set by tracing(). Stages are no-ops when no trace is active.
+_active_trace = None
+
+CSV_FIELDS = ["stage", "labels", "count", "wall_s", "self_wall_s", "cpu_s", "peak_rss_mb"]
+
+
+def peak_rss_mb():
+    # High-water mark of the resident set size of this process, which ru_maxrss reports in bytes on macOS and KB on Linux
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 2 ** 20 if sys.platform == "darwin" else maxrss / 2 ** 10
+
+
+class Trace:
+    """
+    Accumulates wall time, CPU time and peak RSS per pipeline stage.
+
+    Calls of the same stage with the same labels are summed into one record. Stages may nest: wall_s includes the time
+    of nested stages and self_wall_s excludes it, so the self times of all stages add up to the traced time.
+    """
+    def __init__(self):
+        self.records = {}
+        self._stack = []
+
+    @contextmanager
+    def stage(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._stack.append(0.0)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+            child_wall = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += wall
+
+            record = self.records.setdefault(key, {"stage": name, "labels": dict(labels), "count": 0, "wall_s": 0.0, "self_wall_s": 0.0, "cpu_s": 0.0})
+            record["count"] += 1
+            record["wall_s"] += wall
+            record["self_wall_s"] += wall - child_wall
+            record["cpu_s"] += cpu
+            record["peak_rss_mb"] = peak_rss_mb()
+
+    def write(self, path):
+        """
+        Writes the records to path + ".json" and path + ".csv".
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        records = list(self.records.values())
+        with open(path + ".json", 'w') as f:
+            json.dump({"records": records, "peak_rss_mb": peak_rss_mb()}, f, indent=2)
+        with open(path + ".csv", 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+            writer.writeheader()
+            for record in records:
+                writer.writerow(dict(record, labels=";".join(f"{key}={value}" for key, value in record["labels"].items())))
+
+
+def stage(name, **labels):
+    """
+    Context manager that records a stage (e.g. "read_fif", "filter", "hilbert") in the active trace, if any.
+    """
+    if _active_trace is None:
+        return nullcontext()
+    return _active_trace.stage(name, **labels)
+
+
+@contextmanager
+def tracing(trace_path=None, profile=False):
+    """
+    Records every stage() entered within the block and writes the trace when the block exits.
+
+    Args:
+        trace_path: Path without extension of the JSON and CSV trace. None disables tracing.
+        profile: Also run cProfile over the block and dump its stats to trace_path + ".prof".
+
+    Yields:
+        trace : the active Trace, or None if tracing is disabled.
+    """
+    global _active_trace
+    if trace_path is None:
+        yield None
+        return
+
+    trace = Trace()
+    profiler = cProfile.Profile() if profile else None
+    _active_trace = trace
+    if profiler is not None:
+        profiler.enable()
+    try:
+        with trace.stage("total"):
+            yield trace
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        _active_trace = None
+        trace.write(trace_path)
+        if profiler is not None:
+            profiler.dump_stats(trace_path + ".prof")
+        print("Saved stage trace to: ", trace_path + ".json")
@@ -0,0 +1,20 @@
+import argparse
+import numpy as np
+from connectivity_store import pack_store
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description="Pack a directory of per-subject connectivity files into a single .npz store that Dataset can read directly")
+    parser.add_argument('connectivity_dir', type=str, help='Connectivity directory, e.g. data/connectivity_scores_entropy_5s')
+    parser.add_argument('out_path', type=str, help='Path of the .npz store to write')
+    parser.add_argument("--dtype", help="Data type of the packed epochs", default="float32", choices=["float32", "float64"])
+
+    # Parse arguments
+    args = parser.parse_args()
+    out_path = args.out_path if args.out_path.endswith(".npz") else args.out_path + ".npz"
+
+    n_entries = pack_store(args.connectivity_dir, out_path, dtype=np.dtype(args.dtype))
+    print(f"Packed {n_entries} connectivity files into {out_path}")
+
+if __name__ == '__main__':
+    main()
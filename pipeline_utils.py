@@ -0,0 +1,376 @@
+import mne
+import numpy as np
+import os
+from instrumentation import stage
+from connectivity_store import ELECTRODE_NAMES_FILE
+
+# Frequency bands studied by the entropy analysis: delta, theta, low alpha, high alpha, low beta and high beta
+FREQUENCY_BANDS = [(0.5, 4.0), (4.0, 8.0), (8.0, 10.0), (10.0, 13.0), (13.0, 20.0), (20.0, 30.0)]
+
+# Electrodes of interest: F3 (5),Fz (6),F4 (7),FCz (42),Cz (16),CP3 (48),CP4 (49),P1 (51),Pz (26),P2 (52),PPO1 (92) and PPO2 (93)
+ELECTRODES_OF_INTEREST = ["F3", "Fz", "F4", "FCz", "Cz", "CP3", "CP4", "P1", "Pz", "P2", "PPO1", "PPO2"]
+
+# Named electrode sets that can be selected instead of a list of electrodes. "eeg" selects every EEG channel.
+ELECTRODE_SETS = {
+    "interest": ELECTRODES_OF_INTEREST,
+    "midline": ["Fz", "FCz", "Cz", "Pz"],
+}
+
+# Seconds ignored at the beginning and at the end of every annotated event
+EVENT_START_TRIM = 2
+EVENT_END_TRIM = 1
+
+
+# Types of the channels of the raw recordings that are not EEG electrodes
+NON_EEG_CHANNEL_TYPES = {
+    'HEOGR': 'eog',
+    'HEOGL': 'eog',
+    'VEOGU': 'eog',
+    'VEOGL': 'eog',
+    'ECG': 'ecg',
+    'M1': 'misc',
+    'M2': 'misc',
+}
+
+# Sessions recorded for each participant
+SESSIONS = range(1, 5)
+
+# (baseline, with_gestures) combinations that make up the four connectivity conditions
+CONDITIONS = [(True, False), (True, True), (False, False), (False, True)]
+
+
+# Environment variables read by the BLAS and OpenMP libraries that numpy, scipy and scikit-learn may be linked against
+BLAS_THREAD_VARIABLES = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS"]
+
+
+def limit_blas_threads(n_threads):
+    """
+    Caps the threads of the BLAS and OpenMP libraries of the current process, e.g. in the initializer of a pool worker
+    so that n_workers * n_threads does not oversubscribe the CPUs.
+
+    Libraries that are already loaded are limited through threadpoolctl if it is installed. The environment variables
+    cover libraries loaded later and child processes.
+    """
+    for variable in BLAS_THREAD_VARIABLES:
+        os.environ[variable] = str(n_threads)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(limits=n_threads)
+
+
+def eeglab_session_path(root_dir, expert, subject_id, session):
+    # EEGLAB export of a recording, whose data is in the .fdt file of the same name
+    return os.path.join(root_dir, 'raw', expert, subject_id, f'{session}.set')
+
+
+def raw_session_path(root_dir, expert, subject_id, session):
+    return os.path.join(root_dir, 'raw', expert, subject_id, f'{session}_raw.fif')
+
+
+def preprocessed_session_path(root_dir, expert, subject_id, session):
+    return os.path.join(root_dir, 'preprocessed', expert, subject_id, f'{session}_raw.fif')
+
+
+def ica_path(root_dir, expert, subject_id, session, num_ica_comps):
+    return os.path.join(root_dir, 'ica', expert, subject_id, f'{session}_{num_ica_comps}_ica.fif')
+
+
+def processed_session_path(root_dir, expert, subject_id, session, num_ica_comps):
+    return os.path.join(root_dir, 'processed', expert, subject_id, f'{session}_{num_ica_comps}_raw.fif')
+
+
+def existing_processed_session_paths(root_dir, expert, subject_id, num_ica_comps):
+    # Processed sessions that exist on disk for a participant, in session order
+    paths = [processed_session_path(root_dir, expert, subject_id, session, num_ica_comps) for session in SESSIONS]
+    return [path for path in paths if os.path.exists(path)]
+
+
+def working_copy_path(root_dir, expert, subject_id, session, num_ica_comps):
+    # Decimated float32 copy of a processed session written by working_copy.py
+    return os.path.join(root_dir, 'working', expert, subject_id, f'{session}_{num_ica_comps}_raw.npz')
+
+
+def existing_working_copy_paths(root_dir, expert, subject_id, num_ica_comps):
+    # Working copies that exist on disk for a participant, in session order
+    paths = [working_copy_path(root_dir, expert, subject_id, session, num_ica_comps) for session in SESSIONS]
+    return [path for path in paths if os.path.exists(path)]
+
+
+def condition_prefix(baseline, with_gestures):
+    # Build the output filename prefix, e.g. "BL_WiG_" or "NoG_"
+    prefix = ""
+    if baseline:
+        prefix += "BL_"
+    if with_gestures:
+        prefix += "WiG_"
+    else:
+        prefix += "NoG_"
+    return prefix
+
+
+def connectivity_output_path(root_dir, dir_suffix, expert, subject_id, baseline, with_gestures):
+    return os.path.join(root_dir, 'connectivity_scores' + dir_suffix, expert, subject_id, condition_prefix(baseline, with_gestures) + "connectivity.npy")
+
+
+def metric_dir_suffix(dir_suffix, metric):
+    # Entropy outputs keep the plain connectivity directory, other phase synchrony metrics get their own, e.g. "_5s_plv"
+    return dir_suffix if metric == "entropy" else f"{dir_suffix}_{metric}"
+
+
+def mean_output_path(out_path):
+    # Path of the per-subject mean over epochs saved next to a connectivity output, e.g. "NoG_connectivity_mean.npy"
+    return os.path.splitext(out_path)[0] + "_mean.npy"
+
+
+class NpyStreamWriter:
+    """
+    Writes an .npy file by appending blocks along the first axis, for results whose length is not known up front.
+
+    Space for the header is reserved when the file is opened and the final shape is written into it on close, so the
+    blocks never have to be held in memory together. The file is written under a temporary name and only moved to
+    out_path once complete, after which it can be memory-mapped with np.load(out_path, mmap_mode='r').
+
+    Blocks are stored with the dtype of the first block, e.g. complex connectivity, unless a dtype is given.
+    """
+    # Bytes reserved for the npy header, a multiple of 64 that fits the header of any 4D float or complex array
+    HEADER_SIZE = 256
+
+    def __init__(self, out_path, dtype=None):
+        self.out_path = out_path
+        self.tmp_path = out_path + ".tmp"
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.item_shape = None
+        self.length = 0
+        self._file = open(self.tmp_path, 'wb')
+        self._file.write(b'\0' * self.HEADER_SIZE)
+
+    def append(self, block):
+        if self.dtype is None:
+            self.dtype = np.asarray(block).dtype
+        block = np.ascontiguousarray(block, dtype=self.dtype)
+        if self.item_shape is None:
+            self.item_shape = block.shape[1:]
+        elif block.shape[1:] != self.item_shape:
+            raise ValueError(f"Block shape {block.shape[1:]} does not match previous blocks {self.item_shape}")
+        self._file.write(block.tobytes())
+        self.length += len(block)
+
+    def _header(self):
+        shape = (self.length,) + tuple(self.item_shape or ())
+        dtype = self.dtype if self.dtype is not None else np.dtype(np.float64)
+        header = repr({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': shape}).encode('latin1')
+        # Magic string, version 1.0 and the little endian header length, then the header padded with spaces
+        prefix = np.lib.format.magic(1, 0) + (self.HEADER_SIZE - 10).to_bytes(2, 'little')
+        return prefix + header + b' ' * (self.HEADER_SIZE - len(prefix) - len(header) - 1) + b'\n'
+
+    def close(self):
+        self._file.seek(0)
+        self._file.write(self._header())
+        self._file.close()
+        os.replace(self.tmp_path, self.out_path)
+
+    def abort(self):
+        # Discard a partially written file
+        self._file.close()
+        os.remove(self.tmp_path)
+
+
+def resolve_electrodes(electrodes):
+    """
+    Resolves a named electrode set or a list of electrode names.
+
+    Returns:
+        electrodes : list of electrode names, or "eeg" for every EEG channel of a recording.
+    """
+    if isinstance(electrodes, str):
+        if electrodes == "eeg":
+            return electrodes
+        if electrodes not in ELECTRODE_SETS:
+            raise ValueError(f"Unknown electrode set {electrodes}, expected a list of electrodes, 'eeg' or one of {list(ELECTRODE_SETS)}")
+        return list(ELECTRODE_SETS[electrodes])
+    return list(electrodes)
+
+
+def parse_electrodes(values):
+    # Interpret the values of an --electrodes command line argument as a single named set or a list of electrodes
+    if len(values) == 1 and (values[0] == "eeg" or values[0] in ELECTRODE_SETS):
+        return values[0]
+    return values
+
+
+def pick_electrodes(raw, electrodes):
+    """
+    Restricts a Raw object in place to a named electrode set or a list of electrodes, in the order given.
+    """
+    with stage("pick"):
+        electrodes = resolve_electrodes(electrodes)
+        return raw.pick("eeg" if electrodes == "eeg" else electrodes)
+
+
+def connectivity_electrodes_path(root_dir, dir_suffix):
+    # Electrode names of the rows and columns of every connectivity matrix in a connectivity directory
+    return os.path.join(root_dir, 'connectivity_scores' + dir_suffix, ELECTRODE_NAMES_FILE)
+
+
+def save_connectivity_electrodes(root_dir, dir_suffix, ch_names):
+    # Several subjects may be computed at once, so write to a process specific temporary file and move it into place
+    out_path = connectivity_electrodes_path(root_dir, dir_suffix)
+    tmp_path = f"{out_path}.{os.getpid()}.tmp.npy"
+    np.save(tmp_path, np.array(ch_names))
+    os.replace(tmp_path, out_path)
+
+
+def load_processed_session(root_dir, expert, subject_id, session, num_ica_comps, preload=True, electrodes=None):
+    """
+    Loads a processed session into memory exactly once.
+
+    Args:
+        preload: If False, only the header and annotations are read and the data is left on disk.
+        electrodes: Optional named electrode set or list of electrodes to pick right after opening the file, so that
+            only those channels are read, filtered and epoched. See pick_electrodes.
+
+    Returns:
+        raw : MNE Raw object, or None if the session file is missing.
+    """
+    in_path = processed_session_path(root_dir, expert, subject_id, session, num_ica_comps)
+    try:
+        with stage("read_fif", session=session):
+            if electrodes is None:
+                return mne.io.read_raw_fif(in_path, preload=preload)
+            raw = pick_electrodes(mne.io.read_raw_fif(in_path, preload=False), electrodes)
+            return raw.load_data() if preload else raw
+    except FileNotFoundError:
+        print("Skipping session ", session, " due to missing file")
+        return None
+
+
+def _annotation_start_times(raw):
+    # Map every annotation description to its onset
+    start_times = {}
+    for annot in raw.annotations:
+        start_times[annot["description"]] = annot["onset"]
+    return start_times
+
+
+def _select_windows(start_times, baseline, with_gestures):
+    # Create a beg_keys sub list that includes only the start_times keys with the string "beg" somewhere inside
+    beg_keys = [key for key in start_times.keys() if "beg" in key]
+
+    # Isolate only the events corresponding to the correct gesture/no gesture condition
+    filter_string = "WiG" if with_gestures else "NoG"
+    beg_keys = [key for key in beg_keys if filter_string in key]
+
+    # Isolate only the events corresponding to the correct baseline/no baseline condition
+    if baseline:
+        # Remove keys missing "BL"
+        beg_keys = [key for key in beg_keys if "BL" in key]
+    else:
+        # Remove keys containing "BL"
+        beg_keys = [key for key in beg_keys if "BL" not in key]
+
+    # Identify the corresponding end_keys for each beg_key by replacing "beg" with "end" and grabbing that key from start_times
+    end_keys = [key.replace("beg", "end") for key in beg_keys]
+    # Drop any end_keys that are not in start_times
+    end_keys = [key for key in end_keys if key in start_times]
+    # Create tuple pairs
+    annotations_of_interest = list(zip(beg_keys, end_keys))
+    print("annotations of interest: ", annotations_of_interest)
+
+    # Ignore the first two seconds and the last second of each event
+    return [(start_times[beg] + EVENT_START_TRIM, start_times[end] - EVENT_END_TRIM) for beg, end in annotations_of_interest]
+
+
+def find_annotation_windows(raw, baseline, with_gestures):
+    """
+    Parses the annotations of a session and returns the time windows of the requested condition.
+
+    Args:
+        raw: MNE Raw object whose annotations mark the beginning and end of each event.
+        baseline: Whether to select baseline (BL) events.
+        with_gestures: Whether to select events with (WiG) or without (NoG) gestures.
+
+    Returns:
+        windows : list of (start, end) tuples in seconds, already trimmed by EVENT_START_TRIM and EVENT_END_TRIM.
+    """
+    return _select_windows(_annotation_start_times(raw), baseline, with_gestures)
+
+
+def find_condition_windows(raw, conditions=CONDITIONS):
+    """
+    Partitions the annotations of a session into the windows of several conditions with a single parse.
+
+    Args:
+        raw: MNE Raw object whose annotations mark the beginning and end of each event.
+        conditions: (baseline, with_gestures) tuples to select windows for.
+
+    Returns:
+        windows : dict mapping each condition to its list of (start, end) tuples, as in find_annotation_windows.
+    """
+    start_times = _annotation_start_times(raw)
+    return {condition: _select_windows(start_times, *condition) for condition in conditions}
+
+
+def window_epochs(raw, start, end, duration, overlap):
+    """
+    Cuts one annotation window of a loaded session into fixed length epochs without copying the recording.
+
+    Gives the epochs of mne.make_fixed_length_epochs(raw.copy().crop(tmin=start, tmax=end), duration=duration,
+    overlap=overlap, preload=True), including the rejection of epochs that overlap BAD annotations, as a strided view
+    of the loaded buffer instead of a cropped copy. Projections are not applied again, since processed sessions only
+    carry projections that were already applied to the data.
+
+    Returns:
+        epochs : read-only array of shape (n_epochs, n_channels, n_times), a view of the buffer of raw when the epochs
+        are evenly spaced.
+    """
+    sfreq = raw.info["sfreq"]
+    # Samples kept by raw.crop(tmin=start, tmax=end)
+    first, last = np.clip(raw.time_as_index([start, end], use_rounding=True), 0, raw.n_times - 1)
+    n_times = int(np.round(sfreq * duration))
+
+    # Epoch onsets as placed by mne.make_fixed_length_events on the cropped recording, relative to the start of raw
+    first_samp = raw.first_samp + first
+    onsets = np.arange(first_samp, first_samp + last - first + 1 - n_times + 1, sfreq * (duration - overlap)).astype(int) - raw.first_samp
+    if len(onsets) == 0:
+        raise ValueError("No events produced, check the values of start, stop, and duration")
+
+    # Drop the epochs that overlap a BAD annotation, as reject_by_annotation does
+    bad = np.array([description.lower().startswith("bad") for description in raw.annotations.description], dtype=bool)
+    if bad.any():
+        bad_onsets = raw.annotations.onset[bad] - raw.first_time
+        bad_offsets = bad_onsets + raw.annotations.duration[bad]
+        overlaps = (bad_onsets < (onsets[:, None] + n_times) / sfreq) & (bad_offsets > onsets[:, None] / sfreq)
+        onsets = onsets[~overlaps.any(axis=1)]
+
+    # MNE's get_data() returns a copy, so window the preloaded buffer directly
+    epochs = np.lib.stride_tricks.sliding_window_view(raw._data, n_times, axis=1).transpose(1, 0, 2)
+    steps = np.unique(np.diff(onsets))
+    if len(onsets) > 0 and len(steps) <= 1:
+        return epochs[onsets[0]:onsets[-1] + 1:int(steps[0]) if len(steps) else 1]
+    return epochs[onsets]
+
+
+def trace_path(trace_dir, expert, subject_id, conditions):
+    # Path without extension of the stage trace of one connectivity run, e.g. "<trace_dir>/expert_3_BL_NoG-WiG"
+    if trace_dir is None:
+        return None
+    condition_names = "-".join(condition_prefix(*condition).rstrip("_") for condition in conditions)
+    return os.path.join(trace_dir, f"{expert}_{subject_id}_{condition_names}")
+
+
+def iter_band_filtered(raw, frequency_bands, n_jobs=1):
+    """
+    Derives one band-filtered signal per frequency band from a single loaded session.
+
+    The loaded buffer is never modified, so every band is filtered from the same unfiltered data without re-reading
+    the file from disk. n_jobs is passed to MNE, which filters the channels in parallel.
+
+    Yields:
+        (band_idx, band_raw) : index into frequency_bands and an MNE Raw object filtered to that band.
+    """
+    for band_idx, (lower_bound, upper_bound) in enumerate(frequency_bands):
+        with stage("filter", band=band_idx):
+            band_raw = raw.copy().filter(l_freq=lower_bound, h_freq=upper_bound, n_jobs=n_jobs)
+        yield band_idx, band_raw
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+
+# Bump when the manifest layout changes so that older manifests are treated as stale
+MANIFEST_VERSION = 1
+MANIFEST_SUFFIX = ".manifest.json"
+
+# Output version of results whose stage does not give one, and of manifests written before output versions were recorded.
+# Every stage passes its own OUTPUT_VERSION, which it bumps when the meaning of its outputs changes.
+DEFAULT_OUTPUT_VERSION = 1
+
+# Size of the blocks read while hashing input files
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def manifest_path(out_path):
+    return out_path + MANIFEST_SUFFIX
+
+
+def file_digest(path):
+    """
+    Computes the sha256 digest of a file, reading it in blocks so that large recordings are never fully in memory.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _file_stat(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _input_digests(input_paths, previous_inputs=None):
+    # Hash every input, reusing the digest recorded in a previous manifest when size and mtime are unchanged
+    previous_inputs = previous_inputs or {}
+    inputs = {}
+    for path in sorted(input_paths):
+        key = os.path.abspath(path)
+        stat = _file_stat(path)
+        previous = previous_inputs.get(key)
+        if previous is not None and previous["size"] == stat["size"] and previous["mtime_ns"] == stat["mtime_ns"]:
+            inputs[key] = previous
+        else:
+            inputs[key] = dict(stat, sha256=file_digest(path))
+    return inputs
+
+
+def cache_key(inputs, params):
+    """
+    Builds the content address of a result from the digests of its inputs and the parameters that produced it.
+    """
+    payload = {
+        "inputs": sorted(entry["sha256"] for entry in inputs.values()),
+        "params": params,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _read_manifest(out_path):
+    try:
+        with open(manifest_path(out_path)) as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def is_current(out_path, input_paths, params, output_version=DEFAULT_OUTPUT_VERSION):
+    """
+    Checks whether out_path was produced from the current content of input_paths with the same params and the same
+    version of the code that writes it.
+
+    Args:
+        out_path: Path of the cached result.
+        input_paths: Files the result was computed from. Missing files make the result stale.
+        params: JSON serializable dict of every parameter that affects the result.
+        output_version: Version of the stage's outputs. Results written by another version are stale.
+
+    Returns:
+        current : True if the result can be reused without recomputation.
+    """
+    if not os.path.exists(out_path):
+        return False
+    manifest = _read_manifest(out_path)
+    if manifest is None:
+        return False
+    if manifest.get("output_version", DEFAULT_OUTPUT_VERSION) != output_version:
+        return False
+    if not all(os.path.exists(path) for path in input_paths):
+        return False
+    # Different input sets can never be current, so avoid hashing in that case
+    if sorted(os.path.abspath(path) for path in input_paths) != sorted(manifest["inputs"]):
+        return False
+    inputs = _input_digests(input_paths, manifest["inputs"])
+    if cache_key(inputs, params) != manifest["key"]:
+        return False
+    # Record the new stats of inputs that were touched but not changed, so the next check does not hash them again
+    if inputs != manifest["inputs"]:
+        _write(out_path, inputs, params, output_version)
+    return True
+
+
+def write_manifest(out_path, input_paths, params, output_version=DEFAULT_OUTPUT_VERSION):
+    """
+    Records the inputs, params and output version of a freshly written result next to it.
+    """
+    previous = _read_manifest(out_path)
+    inputs = _input_digests(input_paths, previous["inputs"] if previous is not None else None)
+    _write(out_path, inputs, params, output_version)
+
+
+def _write(out_path, inputs, params, output_version):
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "output_version": output_version,
+        "key": cache_key(inputs, params),
+        "output": os.path.basename(out_path),
+        "params": params,
+        "inputs": inputs,
+    }
+    # Write to a temporary file first so an interrupted run never leaves a half written manifest behind
+    tmp_path = manifest_path(out_path) + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True, default=str)
+    os.replace(tmp_path, manifest_path(out_path))
@@ -0,0 +1,275 @@
+import argparse
+import importlib
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from pipeline_utils import ELECTRODE_SETS, SESSIONS, CONDITIONS, raw_session_path, preprocessed_session_path, ica_path, processed_session_path, working_copy_path, connectivity_output_path, metric_dir_suffix, parse_electrodes, limit_blas_threads
+from working_copy import working_copy_dir_suffix
+
+# Stage scripts that the batch driver can call into. They are imported once per worker process.
+STAGE_MODULES = ["1_preproc", "1_fit_ica", "working_copy", "3_compute_connectivity_entropy", "3_compute_connectivity_mne"]
+CONNECTIVITY_MODULES = {"entropy": "3_compute_connectivity_entropy", "mne": "3_compute_connectivity_mne"}
+GROUPS = ["expert", "novice"]
+
+_stages = {}
+
+def _init_worker(blas_threads=None):
+    # Import MNE and every stage module exactly once per worker process
+    if blas_threads is not None:
+        limit_blas_threads(blas_threads)
+    import mne
+    mne.set_log_level("WARNING")
+    for module_name in STAGE_MODULES:
+        _stages[module_name] = importlib.import_module(module_name)
+
+def _run_task(module_name, func_name, kwargs):
+    if not _stages:
+        _init_worker()
+    if module_name not in _stages:
+        _stages[module_name] = importlib.import_module(module_name)
+    # Results (e.g. Raw objects) are written to disk by the stage itself and are not sent back to the parent process
+    getattr(_stages[module_name], func_name)(**kwargs)
+
+
+class Task:
+    """
+    A single unit of work in the pipeline task graph.
+
+    Args:
+        name: Unique name of the task, used for dependencies and logging.
+        module_name: Stage module containing the function to call.
+        func_name: Name of the function to call in the stage module.
+        kwargs: Keyword arguments passed to the function.
+        inputs: Files read by the task.
+        outputs: Files written by the task.
+        deps: Names of tasks that must finish before this one starts.
+        cached: Whether the stage checks its own content-addressed cache, in which case it is always dispatched.
+    """
+    def __init__(self, name, module_name, func_name, kwargs, inputs, outputs, deps=(), cached=False):
+        self.name = name
+        self.module_name = module_name
+        self.func_name = func_name
+        self.kwargs = kwargs
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.deps = list(deps)
+        self.cached = cached
+        self.attempts = 0
+
+    def is_up_to_date(self):
+        # Stages with a result cache compare input hashes and parameters themselves, which mtimes cannot capture
+        if self.cached:
+            return False
+        # A task is up to date when all of its outputs exist and are newer than all of its inputs
+        if not all(os.path.exists(path) for path in self.outputs):
+            return False
+        if not all(os.path.exists(path) for path in self.inputs):
+            return False
+        newest_input = max((os.path.getmtime(path) for path in self.inputs), default=0)
+        oldest_output = min(os.path.getmtime(path) for path in self.outputs)
+        return oldest_output >= newest_input
+
+
+def discover_subjects(root_dir):
+    """
+    Finds every (group, subject_id) with data in the raw or processed directories.
+    """
+    subjects = set()
+    for stage_dir in ['raw', 'processed']:
+        for group in GROUPS:
+            group_dir = os.path.join(root_dir, stage_dir, group)
+            if not os.path.isdir(group_dir):
+                continue
+            for subject_id in os.listdir(group_dir):
+                if os.path.isdir(os.path.join(group_dir, subject_id)):
+                    subjects.add((group, subject_id))
+    return sorted(subjects)
+
+
+def build_task_graph(root_dir, num_ica_comps=0.9999, method="entropy", dir_suffix="", stages=("preproc", "ica", "connectivity"), connectivity_kwargs=None, force=False):
+    """
+    Builds the preproc -> ICA fit -> connectivity task graph for all subjects under root_dir.
+
+    Connectivity is one task per subject that writes all four BL/WiG condition outputs.
+
+    Bad channel marking (0_mark_bads.py) and ICA component selection (2_select_ica.py) are interactive and are not
+    scheduled. Connectivity tasks are built for every subject that already has processed sessions.
+
+    Args:
+        force: Refit ICAs that are up to date. ICA tasks check their own manifests, since mtimes cannot tell whether
+            an ICA was fitted with the same parameters.
+
+    With working_copies set in connectivity_kwargs, a working_copy.py task is scheduled for every processed session
+    and the connectivity task of the subject reads the working copies once they are written.
+
+    Returns:
+        tasks : list of Task objects in dependency order.
+    """
+    connectivity_kwargs = connectivity_kwargs or {}
+    tasks = []
+
+    for group, subject_id in discover_subjects(root_dir):
+        for session in SESSIONS:
+            raw_path = raw_session_path(root_dir, group, subject_id, session)
+            if not os.path.exists(raw_path):
+                continue
+            preproc_name = f"preproc/{group}/{subject_id}/{session}"
+            preprocessed_path = preprocessed_session_path(root_dir, group, subject_id, session)
+            session_kwargs = dict(root_dir=root_dir, expert=group, subject_id=subject_id, session=session)
+            if "preproc" in stages:
+                tasks.append(Task(preproc_name, "1_preproc", "preprocess", session_kwargs, [raw_path], [preprocessed_path]))
+            if "ica" in stages:
+                deps = [preproc_name] if "preproc" in stages else []
+                tasks.append(Task(f"ica/{group}/{subject_id}/{session}", "1_fit_ica", "fit_ica", dict(session_kwargs, num_ica_comps=num_ica_comps, force=force),
+                                  [preprocessed_path], [ica_path(root_dir, group, subject_id, session, num_ica_comps)], deps, cached=True))
+
+        if "connectivity" not in stages:
+            continue
+
+        # Connectivity is computed from the manually cleaned sessions written by 2_select_ica.py
+        processed_paths = [processed_session_path(root_dir, group, subject_id, session, num_ica_comps) for session in SESSIONS]
+        processed_paths = [path for path in processed_paths if os.path.exists(path)]
+        if len(processed_paths) == 0:
+            print(f"No processed sessions for {group} {subject_id}, skipping connectivity until 2_select_ica.py has been run")
+            continue
+
+        # Write the decimated working copies of the processed sessions first if the connectivity task reads them
+        input_paths, deps = processed_paths, []
+        if connectivity_kwargs.get("working_copies"):
+            input_paths = []
+            for session in SESSIONS:
+                processed_path = processed_session_path(root_dir, group, subject_id, session, num_ica_comps)
+                if not os.path.exists(processed_path):
+                    continue
+                working_name = f"working_copy/{group}/{subject_id}/{session}"
+                input_paths.append(working_copy_path(root_dir, group, subject_id, session, num_ica_comps))
+                tasks.append(Task(working_name, "working_copy", "write_working_copy",
+                                  dict(root_dir=root_dir, expert=group, subject_id=subject_id, session=session, num_ica_comps=num_ica_comps,
+                                       electrodes=connectivity_kwargs.get("electrodes", "interest"), force=force),
+                                  [processed_path], [input_paths[-1]], cached=True))
+                deps.append(working_name)
+
+        # All four conditions are computed in a single pass over the subject's sessions, from the working copies into
+        # their own directory (the copies are written at the default rate)
+        output_suffix = working_copy_dir_suffix(dir_suffix) if connectivity_kwargs.get("working_copies") else dir_suffix
+        metric_suffixes = [metric_dir_suffix(output_suffix, metric) for metric in connectivity_kwargs.get("metrics", ["entropy"])]
+        out_paths = [connectivity_output_path(root_dir, suffix, group, subject_id, *condition) for suffix in metric_suffixes for condition in CONDITIONS]
+        kwargs = dict(connectivity_kwargs, root_dir=root_dir, expert=group, subject_id=subject_id, conditions=CONDITIONS,
+                      num_ica_comps=num_ica_comps, dir_suffix=dir_suffix)
+        tasks.append(Task(f"connectivity/{group}/{subject_id}", CONNECTIVITY_MODULES[method], "compute_conditions", kwargs, input_paths, out_paths, deps, cached=True))
+
+    return tasks
+
+
+def run_tasks(tasks, n_workers=None, retries=1, force=False, blas_threads=None):
+    """
+    Runs a task graph on a process pool, retrying failed tasks and skipping tasks whose outputs are up to date.
+
+    Args:
+        blas_threads: Optional number of BLAS threads of every worker process.
+
+    Returns:
+        (completed, skipped, failed) : lists of task names.
+    """
+    pending = {task.name: task for task in tasks}
+    completed, skipped, failed = [], [], []
+    finished = set()
+    running = {}
+
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(blas_threads,)) as pool:
+        while pending or running:
+            # Submit every task whose dependencies have finished
+            for name, task in list(pending.items()):
+                if any(dep in failed for dep in task.deps):
+                    print(f"Not running {name} because a dependency failed")
+                    failed.append(name)
+                    del pending[name]
+                    continue
+                if not all(dep in finished for dep in task.deps):
+                    continue
+                del pending[name]
+                if not force and task.is_up_to_date():
+                    skipped.append(name)
+                    finished.add(name)
+                    continue
+                task.attempts += 1
+                running[pool.submit(_run_task, task.module_name, task.func_name, task.kwargs)] = task
+
+            if not running:
+                # Anything still pending depends on a task that is not part of the graph
+                if pending and not any(all(dep in finished for dep in task.deps) for task in pending.values()):
+                    failed.extend(pending)
+                    pending.clear()
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                try:
+                    future.result()
+                except Exception:
+                    print(f"Task {task.name} failed (attempt {task.attempts} of {retries + 1}):")
+                    traceback.print_exc()
+                    if task.attempts <= retries:
+                        pending[task.name] = task
+                    else:
+                        failed.append(task.name)
+                    continue
+                print(f"Finished {task.name}")
+                completed.append(task.name)
+                finished.add(task.name)
+
+    return completed, skipped, failed
+
+
+def main():
+    # Metrics offered by the entropy script, so that new metrics are available here without listing them twice
+    entropy_metrics = list(importlib.import_module(CONNECTIVITY_MODULES["entropy"]).METRICS)
+
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description="Run the preprocessing, ICA fitting and connectivity stages for every subject in parallel")
+    parser.add_argument('--root_dir', type=str, default="/Volumes/eeg", help='Root directory of the data')
+    parser.add_argument("--num_ica_comps", help="Number of ICA components", default=0.9999, type=float)
+    parser.add_argument("--dir_suffix", help="Suffix for the connectivity directory", default="", type=str)
+    parser.add_argument("--method", help="Connectivity script to run", default="entropy", choices=sorted(CONNECTIVITY_MODULES))
+    parser.add_argument("--stages", help="Stages to run", nargs="+", default=["preproc", "ica", "connectivity"], choices=["preproc", "ica", "connectivity"])
+    parser.add_argument("--n_workers", help="Number of worker processes", default=os.cpu_count(), type=int)
+    parser.add_argument("--blas_threads", help="Number of BLAS threads per worker process, e.g. to share the CPUs between ICA fits", default=None, type=int)
+    parser.add_argument("--retries", help="Number of times a failed task is retried", default=1, type=int)
+    parser.add_argument("--force", help="Rerun tasks even if their outputs are up to date", action="store_true")
+    parser.add_argument("--epoch_duration", help="Duration of each epoch in seconds (entropy method)", default=5.0, type=float)
+    parser.add_argument("--epoch_overlap", help="Overlap between epochs in seconds (entropy method)", default=2.5, type=float)
+    parser.add_argument("--trace_dir", help="Write a JSON and CSV stage trace of every connectivity task to this directory", default=None, type=str)
+    parser.add_argument("--profile", help="Also dump cProfile stats next to each trace", action="store_true")
+    parser.add_argument("--n_jobs", help="Number of processes used by each connectivity task", default=1, type=int)
+    parser.add_argument("--filter_cache", help="Directory to cache band-filtered signals in (entropy method)", default=None, type=str)
+    parser.add_argument("--metrics", help="Phase synchrony metrics to compute (entropy method), coherency being the amplitude weighted phase locking value",
+                        nargs="+", default=["entropy"], choices=entropy_metrics)
+    parser.add_argument("--electrodes", help=f"Electrodes to compute connectivity between: one of {list(ELECTRODE_SETS)}, 'eeg' for all EEG channels, or a list of electrode names",
+                        nargs="+", default=["interest"])
+    parser.add_argument("--working_copies", help="Write decimated working copies of the processed sessions and compute connectivity from them", action="store_true")
+    parser.add_argument("--chunk_size", help="Stream epochs to disk in chunks of this many epochs (mne method)", default=None, type=int)
+    parser.add_argument("--running_mean", help="Also save the mean over epochs of each condition (mne method)", action="store_true")
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    connectivity_kwargs = dict(force=args.force, n_jobs=args.n_jobs, trace_dir=args.trace_dir, profile=args.profile,
+                               electrodes=parse_electrodes(args.electrodes), working_copies=args.working_copies)
+    if args.method == "entropy":
+        connectivity_kwargs.update(epoch_duration=args.epoch_duration, epoch_overlap=args.epoch_overlap, metrics=args.metrics,
+                                   filter_cache_dir=args.filter_cache)
+    else:
+        connectivity_kwargs.update(chunk_size=args.chunk_size, running_mean=args.running_mean)
+
+    tasks = build_task_graph(args.root_dir, num_ica_comps=args.num_ica_comps, method=args.method, dir_suffix=args.dir_suffix,
+                             stages=args.stages, connectivity_kwargs=connectivity_kwargs, force=args.force)
+    print(f"Built {len(tasks)} tasks")
+
+    completed, skipped, failed = run_tasks(tasks, n_workers=args.n_workers, retries=args.retries, force=args.force, blas_threads=args.blas_threads)
+    print(f"Completed {len(completed)} tasks, skipped {len(skipped)} up to date tasks, {len(failed)} tasks failed")
+    for name in failed:
+        print("Failed: ", name)
+
+if __name__ == '__main__':
+    main()
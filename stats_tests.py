@@ -1,88 +1,93 @@
 import numpy as np
-import pingouin as pg
-import pandas as pd
+import os
+from concurrent.futures import ProcessPoolExecutor
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.stats import f as f_dist
 from statsmodels.stats.multitest import multipletests
 
+# Order of the effects returned by mixed_anova_2x2
+MIXED_ANOVA_EFFECTS = ("group", "condition", "interaction")
+
+def mixed_anova_2x2(group_A_condition_1, group_A_condition_2, group_B_condition_1, group_B_condition_2):
+    """
+    Closed form 2x2 mixed ANOVA (between factor group, within factor condition) for every edge at once.
+
+    Matches pingouin.mixed_anova with correction=False and effsize="np2" applied independently to each edge, but
+    operates on the stacked arrays directly instead of one DataFrame per edge.
+
+    Args:
+        group_A_condition_1: ndarray, shape (n_A, ...) with one entry per subject of group A in condition 1.
+        group_A_condition_2: ndarray, shape (n_A, ...) with the same subjects of group A in condition 2.
+        group_B_condition_1: ndarray, shape (n_B, ...) with one entry per subject of group B in condition 1.
+        group_B_condition_2: ndarray, shape (n_B, ...) with the same subjects of group B in condition 2.
+
+    Returns:
+        f_values : ndarray, shape (3, ...) with the F statistic of each effect in MIXED_ANOVA_EFFECTS order.
+        p_values : ndarray, shape (3, ...) with the uncorrected p-values.
+        np2 : ndarray, shape (3, ...) with the partial eta squared effect sizes.
+    """
+    a1 = np.asarray(group_A_condition_1, dtype=float)
+    a2 = np.asarray(group_A_condition_2, dtype=float)
+    b1 = np.asarray(group_B_condition_1, dtype=float)
+    b2 = np.asarray(group_B_condition_2, dtype=float)
+    n_A, n_B = a1.shape[0], b1.shape[0]
+    n_subj = n_A + n_B
+
+    # Cell, marginal and grand means over the subject axis
+    mean_a1, mean_a2, mean_b1, mean_b2 = a1.mean(axis=0), a2.mean(axis=0), b1.mean(axis=0), b2.mean(axis=0)
+    mean_A = (mean_a1 + mean_a2) / 2
+    mean_B = (mean_b1 + mean_b2) / 2
+    mean_1 = (n_A * mean_a1 + n_B * mean_b1) / n_subj
+    mean_2 = (n_A * mean_a2 + n_B * mean_b2) / n_subj
+    grandmean = (mean_1 + mean_2) / 2
+
+    # Sums of squares
+    ss_total = ((a1 - grandmean) ** 2).sum(axis=0) + ((a2 - grandmean) ** 2).sum(axis=0) \
+        + ((b1 - grandmean) ** 2).sum(axis=0) + ((b2 - grandmean) ** 2).sum(axis=0)
+    ss_betw = 2 * n_A * (mean_A - grandmean) ** 2 + 2 * n_B * (mean_B - grandmean) ** 2
+    ss_with = n_subj * (mean_1 - grandmean) ** 2 + n_subj * (mean_2 - grandmean) ** 2
+    ss_resall = ((a1 - mean_a1) ** 2).sum(axis=0) + ((a2 - mean_a2) ** 2).sum(axis=0) \
+        + ((b1 - mean_b1) ** 2).sum(axis=0) + ((b2 - mean_b2) ** 2).sum(axis=0)
+    ss_inter = ss_total - (ss_resall + ss_with + ss_betw)
+    ss_subj = 2 * ((((a1 + a2) / 2 - grandmean) ** 2).sum(axis=0) + (((b1 + b2) / 2 - grandmean) ** 2).sum(axis=0))
+    ss_resbetw = ss_subj - ss_betw
+    ss_reswith = ss_total - (ss_with + ss_subj + ss_inter)
+
+    # Every effect has one degree of freedom, and both error terms have n_subj - 2
+    df_err = n_subj - 2
+    ss = np.stack([ss_betw, ss_with, ss_inter])
+    ss_err = np.stack([ss_resbetw, ss_reswith, ss_reswith])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        f_values = ss / (ss_err / df_err)
+        np2 = ss / (ss + ss_err)
+    p_values = f_dist.sf(f_values, 1, df_err)
+
+    return f_values, p_values, np2
+
 def run_mixed_anova(group_A_condition_1, group_A_condition_2, group_B_condition_1, group_B_condition_2, fdr_correct=True):
     # groups will be n x 12 x 12
     assert(group_A_condition_1.shape == group_A_condition_2.shape)
     assert(group_A_condition_1[0].shape == group_B_condition_1[0].shape)
     assert(group_B_condition_1.shape == group_B_condition_2.shape)
 
+    # Run the ANOVA for all electrode pairs at once and keep the lower triangular part
+    _, p_values, np2 = mixed_anova_2x2(group_A_condition_1, group_A_condition_2, group_B_condition_1, group_B_condition_2)
+    mask = np.tril(np.ones(group_A_condition_1[0].shape), k=-1).astype(bool)
+
     p_values_group = np.ones_like(group_A_condition_1[0])
     p_values_condition = np.ones_like(group_A_condition_1[0])
     p_values_interaction = np.ones_like(group_A_condition_1[0])
     n2_condition = np.ones_like(group_A_condition_1[0])
 
-    for i in range(12):
-        for j in range(12):
-            if i <= j: 
-                continue
-            
-            data = {
-                "subject_id": [],
-                "group": [],
-                "condition": [],
-                "plv": []
-                }
-        
-            for idx, subject in enumerate(group_A_condition_1):
-                subject_id = idx
-                group = "A"
-                condition = "1"
-            
-                plv = subject[i, j]
-                data["subject_id"].append(subject_id)
-                data["group"].append(group)
-                data["condition"].append(condition)
-                data["plv"].append(plv)
-            
-            for idx, subject in enumerate(group_A_condition_2):
-                subject_id = idx
-                group = "A"
-                condition = "2"
-            
-                plv = subject[i, j]
-                data["subject_id"].append(subject_id)
-                data["group"].append(group)
-                data["condition"].append(condition)
-                data["plv"].append(plv)
-            
-            for idx, subject in enumerate(group_B_condition_1):
-                subject_id = idx + len(group_A_condition_1)
-                group = "B"
-                condition = "1"
-            
-                plv = subject[i, j]
-                data["subject_id"].append(subject_id)
-                data["group"].append(group)
-                data["condition"].append(condition)
-                data["plv"].append(plv)
-            
-            for idx, subject in enumerate(group_B_condition_2):
-                subject_id = idx + len(group_A_condition_1)
-                group = "B"
-                condition = "2"
-            
-                plv = subject[i, j]
-                data["subject_id"].append(subject_id)
-                data["group"].append(group)
-                data["condition"].append(condition)
-                data["plv"].append(plv)
-            
-            
-            df = pd.DataFrame(data)
-
-            # Anova
-            anova_results = pg.mixed_anova(data=df, dv='plv', between='group', within='condition', subject='subject_id', correction=False)
-            p_values_group[i, j] = anova_results['p-unc'][0]
-            p_values_condition[i, j] = anova_results['p-unc'][1]
-            n2_condition[i, j] = anova_results['np2'][1]
-            p_values_interaction[i, j] = anova_results['p-unc'][2]
+    p_values_group[mask] = p_values[0][mask]
+    p_values_condition[mask] = p_values[1][mask]
+    p_values_interaction[mask] = p_values[2][mask]
+    n2_condition[mask] = np2[1][mask]
     
     if fdr_correct:
         # Extract the p-values from the lower triangular part
-        mask = np.tril(np.ones(p_values_group.shape), k=-1).astype(bool)
         p_values_group_masked = p_values_group[mask]
         p_values_condition_masked = p_values_condition[mask]
         p_values_interaction_masked = p_values_interaction[mask]
@@ -104,70 +109,223 @@ def run_mixed_anova(group_A_condition_1, group_A_condition_2, group_B_condition_
     return p_values_group, p_values_condition, p_values_interaction, n2_condition
 
 
+def rm_anova_2level(condition_1, condition_2):
+    """
+    Closed form one-way repeated measures ANOVA with two levels for every edge at once.
+
+    Matches pingouin.rm_anova with correction=False and effsize="np2" applied independently to each edge. With two
+    levels this is equivalent to a two-sided paired t-test (F = t ** 2).
+
+    Args:
+        condition_1: ndarray, shape (n, ...) with one entry per subject in condition 1.
+        condition_2: ndarray, shape (n, ...) with the same subjects in condition 2.
+
+    Returns:
+        f_values : ndarray, shape (...) with the F statistic of the condition effect.
+        p_values : ndarray, shape (...) with the uncorrected p-values.
+        np2 : ndarray, shape (...) with the partial eta squared effect sizes.
+    """
+    c1 = np.asarray(condition_1, dtype=float)
+    c2 = np.asarray(condition_2, dtype=float)
+    n_subj = c1.shape[0]
+
+    # Condition and grand means over the subject axis
+    mean_1, mean_2 = c1.mean(axis=0), c2.mean(axis=0)
+    grandmean = (mean_1 + mean_2) / 2
+
+    # Sums of squares, splitting the residuals into a between subject and a within subject component
+    ss_with = n_subj * ((mean_1 - grandmean) ** 2 + (mean_2 - grandmean) ** 2)
+    ss_resall = ((c1 - mean_1) ** 2).sum(axis=0) + ((c2 - mean_2) ** 2).sum(axis=0)
+    ss_resbetw = 2 * (((c1 + c2) / 2 - grandmean) ** 2).sum(axis=0)
+    ss_reswith = ss_resall - ss_resbetw
+
+    df_err = n_subj - 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        f_values = ss_with / (ss_reswith / df_err)
+        np2 = ss_with / (ss_with + ss_reswith)
+    p_values = f_dist.sf(f_values, 1, df_err)
+
+    return f_values, p_values, np2
+
+def fdr_bh(p_values, axis=-1):
+    """
+    Benjamini-Hochberg adjusted p-values computed independently along one axis of a batch.
+
+    Gives the same result as statsmodels multipletests(..., method='fdr_bh')[1] on every 1D slice.
+    """
+    p_values = np.moveaxis(np.asarray(p_values, dtype=float), axis, -1)
+    n_tests = p_values.shape[-1]
+
+    # Scale the sorted p-values by n / rank and enforce monotonicity from the largest p-value down
+    order = np.argsort(p_values, axis=-1)
+    p_sorted = np.take_along_axis(p_values, order, axis=-1)
+    p_scaled = p_sorted * n_tests / np.arange(1, n_tests + 1)
+    p_adj_sorted = np.minimum.accumulate(p_scaled[..., ::-1], axis=-1)[..., ::-1]
+    np.minimum(p_adj_sorted, 1, out=p_adj_sorted)
+
+    # Undo the sort
+    p_adj = np.empty_like(p_adj_sorted)
+    np.put_along_axis(p_adj, order, p_adj_sorted, axis=-1)
+    return np.moveaxis(p_adj, -1, axis)
+
 def run_rm_anova(group_A_condition_1, group_A_condition_2, fdr_correct=True):
-    # groups will be n x 12 x 12
+    """
+    Repeated measures ANOVA between two conditions for every electrode pair.
+
+    Args:
+        group_A_condition_1: ndarray, shape (n, 12, 12) or (n, 12, 12, n_bands).
+        group_A_condition_2: ndarray with the same shape and subject order as group_A_condition_1.
+        fdr_correct: Whether to apply Benjamini-Hochberg correction over the lower triangle, separately per band.
+
+    Returns:
+        p_values : ndarray, shape (12, 12) or (12, 12, n_bands). Entries outside the lower triangle are 1.
+    """
+    # groups will be n x 12 x 12, optionally with a trailing frequency band axis
     assert(group_A_condition_1.shape == group_A_condition_2.shape)
-    
-    p_values = np.ones_like(group_A_condition_1[0])
-
-    for i in range(12):
-        for j in range(12):
-            if i <= j: 
-                continue
-            
-            data = {
-                "subject_id": [],
-                "group": [],
-                "condition": [],
-                "plv": []
-                }
-        
-            for idx, subject in enumerate(group_A_condition_1):
-                subject_id = idx
-                group = "A"
-                condition = "1"
-            
-                plv = subject[i, j]
-                data["subject_id"].append(subject_id)
-                data["group"].append(group)
-                data["condition"].append(condition)
-                data["plv"].append(plv)
-            
-            for idx, subject in enumerate(group_A_condition_2):
-                subject_id = idx
-                group = "A"
-                condition = "2"
-            
-                plv = subject[i, j]
-                data["subject_id"].append(subject_id)
-                data["group"].append(group)
-                data["condition"].append(condition)
-                data["plv"].append(plv)
-            
-                plv = subject[i, j]
-                data["subject_id"].append(subject_id)
-                data["group"].append(group)
-                data["condition"].append(condition)
-                data["plv"].append(plv)
-            
-            
-            df = pd.DataFrame(data)
-
-            # Repeated Measures Anova
-            anova_results = pg.rm_anova(data=df, dv='plv', within='condition', subject='subject_id', correction=False)
-            p_values[i, j] = anova_results['p-unc'][0]
+
+    # Run the ANOVA for all electrode pairs and bands at once
+    _, p_values_all, _ = rm_anova_2level(group_A_condition_1, group_A_condition_2)
+
+    # Keep only the lower triangular part
+    mask = np.tril(np.ones(group_A_condition_1.shape[1:3]), k=-1).astype(bool)
+    p_values_masked = p_values_all[mask]  # Shape: (n_pairs,) or (n_pairs, n_bands)
 
     if fdr_correct:
-        # Extract the p-values from the lower triangular part
-        mask = np.tril(np.ones(p_values.shape), k=-1).astype(bool)
-        p_values_masked = p_values[mask]
+        # Apply Benjamini-Hochberg FDR correction across the electrode pairs of each band
+        p_values_masked = fdr_bh(p_values_masked, axis=0)
 
-        # Apply Benjamini-Hochberg FDR correction
-        p_values_adj = multipletests(p_values_masked, alpha=0.05, method='fdr_bh')[1]
+    p_values = np.ones_like(p_values_all)
+    p_values[mask] = p_values_masked
 
-        
-        p_values = np.ones_like(p_values)
+    return p_values
+
+# Number of permutations evaluated together in one vectorized ANOVA call. Each chunk is seeded independently, so the
+# null distribution does not depend on how many workers the chunks are spread over.
+NBS_PERMUTATIONS_PER_CHUNK = 250
+
+def _lower_triangle_edges(stack):
+    # Flatten the lower triangle of a (n, n_nodes, n_nodes) stack into (n, n_edges)
+    rows, cols = np.tril_indices(stack.shape[1], k=-1)
+    return stack[:, rows, cols]
+
+def _component_sizes(suprathreshold, rows, cols, n_nodes):
+    """
+    Finds the connected components formed by the suprathreshold edges of one graph.
+
+    Returns:
+        sizes : list with the number of edges in each component that contains at least one edge.
+        labels : ndarray, shape (n_edges,) with the component index of each suprathreshold edge and -1 elsewhere.
+    """
+    adjacency = csr_matrix((np.ones(suprathreshold.sum()), (rows[suprathreshold], cols[suprathreshold])), shape=(n_nodes, n_nodes))
+    _, node_labels = connected_components(adjacency, directed=False)
+
+    # Label each edge by the component of its nodes, then renumber the components that contain edges
+    edge_labels = np.where(suprathreshold, node_labels[rows], -1)
+    components, edge_labels[suprathreshold] = np.unique(edge_labels[suprathreshold], return_inverse=True)
+    sizes = np.bincount(edge_labels[suprathreshold], minlength=len(components)).tolist()
+    return sizes, edge_labels
+
+def _nbs_null_chunk(c1, c2, n_A, effect_idx, threshold, n_permutations, seed, n_nodes):
+    """
+    Computes the maximum component size of n_permutations relabelled datasets.
+    """
+    rng = np.random.default_rng(seed)
+    n_subj = c1.shape[0]
+    rows, cols = np.tril_indices(n_nodes, k=-1)
+
+    if MIXED_ANOVA_EFFECTS[effect_idx] == "condition":
+        # Swap the two conditions within randomly chosen subjects
+        swap = rng.random((n_permutations, n_subj)) < 0.5
+        p1 = np.where(swap[..., None], c2[None], c1[None])
+        p2 = np.where(swap[..., None], c1[None], c2[None])
+        group_idx = np.broadcast_to(np.arange(n_subj), (n_permutations, n_subj))
+    else:
+        # Shuffle the group labels of the subjects, keeping both conditions of each subject together
+        group_idx = rng.permuted(np.broadcast_to(np.arange(n_subj), (n_permutations, n_subj)), axis=1)
+        p1 = c1[group_idx]
+        p2 = c2[group_idx]
+    del group_idx
+
+    # Move the subject axis first so that all permutations are tested in a single call: shape (n_subj, n_permutations, n_edges)
+    p1 = np.swapaxes(p1, 0, 1)
+    p2 = np.swapaxes(p2, 0, 1)
+    f_values, _, _ = mixed_anova_2x2(p1[:n_A], p2[:n_A], p1[n_A:], p2[n_A:])
+    suprathreshold = f_values[effect_idx] > threshold
+
+    max_sizes = np.zeros(n_permutations)
+    for perm_idx in np.flatnonzero(suprathreshold.any(axis=1)):
+        sizes, _ = _component_sizes(suprathreshold[perm_idx], rows, cols, n_nodes)
+        max_sizes[perm_idx] = max(sizes)
+    return max_sizes
+
+def run_network_based_statistic(group_A_condition_1, group_A_condition_2, group_B_condition_1, group_B_condition_2, effect="condition",
+                                primary_p=0.01, n_permutations=10000, seed=42, n_jobs=1):
+    """
+    Network based statistic (NBS) for one effect of the 2x2 mixed ANOVA over the electrode graph.
+
+    Edges whose F statistic exceeds the primary threshold are grouped into connected components, and the size (number
+    of edges) of each component is compared to the null distribution of the largest component size under
+    relabelling. This controls the family wise error rate at the level of components rather than edges.
+
+    Args:
+        group_A_condition_1, group_A_condition_2, group_B_condition_1, group_B_condition_2: ndarrays, shape (n, 12, 12),
+            as in run_mixed_anova.
+        effect: One of MIXED_ANOVA_EFFECTS. Group and interaction effects shuffle group labels between subjects, the
+            condition effect swaps conditions within subjects.
+        primary_p: Uncorrected p-value defining the suprathreshold edges.
+        n_permutations: Number of relabellings used to build the null distribution.
+        seed: Seed of the permutations. Results are identical for any n_jobs.
+        n_jobs: Number of worker processes. -1 uses every CPU.
+
+    Returns:
+        component_masks : list of boolean ndarrays, shape (12, 12), marking the lower triangular edges of each component.
+        p_values : ndarray with the family wise error corrected p-value of each component.
+        null_distribution : ndarray, shape (n_permutations,) with the largest component size of each permutation.
+    """
+    assert(group_A_condition_1.shape == group_A_condition_2.shape)
+    assert(group_A_condition_1[0].shape == group_B_condition_1[0].shape)
+    assert(group_B_condition_1.shape == group_B_condition_2.shape)
+
+    effect_idx = MIXED_ANOVA_EFFECTS.index(effect)
+    n_nodes = group_A_condition_1.shape[1]
+    n_A = group_A_condition_1.shape[0]
+    rows, cols = np.tril_indices(n_nodes, k=-1)
+
+    # Stack both groups so that permutations can relabel subjects, with shape (n_subj, n_edges)
+    c1 = np.concatenate([_lower_triangle_edges(group_A_condition_1), _lower_triangle_edges(group_B_condition_1)]).astype(float)
+    c2 = np.concatenate([_lower_triangle_edges(group_A_condition_2), _lower_triangle_edges(group_B_condition_2)]).astype(float)
+
+    # Primary threshold on the F statistic
+    threshold = f_dist.isf(primary_p, 1, c1.shape[0] - 2)
+
+    # Observed components
+    f_values, _, _ = mixed_anova_2x2(c1[:n_A], c2[:n_A], c1[n_A:], c2[n_A:])
+    suprathreshold = f_values[effect_idx] > threshold
+    sizes, edge_labels = _component_sizes(suprathreshold, rows, cols, n_nodes)
+
+    # Null distribution of the largest component size, built from independently seeded chunks of permutations
+    chunk_sizes = [NBS_PERMUTATIONS_PER_CHUNK] * (n_permutations // NBS_PERMUTATIONS_PER_CHUNK)
+    if n_permutations % NBS_PERMUTATIONS_PER_CHUNK:
+        chunk_sizes.append(n_permutations % NBS_PERMUTATIONS_PER_CHUNK)
+    seeds = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+    chunk_args = [(c1, c2, n_A, effect_idx, threshold, size, chunk_seed, n_nodes) for size, chunk_seed in zip(chunk_sizes, seeds)]
+
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    if n_jobs == 1:
+        null_chunks = [_nbs_null_chunk(*args) for args in chunk_args]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            null_chunks = list(pool.map(_nbs_null_chunk, *zip(*chunk_args)))
+    null_distribution = np.concatenate(null_chunks) if null_chunks else np.zeros(0)
 
-        p_values[mask] = p_values_adj
+    # Family wise error corrected p-value of each observed component
+    component_masks = []
+    p_values = []
+    for component_idx, size in enumerate(sizes):
+        mask = np.zeros((n_nodes, n_nodes), dtype=bool)
+        mask[rows, cols] = edge_labels == component_idx
+        component_masks.append(mask)
+        p_values.append((np.sum(null_distribution >= size) + 1) / (n_permutations + 1))
 
-    return p_values
\ No newline at end of file
+    return component_masks, np.array(p_values), null_distribution
@@ -0,0 +1,56 @@
+import importlib
+import os
+import sys
+
+import mne
+import numpy as np
+import pytest
+
+# The pipeline scripts live at the root of the repository and are not installed as a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pipeline_utils import ELECTRODES_OF_INTEREST, processed_session_path
+
+
+def import_script(name):
+    # Scripts such as 3_compute_connectivity_entropy.py cannot be imported with an import statement
+    return importlib.import_module(name)
+
+
+# EEG channels of the synthetic sessions: the electrodes of interest followed by a few others
+SYNTHETIC_CHANNELS = ELECTRODES_OF_INTEREST + ["Fp1", "Fp2", "O1", "O2", "T7", "T8"]
+
+
+def write_processed_session(root_dir, expert, subject_id, session, num_ica_comps, sfreq=128.0, duration=120.0, seed=0):
+    """
+    Writes a small synthetic processed session with an applied average reference projector and one annotated window
+    per condition, like the output of 2_select_ica.py.
+    """
+    rng = np.random.default_rng(seed)
+    n_times = int(sfreq * duration)
+    times = np.arange(n_times) / sfreq
+    # Shared oscillations on top of channel specific noise, so that phase synchrony differs between pairs
+    sources = np.stack([np.sin(2 * np.pi * freq * times + rng.uniform(0, 2 * np.pi)) for freq in (2.0, 6.0, 9.0, 11.5, 16.0, 25.0)])
+    data = rng.normal(size=(len(SYNTHETIC_CHANNELS), len(sources))) @ sources + rng.normal(size=(len(SYNTHETIC_CHANNELS), n_times))
+    info = mne.create_info(SYNTHETIC_CHANNELS, sfreq, ch_types="eeg")
+    raw = mne.io.RawArray(data * 1e-6, info, verbose=False)
+
+    onsets, descriptions = [], []
+    for idx, prefix in enumerate(["BL_NoG", "BL_WiG", "NoG", "WiG"]):
+        onsets += [5.0 + 28.0 * idx, 30.0 + 28.0 * idx]
+        descriptions += [f"{prefix}_beg", f"{prefix}_end"]
+    raw.set_annotations(mne.Annotations(onsets, [0.0] * len(onsets), descriptions))
+    raw.set_eeg_reference("average", projection=True, verbose=False)
+    raw.apply_proj(verbose=False)
+
+    out_path = processed_session_path(root_dir, expert, subject_id, session, num_ica_comps)
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    raw.save(out_path, overwrite=True, verbose=False)
+    return out_path
+
+
+@pytest.fixture
+def processed_root(tmp_path):
+    # Data root with one synthetic processed session for participant "expert/1"
+    write_processed_session(str(tmp_path), "expert", "1", 1, 0.9999)
+    return str(tmp_path)
@@ -0,0 +1,34 @@
+import os
+
+import numpy as np
+import pytest
+
+from conftest import import_script
+from pipeline_utils import mean_output_path
+from result_cache import manifest_path
+
+mne_connectivity = import_script("3_compute_connectivity_mne")
+
+CONDITION = (False, False)
+
+
+@pytest.mark.parametrize("chunk_size", [None, 4])
+def test_running_mean_follows_its_output(processed_root, chunk_size):
+    def compute(**kwargs):
+        return mne_connectivity.compute_conditions(processed_root, "expert", "1", conditions=[CONDITION], chunk_size=chunk_size, **kwargs)[CONDITION]
+
+    out_path = compute(running_mean=True)
+    mean_path = mean_output_path(out_path)
+    np.testing.assert_allclose(np.load(mean_path), np.load(out_path).mean(axis=0))
+    assert os.path.exists(manifest_path(mean_path))
+
+    # Recomputing the output without the mean removes the mean of the earlier parameters
+    compute(n_cycles_numerator=3)
+    assert not os.path.exists(mean_path) and not os.path.exists(manifest_path(mean_path))
+
+    # A mean without a manifest, e.g. one left by an earlier version, is recomputed even if the output is current
+    compute(n_cycles_numerator=3, running_mean=True)
+    np.save(mean_path, np.zeros_like(np.load(mean_path)))
+    os.remove(manifest_path(mean_path))
+    compute(n_cycles_numerator=3, running_mean=True)
+    np.testing.assert_allclose(np.load(mean_path), np.load(out_path).mean(axis=0))
@@ -0,0 +1,91 @@
+import os
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from connectivity_store import CONDITION_FILES, ELECTRODE_NAMES_FILE, pack_store
+from dataset import Dataset, NORMALIZATIONS
+
+SUBJECTS = {"expert": ["3", "10", "7"], "novice": ["12", "2"]}
+
+
+@pytest.fixture
+def connectivity_dir(tmp_path):
+    # Entropy connectivity files of a few subjects, shape (n_epochs, 4, 4, 6), with a different epoch count per file
+    rng = np.random.default_rng(20)
+    directory = tmp_path / "connectivity_scores"
+    for group, ids in SUBJECTS.items():
+        for id in ids:
+            os.makedirs(directory / group / id)
+            for filename in CONDITION_FILES.values():
+                np.save(directory / group / id / filename, rng.uniform(size=(rng.integers(3, 9), 4, 4, 6)))
+    np.save(directory / ELECTRODE_NAMES_FILE, np.array(["Fz", "Cz", "Pz", "Oz"]))
+    return str(tmp_path), "connectivity_scores"
+
+
+@pytest.fixture
+def condition_reads(monkeypatch):
+    # Count how often the file of each (group, id, demo, gestures) is opened
+    reads = Counter()
+    load_condition = Dataset._load_condition
+
+    def counting_load_condition(self, group_dir, id, demo, gestures, mmap=False):
+        reads[(group_dir, id, demo, gestures)] += 1
+        return load_condition(self, group_dir, id, demo, gestures, mmap=mmap)
+
+    monkeypatch.setattr(Dataset, "_load_condition", counting_load_condition)
+    return reads
+
+
+@pytest.mark.parametrize("normalize", NORMALIZATIONS + [False])
+def test_eager_reads_each_file_once(connectivity_dir, condition_reads, normalize):
+    data_dir, connectivity_dir_path = connectivity_dir
+    eager = Dataset(connectivity_dir_path, data_dir=data_dir, normalize=normalize)
+    assert set(condition_reads.values()) == {1}
+    assert len(condition_reads) == len(CONDITION_FILES) * sum(len(ids) for ids in SUBJECTS.values())
+
+    # The means and statistics taken from the loaded epochs equal those of the streaming pass of lazy mode
+    lazy = Dataset(connectivity_dir_path, data_dir=data_dir, normalize=normalize, lazy=True)
+    for group in SUBJECTS:
+        for demo, gestures in CONDITION_FILES:
+            np.testing.assert_array_equal(eager.numpy_arrays[group][demo][gestures], lazy.numpy_arrays[group][demo][gestures])
+            expected = [lazy.get_subject_epochs(group, demo, gestures, id) for id in eager.id_dicts[group][demo][gestures]]
+            for actual, epochs in zip(eager.lists[group][demo][gestures], expected):
+                np.testing.assert_array_equal(actual, epochs)
+
+
+def test_eager_with_cached_summaries_reads_each_file_once(connectivity_dir, condition_reads, tmp_path):
+    data_dir, connectivity_dir_path = connectivity_dir
+    first = Dataset(connectivity_dir_path, data_dir=data_dir, normalize="zscore", cache_dir=str(tmp_path / "cache"))
+    condition_reads.clear()
+    second = Dataset(connectivity_dir_path, data_dir=data_dir, normalize="zscore", cache_dir=str(tmp_path / "cache"))
+    assert set(condition_reads.values()) == {1}
+    for group in SUBJECTS:
+        for demo, gestures in CONDITION_FILES:
+            np.testing.assert_array_equal(first.numpy_arrays[group][demo][gestures], second.numpy_arrays[group][demo][gestures])
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_subjects_are_sorted_like_the_store(connectivity_dir, tmp_path, lazy):
+    data_dir, connectivity_dir_path = connectivity_dir
+    directory = Dataset(connectivity_dir_path, data_dir=data_dir, lazy=lazy)
+    pack_store(os.path.join(data_dir, connectivity_dir_path), str(tmp_path / "packed.npz"), dtype=np.float64)
+    packed = Dataset(str(tmp_path / "packed.npz"), lazy=lazy)
+
+    for group, ids in SUBJECTS.items():
+        for demo, gestures in CONDITION_FILES:
+            np.testing.assert_allclose(directory.numpy_arrays[group][demo][gestures], packed.numpy_arrays[group][demo][gestures])
+        if lazy:
+            assert directory.subject_ids[group] == sorted(ids)
+        else:
+            assert list(directory.id_dicts[group]["BL"]["NoG"]) == sorted(ids)
+
+    # Subjects added later take their sorted place
+    rng = np.random.default_rng(10)
+    os.makedirs(os.path.join(data_dir, connectivity_dir_path, "expert", "4"))
+    for filename in CONDITION_FILES.values():
+        np.save(os.path.join(data_dir, connectivity_dir_path, "expert", "4", filename), rng.uniform(size=(5, 4, 4, 6)))
+    directory.refresh()
+    expected = sorted(SUBJECTS["expert"] + ["4"])
+    assert (directory.subject_ids["expert"] if lazy else list(directory.id_dicts["expert"]["demo"]["WiG"])) == expected
@@ -0,0 +1,47 @@
+import json
+
+import mne
+import numpy as np
+
+from conftest import SYNTHETIC_CHANNELS, import_script
+from pipeline_utils import CONDITIONS, ELECTRODES_OF_INTEREST, find_annotation_windows, load_processed_session, window_epochs
+from result_cache import manifest_path
+
+
+def test_picked_epochs_match_full_epochs(processed_root):
+    # Epochs of the picked electrodes must be those of the full session, not re-referenced to the picked subset
+    full = load_processed_session(processed_root, "expert", "1", 1, 0.9999)
+    picked = load_processed_session(processed_root, "expert", "1", 1, 0.9999, electrodes="interest")
+    assert full.info["projs"] and full.info["projs"][0]["active"]
+    assert picked.ch_names == ELECTRODES_OF_INTEREST
+
+    # The projector is already applied to the stored data, so the reference epochs are taken without projecting again
+    for start, end in find_annotation_windows(full, baseline=False, with_gestures=False):
+        expected = mne.make_fixed_length_epochs(full.copy().crop(tmin=start, tmax=end), duration=5.0, overlap=2.5, preload=True,
+                                                proj="delayed", verbose=False).get_data(picks=ELECTRODES_OF_INTEREST)
+        np.testing.assert_array_equal(window_epochs(picked, start, end, 5.0, 2.5), expected)
+
+
+def test_picked_connectivity_matches_full_connectivity(processed_root):
+    # Pairwise connectivity of the electrodes of interest must equal the matching entries of an all-electrode run
+    entropy = import_script("3_compute_connectivity_entropy")
+    picked_paths = entropy.compute_conditions(processed_root, "expert", "1", dir_suffix="_interest", electrodes="interest")
+    full_paths = entropy.compute_conditions(processed_root, "expert", "1", dir_suffix="_eeg", electrodes="eeg")
+
+    idx = [SYNTHETIC_CHANNELS.index(name) for name in ELECTRODES_OF_INTEREST]
+    for condition in CONDITIONS:
+        picked = np.load(picked_paths["entropy"][condition])
+        full = np.load(full_paths["entropy"][condition])
+        assert picked.shape[1:3] == (len(idx), len(idx))
+        np.testing.assert_array_equal(picked, full[:, idx][:, :, idx])
+
+
+def test_default_electrodes_keep_manifest_params(processed_root):
+    # Results on the electrodes of interest keep the params of results written before electrodes could be chosen
+    entropy = import_script("3_compute_connectivity_entropy")
+    for electrodes, recorded in [("interest", False), ("eeg", True)]:
+        out_paths = entropy.compute_conditions(processed_root, "expert", "1", dir_suffix=f"_{electrodes}", electrodes=electrodes)
+        for condition in CONDITIONS:
+            with open(manifest_path(out_paths["entropy"][condition])) as f:
+                params = json.load(f)["params"]
+            assert ("electrodes" in params) == recorded
@@ -0,0 +1,95 @@
+from itertools import combinations
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from scipy.signal import hilbert
+
+from conftest import import_script
+
+entropy = import_script("3_compute_connectivity_entropy")
+
+BINS = 50
+
+
+def _loop_histogram_entropy(phdiff):
+    # Per-pair np.bincount histogram entropy of the original implementation, for phdiff of shape (n_times, n_pairs).
+    # np.digitize puts a difference of exactly pi one past the last bin, where the original loop failed because
+    # bincount returned BINS + 1 counts. It is folded into the last bin here, as the batched engine does.
+    bin_edges = np.linspace(-np.pi, np.pi, BINS + 1)
+    bin_indices = np.minimum(np.digitize(phdiff, bins=bin_edges) - 1, BINS - 1)
+    counts = np.zeros((BINS, phdiff.shape[1]))
+    for i in range(phdiff.shape[1]):
+        counts[:, i] = np.bincount(bin_indices[:, i], minlength=BINS)
+    d = counts / (np.sum(counts, axis=0, keepdims=True) + np.finfo(float).eps)
+    logd = np.log(d + np.finfo(float).eps)
+    return np.sum(d * logd, axis=0) / np.log(BINS)
+
+
+def _loop_normalized_entropy(data):
+    # Original per-epoch implementation of phase_synchrony_via_normalized_entropy
+    n_epochs, n_channels, _ = data.shape
+    pairs = np.array(list(combinations(range(n_channels), 2)))
+    synchrony_matrices = np.zeros((n_epochs, n_channels, n_channels))
+    for epoch_idx in range(n_epochs):
+        ph = np.angle(hilbert(data[epoch_idx].T, axis=0))
+        phdiff = np.angle(np.exp(1j * (ph[:, pairs[:, 0]] - ph[:, pairs[:, 1]])))
+        h = _loop_histogram_entropy(phdiff)
+        for idx, (k, m) in enumerate(pairs):
+            synchrony_matrices[epoch_idx, k, m] = h[idx]
+            synchrony_matrices[epoch_idx, m, k] = h[idx]
+    return synchrony_matrices
+
+
+@pytest.mark.parametrize("epochs_per_block", [None, 1, 3, 100])
+def test_batched_entropy_matches_loop(epochs_per_block):
+    data = np.random.default_rng(1).normal(size=(7, 12, 640))
+    np.testing.assert_array_equal(entropy.normalized_entropy_from_data(data, epochs_per_block=epochs_per_block), _loop_normalized_entropy(data))
+
+
+def test_entropy_binning_at_edges():
+    # Phase differences exactly at -pi, pi and every bin edge, plus values one ulp either side of them
+    rng = np.random.default_rng(2)
+    edges = np.linspace(-np.pi, np.pi, BINS + 1)
+    edge_values = np.concatenate([edges, np.nextafter(edges[1:], -np.inf), np.nextafter(edges[:-1], np.inf)])
+    n_epochs, n_pairs = 4, 6
+    phdiff = rng.choice(np.concatenate([edge_values, rng.uniform(-np.pi, np.pi, 200)]), size=(n_epochs, n_pairs, 256))
+    phdiff[:, 0, :] = np.pi
+    phdiff[:, 1, :] = -np.pi
+    phdiff[:, 2, ::2] = np.pi
+    phdiff[:, 2, 1::2] = -np.pi
+
+    block = SimpleNamespace(n_epochs=n_epochs, pair_k=np.zeros(n_pairs, dtype=int), phase_difference=phdiff)
+    expected = np.stack([_loop_histogram_entropy(epoch.T) for epoch in phdiff])
+    np.testing.assert_array_equal(entropy._normalized_entropy(block), expected)
+    # A constant phase difference fills a single bin, at pi and at -pi alike, and pi and -pi fall into different bins
+    np.testing.assert_allclose(expected[:, :2], 0.0, atol=1e-12)
+    np.testing.assert_allclose(expected[:, 2], -np.log(2) / np.log(BINS))
+
+
+def test_coherency_is_amplitude_weighted_plv():
+    block = entropy.AnalyticBlock(np.random.default_rng(3).normal(size=(3, 5, 256)))
+    coherency = entropy._coherency(block)
+    assert np.all((coherency >= 0) & (coherency <= 1 + 1e-12))
+    assert not np.allclose(coherency, entropy._phase_locking_value(block))
+
+    # With unit amplitudes the coherency reduces to the phase locking value |<exp(i * phase difference)>|
+    block.analytic_signal = np.exp(1j * block.phase)
+    np.testing.assert_allclose(entropy._coherency(block), entropy._phase_locking_value(block), atol=1e-12)
+
+
+def test_parallel_synchrony_matches_serial():
+    # Epoch counts that are not multiples of the block size (6 epochs for 12 x 640, 36 for 8 x 256), one array smaller
+    # than a block, so that chunks end on partial blocks
+    rng = np.random.default_rng(4)
+    datasets = [rng.normal(size=shape) for shape in [(13, 12, 640), (5, 12, 640), (40, 8, 256)]]
+    assert [len(data) % entropy.entropy_block_size(*data.shape[1:]) for data in datasets] == [1, 5, 4]
+
+    metrics = tuple(entropy.METRICS)
+    serial = entropy.phase_synchrony_parallel(datasets, metrics, n_jobs=1)
+    parallel = entropy.phase_synchrony_parallel(datasets, metrics, n_jobs=3)
+    for serial_result, parallel_result, data in zip(serial, parallel, datasets):
+        assert set(parallel_result) == set(metrics)
+        for metric in metrics:
+            assert parallel_result[metric].shape == (len(data), data.shape[1], data.shape[1])
+            assert np.array_equal(parallel_result[metric], serial_result[metric]), metric
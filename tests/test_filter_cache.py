@@ -0,0 +1,78 @@
+import os
+
+import mne
+import numpy as np
+
+from conftest import SYNTHETIC_CHANNELS
+from filter_cache import BandFilterCache
+from pipeline_utils import ELECTRODES_OF_INTEREST, processed_session_path
+
+BANDS = [(4.0, 8.0), (13.0, 30.0)]
+
+
+def _band_signals(cache, source_path):
+    raw = mne.io.read_raw_fif(source_path, preload=False, verbose=False)
+    return [band_raw.get_data() for _, band_raw in cache.iter_band_filtered(raw, source_path, BANDS, ELECTRODES_OF_INTEREST)]
+
+
+def _entries(cache_dir):
+    return sorted(name for name in os.listdir(cache_dir) if name.endswith(".npy"))
+
+
+def test_hit_returns_cached_float32_signal(processed_root, tmp_path, monkeypatch):
+    source_path = processed_session_path(processed_root, "expert", "1", 1, 0.9999)
+    cache = BandFilterCache(str(tmp_path / "cache"))
+    missed = _band_signals(cache, source_path)
+    assert len(_entries(cache.cache_dir)) == len(BANDS)
+
+    # The float32 entries hold the picked channels filtered to each band
+    raw = mne.io.read_raw_fif(source_path, preload=True, verbose=False).pick(ELECTRODES_OF_INTEREST)
+    for (l_freq, h_freq), signal in zip(BANDS, missed):
+        entry = cache.load(cache.key(source_path, l_freq, h_freq, ELECTRODES_OF_INTEREST))
+        assert entry.dtype == np.float32 and entry.shape == (len(ELECTRODES_OF_INTEREST), raw.n_times)
+        np.testing.assert_array_equal(signal, entry)
+        np.testing.assert_allclose(entry, raw.copy().filter(l_freq, h_freq, verbose=False).get_data(), rtol=1e-5, atol=1e-12)
+
+    # Hits read the entries without filtering again
+    def no_filter(*args, **kwargs):
+        raise AssertionError("cache hit filtered the signal")
+    monkeypatch.setattr(mne.io.BaseRaw, "filter", no_filter)
+    for signal, hit in zip(missed, _band_signals(cache, source_path)):
+        np.testing.assert_array_equal(hit, signal)
+
+
+def test_touching_source_misses(processed_root, tmp_path):
+    source_path = processed_session_path(processed_root, "expert", "1", 1, 0.9999)
+    cache = BandFilterCache(str(tmp_path / "cache"))
+    keys = [cache.key(source_path, l_freq, h_freq, ELECTRODES_OF_INTEREST) for l_freq, h_freq in BANDS]
+    _band_signals(cache, source_path)
+
+    stat = os.stat(source_path)
+    os.utime(source_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    new_keys = [cache.key(source_path, l_freq, h_freq, ELECTRODES_OF_INTEREST) for l_freq, h_freq in BANDS]
+    assert not set(keys) & set(new_keys)
+    assert all(cache.load(key) is None for key in new_keys)
+
+    _band_signals(cache, source_path)
+    assert _entries(cache.cache_dir) == sorted(key + ".npy" for key in keys + new_keys)
+    # Other channels are a different entry as well
+    assert cache.key(source_path, *BANDS[0], SYNTHETIC_CHANNELS) not in new_keys
+
+
+def test_exceeding_max_bytes_evicts_least_recently_used(tmp_path):
+    # Room for two entries of a signal and its .npy header
+    signal = np.zeros((4, 1000), dtype=np.float32)
+    entry_bytes = signal.nbytes + 128
+    cache = BandFilterCache(str(tmp_path / "cache"), max_bytes=2 * entry_bytes + entry_bytes // 2)
+    for age, key in enumerate(["first", "second"]):
+        cache.store(key, signal)
+        os.utime(cache._entry_path(key), ns=(10 ** 18 + age, 10 ** 18 + age))
+    assert _entries(cache.cache_dir) == ["first.npy", "second.npy"]
+
+    cache.store("third", signal)
+    assert _entries(cache.cache_dir) == ["second.npy", "third.npy"]
+
+    # Loading an entry makes it the most recently used
+    assert cache.load("second") is not None
+    cache.store("fourth", signal)
+    assert _entries(cache.cache_dir) == ["fourth.npy", "second.npy"]
@@ -0,0 +1,86 @@
+import glob
+import os
+
+import mne
+import numpy as np
+import pytest
+
+from conftest import SYNTHETIC_CHANNELS, import_script
+from pipeline_utils import ica_path, preprocessed_session_path
+from result_cache import manifest_path
+
+fit_ica = import_script("1_fit_ica")
+
+NUM_ICA_COMPS = 4
+
+
+@pytest.fixture
+def preprocessed_root(tmp_path):
+    # Preprocessed session of "expert/1", as written by 1_preproc.py
+    root_dir = str(tmp_path)
+    rng = np.random.default_rng(31)
+    info = mne.create_info(SYNTHETIC_CHANNELS + ["VEOGU"], 128.0, ch_types=["eeg"] * len(SYNTHETIC_CHANNELS) + ["eog"])
+    raw = mne.io.RawArray(rng.normal(size=(len(SYNTHETIC_CHANNELS) + 1, 128 * 60)) * 1e-6, info, verbose=False)
+    raw.filter(1.0, None, verbose=False)
+    os.makedirs(os.path.dirname(preprocessed_session_path(root_dir, "expert", "1", 1)))
+    raw.save(preprocessed_session_path(root_dir, "expert", "1", 1), verbose=False)
+    return root_dir
+
+
+def _no_fit(*args, **kwargs):
+    raise AssertionError("ICA was fitted again")
+
+
+def test_current_ica_is_skipped(preprocessed_root, monkeypatch):
+    out_path = fit_ica.fit_ica(preprocessed_root, "expert", "1", 1, NUM_ICA_COMPS)
+    assert out_path == ica_path(preprocessed_root, "expert", "1", 1, NUM_ICA_COMPS)
+    assert os.path.exists(manifest_path(out_path))
+    assert mne.preprocessing.read_ica(out_path, verbose=False).n_components_ == NUM_ICA_COMPS
+
+    monkeypatch.setattr(mne.preprocessing.ICA, "fit", _no_fit)
+    assert fit_ica.fit_ica(preprocessed_root, "expert", "1", 1, NUM_ICA_COMPS) == out_path
+
+    # Forcing fits again even though the ICA is current
+    with pytest.raises(AssertionError, match="fitted again"):
+        fit_ica.fit_ica(preprocessed_root, "expert", "1", 1, NUM_ICA_COMPS, force=True)
+
+
+def test_ica_without_manifest_is_adopted_by_mtime(preprocessed_root, monkeypatch):
+    # An ICA fitted before manifests were written is reused when it is newer than the preprocessed recording
+    out_path = fit_ica.fit_ica(preprocessed_root, "expert", "1", 1, NUM_ICA_COMPS)
+    os.remove(manifest_path(out_path))
+    in_path = preprocessed_session_path(preprocessed_root, "expert", "1", 1)
+    os.utime(in_path, (os.path.getmtime(out_path) - 10,) * 2)
+
+    monkeypatch.setattr(mne.preprocessing.ICA, "fit", _no_fit)
+    assert fit_ica.fit_ica(preprocessed_root, "expert", "1", 1, NUM_ICA_COMPS) == out_path
+    assert os.path.exists(manifest_path(out_path))
+    monkeypatch.undo()
+
+    # An ICA older than its preprocessed recording is fitted again
+    os.remove(manifest_path(out_path))
+    os.utime(in_path, (os.path.getmtime(out_path) + 10,) * 2)
+    fitted = []
+    original_fit = mne.preprocessing.ICA.fit
+    monkeypatch.setattr(mne.preprocessing.ICA, "fit", lambda self, *args, **kwargs: fitted.append(self) or original_fit(self, *args, **kwargs))
+    assert fit_ica.fit_ica(preprocessed_root, "expert", "1", 1, NUM_ICA_COMPS) == out_path
+    assert len(fitted) == 1
+    assert os.path.exists(manifest_path(out_path))
+
+
+def test_fit_all_removes_partial_fits(preprocessed_root):
+    out_path = ica_path(preprocessed_root, "expert", "1", 1, NUM_ICA_COMPS)
+    os.makedirs(os.path.dirname(out_path))
+    # Temporary file of a worker killed while saving
+    partial_path = f"{out_path[:-len('_ica.fif')]}.12345.tmp_ica.fif"
+    with open(partial_path, "wb") as f:
+        f.write(b"partial")
+
+    sessions = fit_ica.find_preprocessed_sessions(preprocessed_root)
+    assert sessions == [("expert", "1", 1)]
+    completed, failed = fit_ica.fit_all(preprocessed_root, sessions + [("novice", "2", 1)], NUM_ICA_COMPS, n_workers=2)
+    assert completed == [("expert", "1", 1)]
+    assert failed == [("novice", "2", 1)]
+    assert not os.path.exists(partial_path)
+    assert glob.glob(os.path.join(os.path.dirname(out_path), "*.tmp_ica.fif")) == []
+    assert os.path.exists(out_path) and os.path.exists(manifest_path(out_path))
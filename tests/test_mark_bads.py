@@ -0,0 +1,110 @@
+import os
+import time
+
+import mne
+import numpy as np
+import pytest
+import scipy.io
+from scipy.signal import butter, sosfiltfilt
+
+from conftest import import_script
+from pipeline_utils import NON_EEG_CHANNEL_TYPES, eeglab_session_path, raw_session_path
+from result_cache import manifest_path
+
+mark_bads = import_script("0_mark_bads")
+
+# Channels given bad data by synthetic_recording
+NOISY_CHANNEL = "Cz"
+FLAT_CHANNEL = "Pz"
+
+
+def synthetic_recording(sfreq=250.0, duration=120.0, seed=0):
+    """
+    Returns channel names and data in volts of a recording of the first 64 electrodes of data/channel_locs.elc, driven
+    by spatially smooth sources, with one noisy and one flat channel followed by the non-EEG channels carrying noise.
+    """
+    rng = np.random.default_rng(seed)
+    positions = mark_bads.read_channel_locations()
+    eeg_names = [name for name in positions if name not in NON_EEG_CHANNEL_TYPES][:64]
+    n_times = int(sfreq * duration)
+
+    coordinates = np.array([positions[name] for name in eeg_names])
+    centers = coordinates[rng.choice(len(coordinates), 16, replace=False)]
+    mixing = np.exp(-np.linalg.norm(coordinates[:, None] - centers[None], axis=-1) ** 2 / (2 * 80 ** 2))
+    sources = sosfiltfilt(butter(4, [1, 30], "bandpass", fs=sfreq, output="sos"), np.cumsum(rng.normal(size=(16, n_times)), axis=1))
+    sources /= sources.std(axis=1, keepdims=True)
+    eeg = mixing @ sources * 20 + rng.normal(size=(len(eeg_names), n_times)) * 2
+    eeg[eeg_names.index(NOISY_CHANNEL)] *= 40
+    eeg[eeg_names.index(FLAT_CHANNEL)] = 0
+
+    # EOG, ECG and mastoid channels are far larger than the EEG, and must not be judged as electrodes
+    non_eeg_names = list(NON_EEG_CHANNEL_TYPES)
+    data = np.vstack([eeg, rng.normal(size=(len(non_eeg_names), n_times)) * 2000]) * 1e-6
+    return eeg_names + non_eeg_names, data, sfreq
+
+
+def write_eeglab_session(root_dir, expert, subject_id, session, seed=0):
+    # EEGLAB .set header with the data in a float32 .fdt file, as exported before bad channel marking
+    ch_names, data, sfreq = synthetic_recording(seed=seed)
+    path = eeglab_session_path(root_dir, expert, subject_id, session)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    base = os.path.splitext(os.path.basename(path))[0]
+    (data * 1e6).astype(np.float32).T.tofile(os.path.join(os.path.dirname(path), base + ".fdt"))
+
+    chanlocs = np.zeros((1, len(ch_names)), dtype=[("labels", "O"), ("X", "O"), ("Y", "O"), ("Z", "O"), ("type", "O")])
+    for idx, name in enumerate(ch_names):
+        chanlocs[0, idx] = (name, np.array([]), np.array([]), np.array([]), "")
+    n_times = data.shape[1]
+    eeg = dict(setname=base, filename=base + ".set", filepath="", nbchan=float(len(ch_names)), trials=1.0, pnts=float(n_times), srate=sfreq,
+               xmin=0.0, xmax=(n_times - 1) / sfreq, times=np.zeros((0, 0)), data=base + ".fdt", chanlocs=chanlocs, event=np.zeros((0, 0)),
+               epoch=np.zeros((0, 0)), icawinv=np.zeros((0, 0)), icasphere=np.zeros((0, 0)), icaweights=np.zeros((0, 0)), ref="common",
+               urevent=np.zeros((0, 0)))
+    scipy.io.savemat(path, {"EEG": eeg}, appendmat=False)
+    return path
+
+
+@pytest.mark.parametrize("chunk_duration", [mark_bads.CHUNK_DURATION, 7.0])
+def test_detects_noisy_and_flat_channels(chunk_duration):
+    ch_names, data, sfreq = synthetic_recording()
+    # Every channel is typed as EEG, so the non-EEG channels are only skipped by name
+    raw = mne.io.RawArray(data, mne.create_info(ch_names, sfreq, ch_types="eeg"), verbose=False)
+
+    bads = mark_bads.detect_bad_channels(raw, chunk_duration=chunk_duration)
+    assert set(bads) == {NOISY_CHANNEL, FLAT_CHANNEL}
+    assert "deviation" in bads[NOISY_CHANNEL]
+    assert "flat" in bads[FLAT_CHANNEL]
+    assert not set(bads) & set(NON_EEG_CHANNEL_TYPES)
+
+
+def test_mark_bads_auto_caches_and_keeps_manual_marks(tmp_path, monkeypatch):
+    root_dir = str(tmp_path)
+    write_eeglab_session(root_dir, "expert", "1", 1)
+    out_path = raw_session_path(root_dir, "expert", "1", 1)
+
+    # The electrode positions the neighbors are found from are an input of the marked recording
+    channel_locs_path = str(tmp_path / "channel_locs.elc")
+    with open(mark_bads.CHANNEL_LOCS_PATH) as src, open(channel_locs_path, "w") as dst:
+        dst.write(src.read())
+    monkeypatch.setattr(mark_bads, "CHANNEL_LOCS_PATH", channel_locs_path)
+
+    path, bads = mark_bads.mark_bads_auto(root_dir, "expert", "1", 1)
+    assert path == out_path and set(bads) == {NOISY_CHANNEL, FLAT_CHANNEL}
+    assert os.path.exists(manifest_path(out_path))
+    assert set(mne.io.read_raw_fif(out_path, verbose=False).info["bads"]) == {NOISY_CHANNEL, FLAT_CHANNEL}
+
+    # Current recordings are skipped
+    assert mark_bads.mark_bads_auto(root_dir, "expert", "1", 1) == (out_path, None)
+
+    # Editing the electrode positions or the detector settings marks the recording again
+    with open(channel_locs_path, "a") as f:
+        f.write("\n")
+    assert mark_bads.mark_bads_auto(root_dir, "expert", "1", 1)[1] is not None
+    assert mark_bads.mark_bads_auto(root_dir, "expert", "1", 1, bad_window_fraction=0.5)[1] is not None
+
+    # A recording marked interactively has no manifest and is kept, unless forced
+    os.remove(manifest_path(out_path))
+    mtime = os.path.getmtime(out_path)
+    time.sleep(0.01)
+    assert mark_bads.mark_bads_auto(root_dir, "expert", "1", 1, bad_window_fraction=0.3) == (out_path, None)
+    assert os.path.getmtime(out_path) == mtime
+    assert mark_bads.mark_bads_auto(root_dir, "expert", "1", 1, force=True)[1] is not None
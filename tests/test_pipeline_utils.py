@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+from pipeline_utils import NpyStreamWriter
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32, np.complex128])
+def test_stream_writer_keeps_dtype_of_blocks(tmp_path, dtype):
+    rng = np.random.default_rng(12)
+    blocks = [(rng.normal(size=(n, 3, 3, 2)) + 1j * rng.normal(size=(n, 3, 3, 2))).astype(dtype) if np.dtype(dtype).kind == "c"
+              else rng.normal(size=(n, 3, 3, 2)).astype(dtype) for n in [4, 1, 3]]
+    out_path = str(tmp_path / "connectivity.npy")
+    writer = NpyStreamWriter(out_path)
+    for block in blocks:
+        writer.append(block)
+    writer.close()
+
+    saved = np.load(out_path, mmap_mode="r")
+    assert saved.dtype == dtype
+    np.testing.assert_array_equal(saved, np.concatenate(blocks))
+
+
+def test_stream_writer_casts_to_given_dtype(tmp_path):
+    out_path = str(tmp_path / "connectivity.npy")
+    writer = NpyStreamWriter(out_path, dtype=np.float32)
+    writer.append(np.arange(6, dtype=np.float64).reshape(2, 3))
+    writer.close()
+    saved = np.load(out_path)
+    assert saved.dtype == np.float32
+    np.testing.assert_array_equal(saved, np.arange(6).reshape(2, 3))
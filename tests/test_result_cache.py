@@ -0,0 +1,33 @@
+import json
+
+import numpy as np
+
+from result_cache import is_current, manifest_path, write_manifest
+
+
+def test_output_version_invalidates_results(tmp_path):
+    in_path, out_path = str(tmp_path / "input.npy"), str(tmp_path / "output.npy")
+    np.save(in_path, np.arange(4))
+    np.save(out_path, np.arange(4) * 2)
+    params = {"method": "entropy"}
+
+    write_manifest(out_path, [in_path], params, output_version=2)
+    assert is_current(out_path, [in_path], params, output_version=2)
+    assert not is_current(out_path, [in_path], params, output_version=3)
+    assert not is_current(out_path, [in_path], params)
+
+
+def test_manifests_without_output_version_are_version_1(tmp_path):
+    in_path, out_path = str(tmp_path / "input.npy"), str(tmp_path / "output.npy")
+    np.save(in_path, np.arange(4))
+    np.save(out_path, np.arange(4) * 2)
+    write_manifest(out_path, [in_path], {})
+
+    # Manifests written before output versions were recorded
+    with open(manifest_path(out_path)) as f:
+        manifest = json.load(f)
+    assert manifest.pop("output_version") == 1
+    with open(manifest_path(out_path), "w") as f:
+        json.dump(manifest, f)
+    assert is_current(out_path, [in_path], {}, output_version=1)
+    assert not is_current(out_path, [in_path], {}, output_version=2)
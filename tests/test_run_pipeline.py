@@ -0,0 +1,48 @@
+import os
+
+from run_pipeline import Task, run_tasks
+
+# Task functions run in the worker processes, which import them from this module by name
+
+
+def write_output(out_path):
+    with open(out_path, "w") as f:
+        f.write("done")
+
+
+def fail_once(out_path, marker_path):
+    # The marker file records the first attempt across worker processes
+    if not os.path.exists(marker_path):
+        open(marker_path, "w").close()
+        raise RuntimeError("transient failure")
+    write_output(out_path)
+
+
+def always_fail(out_path):
+    raise RuntimeError("permanent failure")
+
+
+def _task(tmp_path, name, func_name, deps=(), **kwargs):
+    out_path = str(tmp_path / f"{name}.txt")
+    return Task(name, __name__, func_name, dict(out_path=out_path, **kwargs), inputs=[], outputs=[out_path], deps=deps)
+
+
+def test_run_tasks_retries_and_propagates_failures(tmp_path):
+    tasks = [_task(tmp_path, "flaky", "fail_once", marker_path=str(tmp_path / "flaky.marker")),
+             _task(tmp_path, "after_flaky", "write_output", deps=["flaky"]),
+             _task(tmp_path, "broken", "always_fail"),
+             _task(tmp_path, "after_broken", "write_output", deps=["broken"])]
+
+    completed, skipped, failed = run_tasks(tasks, n_workers=2, retries=1)
+    assert set(completed) == {"flaky", "after_flaky"}
+    assert skipped == []
+    assert set(failed) == {"broken", "after_broken"}
+    attempts = {task.name: task.attempts for task in tasks}
+    assert attempts == {"flaky": 2, "after_flaky": 1, "broken": 2, "after_broken": 0}
+    assert os.path.exists(tmp_path / "after_flaky.txt")
+    assert not os.path.exists(tmp_path / "after_broken.txt")
+
+    # Up to date tasks are skipped on the next run, and the failed ones are tried again
+    completed, skipped, failed = run_tasks(tasks, n_workers=2, retries=0)
+    assert completed == [] and set(skipped) == {"flaky", "after_flaky"}
+    assert set(failed) == {"broken", "after_broken"}
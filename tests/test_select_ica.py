@@ -0,0 +1,93 @@
+import os
+from types import SimpleNamespace
+
+import mne
+import numpy as np
+import pytest
+
+from conftest import SYNTHETIC_CHANNELS, import_script
+from pipeline_utils import ica_path, preprocessed_session_path, processed_session_path, working_copy_path
+from result_cache import manifest_path
+
+select_ica = import_script("2_select_ica")
+
+
+@pytest.fixture
+def fitted_root(tmp_path):
+    # Preprocessed session of "expert/1" with a fitted ICA, as written by 1_preproc.py and 1_fit_ica.py
+    root_dir = str(tmp_path)
+    rng = np.random.default_rng(23)
+    info = mne.create_info(SYNTHETIC_CHANNELS + ["VEOGU"], 128.0, ch_types=["eeg"] * len(SYNTHETIC_CHANNELS) + ["eog"])
+    raw = mne.io.RawArray(rng.normal(size=(len(SYNTHETIC_CHANNELS) + 1, 128 * 60)) * 1e-6, info, verbose=False)
+    raw.set_annotations(mne.Annotations([5.0, 30.0], [0.0, 0.0], ["NoG_beg", "NoG_end"]))
+    raw.filter(1.0, None, verbose=False)
+    os.makedirs(os.path.dirname(preprocessed_session_path(root_dir, "expert", "1", 1)))
+    raw.save(preprocessed_session_path(root_dir, "expert", "1", 1), verbose=False)
+
+    ica = mne.preprocessing.ICA(n_components=4, random_state=0)
+    ica.fit(raw, verbose=False)
+    os.makedirs(os.path.dirname(ica_path(root_dir, "expert", "1", 1, 0.9999)))
+    ica.save(ica_path(root_dir, "expert", "1", 1, 0.9999), verbose=False)
+    return root_dir
+
+
+def test_queued_session_drops_automatic_output(fitted_root, monkeypatch):
+    out_path = processed_session_path(fitted_root, "expert", "1", 1, 0.9999)
+    copy_path = working_copy_path(fitted_root, "expert", "1", 1, 0.9999)
+
+    monkeypatch.setattr(select_ica, "auto_select_components", lambda *args, **kwargs: ([0], []))
+    assert select_ica.select_ica_auto(fitted_root, "expert", "1", 1, 0.9999) == (out_path, [])
+    assert all(os.path.exists(path) for path in [out_path, manifest_path(out_path), copy_path])
+
+    # Stricter thresholds make the selection ambiguous, so the earlier automatic output must not be used any more
+    monkeypatch.setattr(select_ica, "auto_select_components", lambda *args, **kwargs: ([0], ["ambiguous"]))
+    assert select_ica.select_ica_auto(fitted_root, "expert", "1", 1, 0.9999, eog_threshold=2.0) == (None, ["ambiguous"])
+    assert not any(os.path.exists(path) for path in [out_path, manifest_path(out_path), copy_path, manifest_path(copy_path)])
+
+
+def test_queued_session_keeps_manual_output(fitted_root, monkeypatch):
+    # A session saved interactively has no manifest and is kept even when the automatic mode is forced
+    out_path = processed_session_path(fitted_root, "expert", "1", 1, 0.9999)
+    os.makedirs(os.path.dirname(out_path))
+    mne.io.read_raw_fif(preprocessed_session_path(fitted_root, "expert", "1", 1), verbose=False).save(out_path, verbose=False)
+
+    monkeypatch.setattr(select_ica, "auto_select_components", lambda *args, **kwargs: ([0], ["ambiguous"]))
+    assert select_ica.select_ica_auto(fitted_root, "expert", "1", 1, 0.9999, force=True) == (None, ["ambiguous"])
+    assert os.path.exists(out_path)
+
+
+@pytest.mark.parametrize("n_components", [None, 0.9999, 8])
+def test_review_window_matches_ica_apply(n_components):
+    rng = np.random.default_rng(5)
+    n_eeg = len(SYNTHETIC_CHANNELS)
+    info = mne.create_info(SYNTHETIC_CHANNELS + ["VEOGU"], 128.0, ch_types=["eeg"] * n_eeg + ["eog"])
+    # A few mixed sources on top of weaker noise, so that a variance fraction keeps fewer components than channels
+    data = rng.normal(size=(n_eeg + 1, 6)) @ rng.laplace(size=(6, 128 * 30)) + 0.05 * rng.laplace(size=(n_eeg + 1, 128 * 30))
+    raw = mne.io.RawArray(data * 1e-6, info, verbose=False)
+    raw.filter(1.0, None, verbose=False)
+    ica = mne.preprocessing.ICA(n_components=n_components, random_state=0)
+    ica.fit(raw, verbose=False)
+    if n_components == 0.9999:
+        assert ica.n_components_ < n_eeg
+
+    exclude = [0, 2]
+    signals = select_ica.ReviewSignals(raw, ica, raw.ch_names)
+    start, stop = 1000, 1640
+    original, cleaned = signals.window(start, stop, exclude)
+    ica.exclude = exclude
+    applied = ica.apply(raw.copy(), verbose=False).get_data(start=start, stop=stop)
+
+    np.testing.assert_array_equal(original, raw.get_data(start=start, stop=stop))
+    assert np.linalg.norm(cleaned - applied) / np.linalg.norm(applied) < 1e-7
+    assert not np.allclose(cleaned, original)
+    # The EOG channel was not part of the fit and is left as it was
+    np.testing.assert_array_equal(cleaned[-1], original[-1])
+    np.testing.assert_array_equal(applied[-1], original[-1])
+
+
+def test_browser_exclude_falls_back_to_ica():
+    ica = SimpleNamespace(exclude=[3, 1])
+    browser = SimpleNamespace(mne=SimpleNamespace(info={"bads": ["ICA002", "ICA000"]}))
+    assert select_ica._browser_exclude(browser, ica) == [0, 2]
+    for browser in [SimpleNamespace(), SimpleNamespace(mne=SimpleNamespace(info={})), SimpleNamespace(mne=SimpleNamespace(info=None))]:
+        assert select_ica._browser_exclude(browser, ica) == [3, 1]
@@ -0,0 +1,185 @@
+import numpy as np
+import pandas as pd
+import pingouin as pg
+import pytest
+from statsmodels.stats.multitest import fdrcorrection, multipletests
+
+from stats_tests import fdr_bh, mixed_anova_2x2, rm_anova_2level, run_mixed_anova, run_network_based_statistic, run_rm_anova
+
+N_ELECTRODES = 12
+
+
+def _p_column(results):
+    # pingouin renamed "p-unc" to "p_unc"
+    return "p_unc" if "p_unc" in results else "p-unc"
+
+
+def _lower_triangle():
+    return zip(*np.tril_indices(N_ELECTRODES, k=-1))
+
+
+def _pingouin_mixed_anova(a1, a2, b1, b2, i, j):
+    # One DataFrame per edge, as run_mixed_anova built them before the closed form
+    n_A, n_B = len(a1), len(b1)
+    df = pd.DataFrame({
+        "subject_id": np.concatenate([np.arange(n_A), np.arange(n_A), n_A + np.arange(n_B), n_A + np.arange(n_B)]),
+        "group": ["A"] * (2 * n_A) + ["B"] * (2 * n_B),
+        "condition": ["1"] * n_A + ["2"] * n_A + ["1"] * n_B + ["2"] * n_B,
+        "plv": np.concatenate([a1[:, i, j], a2[:, i, j], b1[:, i, j], b2[:, i, j]]),
+    })
+    results = pg.mixed_anova(data=df, dv="plv", between="group", within="condition", subject="subject_id", correction=False, effsize="np2")
+    return results["F"].to_numpy(), results[_p_column(results)].to_numpy(), results["np2"].to_numpy()
+
+
+@pytest.fixture
+def mixed_groups():
+    rng = np.random.default_rng(6)
+    n_A, n_B = 9, 7
+    shape = (N_ELECTRODES, N_ELECTRODES)
+    # Condition and group effects of varying strength across edges, on top of a per-subject offset
+    effect = rng.normal(scale=0.3, size=shape)
+    subject_A, subject_B = rng.normal(size=(n_A, 1, 1)), rng.normal(size=(n_B, 1, 1))
+    a1 = subject_A + rng.normal(size=(n_A, *shape))
+    a2 = subject_A + effect + rng.normal(size=(n_A, *shape))
+    b1 = subject_B + effect + rng.normal(size=(n_B, *shape))
+    b2 = subject_B + rng.normal(size=(n_B, *shape))
+    return a1, a2, b1, b2
+
+
+def test_mixed_anova_matches_pingouin(mixed_groups):
+    f_values, p_values, np2 = mixed_anova_2x2(*mixed_groups)
+    assert f_values.shape == p_values.shape == np2.shape == (3, N_ELECTRODES, N_ELECTRODES)
+
+    n_edges = 0
+    for i, j in _lower_triangle():
+        expected_f, expected_p, expected_np2 = _pingouin_mixed_anova(*mixed_groups, i, j)
+        np.testing.assert_allclose(f_values[:, i, j], expected_f, rtol=1e-8)
+        np.testing.assert_allclose(p_values[:, i, j], expected_p, rtol=1e-8)
+        np.testing.assert_allclose(np2[:, i, j], expected_np2, rtol=1e-8)
+        n_edges += 1
+    assert n_edges == 66
+
+
+@pytest.mark.parametrize("fdr_correct", [False, True])
+def test_run_mixed_anova_matches_pingouin(mixed_groups, fdr_correct):
+    p_group, p_condition, p_interaction, np2_condition = run_mixed_anova(*mixed_groups, fdr_correct=fdr_correct)
+
+    mask = np.tril(np.ones((N_ELECTRODES, N_ELECTRODES)), k=-1).astype(bool)
+    expected = np.ones((3, N_ELECTRODES, N_ELECTRODES))
+    expected_np2 = np.ones((N_ELECTRODES, N_ELECTRODES))
+    for i, j in _lower_triangle():
+        _, expected[:, i, j], np2 = _pingouin_mixed_anova(*mixed_groups, i, j)
+        expected_np2[i, j] = np2[1]
+    if fdr_correct:
+        for effect in expected:
+            effect[mask] = multipletests(effect[mask], alpha=0.05, method="fdr_bh")[1]
+
+    for actual, effect in zip([p_group, p_condition, p_interaction], expected):
+        np.testing.assert_allclose(actual, effect, rtol=1e-8)
+    np.testing.assert_allclose(np2_condition, expected_np2, rtol=1e-8)
+
+
+def _pingouin_rm_anova(c1, c2):
+    # Each subject contributes one row per condition, without the duplicated condition 2 rows of the original loop
+    n_subj = len(c1)
+    df = pd.DataFrame({
+        "subject_id": np.concatenate([np.arange(n_subj), np.arange(n_subj)]),
+        "condition": ["1"] * n_subj + ["2"] * n_subj,
+        "plv": np.concatenate([c1, c2]),
+    })
+    results = pg.rm_anova(data=df, dv="plv", within="condition", subject="subject_id", correction=False, effsize="np2")
+    return results["F"][0], results[_p_column(results)][0], results["np2"][0]
+
+
+@pytest.fixture
+def rm_conditions():
+    rng = np.random.default_rng(7)
+    n_subj, n_bands = 11, 3
+    shape = (N_ELECTRODES, N_ELECTRODES, n_bands)
+    subject = rng.normal(size=(n_subj, 1, 1, 1))
+    c1 = subject + rng.normal(size=(n_subj, *shape))
+    c2 = subject + rng.normal(scale=0.4, size=shape) + rng.normal(size=(n_subj, *shape))
+    return c1, c2
+
+
+def test_rm_anova_matches_pingouin(rm_conditions):
+    c1, c2 = rm_conditions
+    f_values, p_values, np2 = rm_anova_2level(c1, c2)
+    assert f_values.shape == c1.shape[1:]
+
+    for i, j in _lower_triangle():
+        for band in range(c1.shape[-1]):
+            expected_f, expected_p, expected_np2 = _pingouin_rm_anova(c1[:, i, j, band], c2[:, i, j, band])
+            np.testing.assert_allclose(f_values[i, j, band], expected_f, rtol=1e-8)
+            np.testing.assert_allclose(p_values[i, j, band], expected_p, rtol=1e-8)
+            np.testing.assert_allclose(np2[i, j, band], expected_np2, rtol=1e-8)
+
+
+@pytest.mark.parametrize("fdr_correct", [False, True])
+def test_run_rm_anova_matches_pingouin(rm_conditions, fdr_correct):
+    c1, c2 = rm_conditions
+    mask = np.tril(np.ones((N_ELECTRODES, N_ELECTRODES)), k=-1).astype(bool)
+
+    # With a band axis every band is corrected on its own, and each band matches the run without a band axis
+    p_values = run_rm_anova(c1, c2, fdr_correct=fdr_correct)
+    assert p_values.shape == c1.shape[1:]
+    for band in range(c1.shape[-1]):
+        expected = np.ones((N_ELECTRODES, N_ELECTRODES))
+        for i, j in _lower_triangle():
+            expected[i, j] = _pingouin_rm_anova(c1[:, i, j, band], c2[:, i, j, band])[1]
+        if fdr_correct:
+            expected[mask] = fdrcorrection(expected[mask])[1]
+        np.testing.assert_allclose(p_values[..., band], expected, rtol=1e-8)
+        np.testing.assert_array_equal(run_rm_anova(c1[..., band], c2[..., band], fdr_correct=fdr_correct), p_values[..., band])
+
+
+def test_fdr_bh_matches_statsmodels():
+    rng = np.random.default_rng(8)
+    # Ties and p-values large enough to be capped at 1 exercise the monotonicity and clipping
+    p_values = rng.choice(np.concatenate([rng.uniform(size=40), [0.01, 0.01, 0.5, 0.5, 0.999]]), size=(5, 66, 4))
+    for axis in range(p_values.ndim):
+        adjusted = fdr_bh(p_values, axis=axis)
+        moved, moved_adjusted = np.moveaxis(p_values, axis, -1), np.moveaxis(adjusted, axis, -1)
+        for idx in np.ndindex(moved.shape[:-1]):
+            np.testing.assert_allclose(moved_adjusted[idx], fdrcorrection(moved[idx])[1], rtol=1e-12)
+
+
+# Edges of the component planted in nbs_groups, between electrodes 0, 1, 2 and 3
+PLANTED_EDGES = [(1, 0), (2, 1), (3, 2)]
+
+
+@pytest.fixture
+def nbs_groups():
+    # Null data with a strong condition effect on a chain of three edges
+    rng = np.random.default_rng(8)
+    n_A, n_B = 10, 9
+    shape = (N_ELECTRODES, N_ELECTRODES)
+    groups = [rng.normal(size=(n, *shape)) for n in [n_A, n_A, n_B, n_B]]
+    for i, j in PLANTED_EDGES:
+        groups[1][:, i, j] += 3.0
+        groups[3][:, i, j] += 3.0
+    return groups
+
+
+def test_network_based_statistic_finds_planted_component(nbs_groups):
+    masks, p_values, null_distribution = run_network_based_statistic(*nbs_groups, effect="condition", primary_p=0.001, n_permutations=600)
+
+    expected = np.zeros((N_ELECTRODES, N_ELECTRODES), dtype=bool)
+    for i, j in PLANTED_EDGES:
+        expected[i, j] = True
+    assert len(masks) == 1
+    np.testing.assert_array_equal(masks[0], expected)
+    assert null_distribution.shape == (600,)
+    # No relabelling reaches a component of three edges, so the p-value is the smallest possible
+    assert null_distribution.max() < len(PLANTED_EDGES)
+    np.testing.assert_allclose(p_values, [1 / 601])
+
+
+@pytest.mark.parametrize("n_jobs", [2, -1])
+def test_network_based_statistic_does_not_depend_on_n_jobs(nbs_groups, n_jobs):
+    # 600 permutations make two full chunks and a partial one
+    serial = run_network_based_statistic(*nbs_groups, effect="group", n_permutations=600, n_jobs=1)
+    parallel = run_network_based_statistic(*nbs_groups, effect="group", n_permutations=600, n_jobs=n_jobs)
+    np.testing.assert_array_equal(serial[2], parallel[2])
+    np.testing.assert_array_equal(serial[1], parallel[1])
+    assert len(serial[0]) == len(parallel[0]) and all(np.array_equal(a, b) for a, b in zip(serial[0], parallel[0]))
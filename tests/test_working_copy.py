@@ -0,0 +1,33 @@
+import os
+
+import numpy as np
+
+from conftest import import_script
+from pipeline_utils import CONDITIONS, connectivity_output_path
+from working_copy import WORKING_SFREQ, load_working_copy, write_working_copy
+
+
+def test_working_copy_results_are_saved_apart(processed_root):
+    entropy = import_script("3_compute_connectivity_entropy")
+    copy_path = write_working_copy(processed_root, "expert", "1", 1, 0.9999)
+    raw, _ = load_working_copy(copy_path)
+    assert raw.info["sfreq"] == WORKING_SFREQ
+
+    out_paths = entropy.compute_conditions(processed_root, "expert", "1", dir_suffix="_5s", working_copies=True)
+    for condition in CONDITIONS:
+        assert out_paths["entropy"][condition] == connectivity_output_path(processed_root, "_5s_wc128", "expert", "1", *condition)
+        assert os.path.exists(out_paths["entropy"][condition])
+        assert not os.path.exists(connectivity_output_path(processed_root, "_5s", "expert", "1", *condition))
+
+    # Results at the original rate do not overwrite, and are not mistaken for, those of the working copies
+    full_paths = entropy.compute_conditions(processed_root, "expert", "1", dir_suffix="_5s")
+    for condition in CONDITIONS:
+        assert full_paths["entropy"][condition] != out_paths["entropy"][condition]
+        assert np.load(full_paths["entropy"][condition]).shape[1:] == np.load(out_paths["entropy"][condition]).shape[1:]
+
+
+def test_pipeline_tracks_working_copy_outputs(processed_root):
+    run_pipeline = import_script("run_pipeline")
+    tasks = run_pipeline.build_task_graph(processed_root, stages=["connectivity"], connectivity_kwargs={"working_copies": True})
+    connectivity = [task for task in tasks if task.name == "connectivity/expert/1"][0]
+    assert connectivity.outputs == [connectivity_output_path(processed_root, "_wc128", "expert", "1", *condition) for condition in CONDITIONS]
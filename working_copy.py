@@ -0,0 +1,167 @@
+import mne
+import argparse
+import os
+import zipfile
+import numpy as np
+from instrumentation import stage
+from result_cache import is_current, write_manifest
+from connectivity_store import mmap_npz_member
+from pipeline_utils import ELECTRODE_SETS, SESSIONS, CONDITIONS, condition_prefix, processed_session_path, working_copy_path, load_processed_session, find_condition_windows, resolve_electrodes, parse_electrodes, pick_electrodes
+
+# Sampling frequency of the working copies, comfortably above twice the 30 Hz upper bound of the studied bands
+WORKING_SFREQ = 128.0
+
+# Bump when the layout or content of working copies changes so that older copies are rewritten
+OUTPUT_VERSION = 1
+
+GROUPS = ["expert", "novice"]
+
+
+def _windows_member(condition):
+    # Name of the (n_windows, 2) array of (start, end) times of a condition, e.g. "windows_BL_NoG"
+    return "windows_" + condition_prefix(*condition).rstrip("_")
+
+
+def working_copy_params(sfreq=WORKING_SFREQ, electrodes="interest"):
+    # Every parameter that affects the content of a working copy, recorded in its manifest
+    return {"sfreq": sfreq, "electrodes": resolve_electrodes(electrodes)}
+
+
+def working_copy_sfreq(paths):
+    # Sampling frequency of the first of a subject's working copies, or WORKING_SFREQ if none are written yet
+    if len(paths) == 0:
+        return WORKING_SFREQ
+    with np.load(paths[0]) as npz:
+        return float(npz["sfreq"])
+
+
+def working_copy_dir_suffix(dir_suffix, sfreq=WORKING_SFREQ):
+    # Connectivity computed from working copies is saved apart from the results at the original rate, e.g. "_5s_wc128"
+    return f"{dir_suffix}_wc{sfreq:g}"
+
+
+def write_working_copy(root_dir, expert, subject_id, session, num_ica_comps, sfreq=WORKING_SFREQ, electrodes="interest", force=False):
+    """
+    Writes the working copy of a processed session: the picked electrodes resampled to sfreq, which band-limits them
+    to below sfreq / 2, as float32, together with the annotations and the parsed condition windows.
+
+    The copy is an uncompressed .npz whose data is memory-mapped by load_working_copy. It carries a manifest of the
+    processed file and the parameters, so it is only rewritten when either changes.
+
+    Returns:
+        out_path : path of the working copy, or None if the processed session is missing.
+    """
+    in_path = processed_session_path(root_dir, expert, subject_id, session, num_ica_comps)
+    out_path = working_copy_path(root_dir, expert, subject_id, session, num_ica_comps)
+    params = working_copy_params(sfreq, electrodes)
+    if not force and is_current(out_path, [in_path], params, OUTPUT_VERSION):
+        print("Working copy is up to date: ", out_path)
+        return out_path
+
+    raw = load_processed_session(root_dir, expert, subject_id, session, num_ica_comps, electrodes=electrodes)
+    if raw is None:
+        return None
+
+    # Parse the windows before resampling, from the same annotations as the connectivity scripts
+    windows = find_condition_windows(raw, CONDITIONS)
+    raw.resample(sfreq)
+
+    # Annotation onsets are stored relative to the first sample, as the copy is read back without a measurement date
+    annotations = raw.annotations
+    arrays = {
+        "data": raw.get_data().astype(np.float32),
+        "sfreq": np.float64(raw.info["sfreq"]),
+        "ch_names": np.array(raw.ch_names),
+        "annotation_onsets": annotations.onset - raw.first_time,
+        "annotation_durations": annotations.duration,
+        "annotation_descriptions": np.array([str(description) for description in annotations.description]),
+    }
+    for condition in CONDITIONS:
+        arrays[_windows_member(condition)] = np.array(windows[condition], dtype=np.float64).reshape(-1, 2)
+
+    # Write to a temporary file first so that an interrupted run never leaves a truncated copy behind
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    tmp_path = out_path + ".tmp"
+    with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for name, arr in arrays.items():
+            with zf.open(name + '.npy', 'w', force_zip64=True) as f:
+                np.lib.format.write_array(f, np.asarray(arr), allow_pickle=False)
+    os.replace(tmp_path, out_path)
+    write_manifest(out_path, [in_path], params, OUTPUT_VERSION)
+    print("Saved working copy to: ", out_path)
+    return out_path
+
+
+def load_working_copy(path):
+    """
+    Loads a working copy written by write_working_copy.
+
+    The float32 data is memory-mapped, but mne.io.RawArray always holds float64, so the Raw object is a float64 copy of
+    the picked electrodes at the reduced rate. Filtering and the connectivity engines compute in float64 either way.
+
+    Returns:
+        (raw, windows) : MNE Raw object with the picked electrodes and the annotations of the processed session, and
+        dict mapping every condition in CONDITIONS to its list of (start, end) windows, as find_condition_windows.
+    """
+    with np.load(path) as npz:
+        sfreq = float(npz["sfreq"])
+        ch_names = [str(name) for name in npz["ch_names"]]
+        annotations = mne.Annotations(npz["annotation_onsets"], npz["annotation_durations"], npz["annotation_descriptions"])
+        windows = {condition: [tuple(window) for window in npz[_windows_member(condition)].tolist()] for condition in CONDITIONS}
+
+    # Only the memory-mapped float32 data is read from disk, and converted into the float64 buffer of the Raw object
+    data = mmap_npz_member(path, "data")
+    raw = mne.io.RawArray(data, mne.create_info(ch_names, sfreq, ch_types="eeg"), verbose=False)
+    raw.set_annotations(annotations)
+    return raw, windows
+
+
+def load_working_session(root_dir, expert, subject_id, session, num_ica_comps, electrodes=None):
+    """
+    Counterpart of pipeline_utils.load_processed_session that reads the working copy of a session.
+
+    Args:
+        electrodes: Optional named electrode set or list of electrodes to pick, which must be part of the copy.
+
+    Returns:
+        (raw, windows) : as load_working_copy, or (None, None) if the working copy is missing.
+    """
+    path = working_copy_path(root_dir, expert, subject_id, session, num_ica_comps)
+    try:
+        with stage("read_working_copy", session=session):
+            raw, windows = load_working_copy(path)
+    except FileNotFoundError:
+        print("Skipping session ", session, " due to missing working copy")
+        return None, None
+    if electrodes is not None:
+        pick_electrodes(raw, electrodes)
+    return raw, windows
+
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description="Write decimated float32 working copies of processed sessions for the connectivity scripts")
+    parser.add_argument('--root_dir', type=str, default="/Volumes/eeg", help='Root directory of the data')
+    parser.add_argument("--num_ica_comps", help="Number of ICA components", default=0.9999, type=float)
+    parser.add_argument("--experts", help="Groups to write", nargs="+", default=GROUPS, choices=GROUPS)
+    parser.add_argument("--ids", help="IDs of the participants to write, defaults to every processed participant", nargs="+", default=None)
+    parser.add_argument("--sfreq", help="Sampling frequency of the working copies", default=WORKING_SFREQ, type=float)
+    parser.add_argument("--electrodes", help=f"Electrodes to keep: one of {list(ELECTRODE_SETS)}, 'eeg' for all EEG channels, or a list of electrode names",
+                        nargs="+", default=["interest"])
+    parser.add_argument("--force", help="Rewrite working copies that are up to date", action="store_true")
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    for expert in args.experts:
+        group_dir = os.path.join(args.root_dir, 'processed', expert)
+        if not os.path.isdir(group_dir):
+            continue
+        for subject_id in sorted(os.listdir(group_dir)) if args.ids is None else args.ids:
+            for session in SESSIONS:
+                if os.path.exists(processed_session_path(args.root_dir, expert, subject_id, session, args.num_ica_comps)):
+                    write_working_copy(args.root_dir, expert, subject_id, session, args.num_ica_comps, sfreq=args.sfreq,
+                                       electrodes=parse_electrodes(args.electrodes), force=args.force)
+
+if __name__ == '__main__':
+    main()